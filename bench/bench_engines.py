@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""Benchmark the commit engines against a simulated GitHub API
+
+Every API call (REST or GraphQL) costs a fixed network latency. Contents API writes are additionally
+serialized per repository, as GitHub does, and hold the repository for the write time.
+
+Usage: python bench/bench_engines.py [--comments N] [--latency MS] [--write MS]
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import statistics
+import sys
+import time
+from unittest import mock
+
+from tornado.httpclient import AsyncHTTPClient, HTTPResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+# noinspection PyPackageRequirements
+import form  # noqa: E402
+# noinspection PyPackageRequirements
+import github  # noqa: E402
+# noinspection PyPackageRequirements
+import processor  # noqa: E402
+
+
+class FakeGithub(object):
+    """Answer GitHub API calls with canned responses after a simulated delay"""
+
+    def __init__(self, latency: float, write: float):
+        self._latency = latency
+        self._write = write
+        self._contents_lock = asyncio.Lock()
+        self.calls = 0
+
+    async def fetch(self, request, **_kwargs):
+        self.calls += 1
+        await asyncio.sleep(self._latency)
+
+        if request.method == "PUT" and "/contents/" in request.url:
+            async with self._contents_lock:
+                await asyncio.sleep(self._write)
+
+        code, body = self._answer(request)
+        return HTTPResponse(request, code, None, io.BytesIO(json.dumps(body).encode()))
+
+    @staticmethod
+    def _answer(request):
+        if request.url.endswith("/graphql"):
+            query = json.loads(request.body)["query"]
+            if "createPullRequest" in query:
+                return 200, {"data": {"createPullRequest": {"pullRequest": {"id": "pr", "number": 1}}}}
+            if "repository(" in query:
+                return 200, {"data": {"repository": {"id": "repo", "label": {"id": "label"}}}}
+            return 200, {"data": {}}
+        if request.method == "GET" and "/git/matching-refs/" in request.url:
+            return 200, [{"object": {"sha": "head"}}]
+        if request.method == "GET" and "/git/commits/" in request.url:
+            return 200, {"sha": "head", "tree": {"sha": "tree"}}
+        if request.method == "POST" and request.url.endswith("/pulls"):
+            return 201, {"number": 1}
+        if request.method == "POST" and request.url.endswith("/labels"):
+            return 200, {}
+        if request.method in ["POST", "PUT"]:
+            return 201, {"sha": "new"}
+        return 404, {}
+
+
+async def run_engine(engine: str, comments: int, latency: float, write: float) -> dict:
+    cfg = github.GithubConfiguration(user="bench", token="bench", repository="bench", email="bench@example.com",
+                                     engine=engine)
+    proc = processor.CommentProcessor(cfg)
+    fake = FakeGithub(latency, write)
+
+    # Start each engine with cold caches
+    github.HEAD_CACHE.clear()
+    github.GithubGraphQLRepository._ids.clear()
+
+    async def one(i):
+        cmt = form.Comment(slug="bench", name="Bench %i" % i, message="Message %i" % i)
+        start = time.perf_counter()
+        assert await proc.comment_to_github_pr(cmt) is not None
+        return time.perf_counter() - start
+
+    with mock.patch.object(AsyncHTTPClient, 'fetch', side_effect=fake.fetch):
+        durations = await asyncio.gather(*[one(i) for i in range(comments)])
+
+    durations = sorted(durations)
+    return {
+        "engine": engine,
+        "round trips": fake.calls / comments,
+        "mean ms": statistics.mean(durations) * 1000,
+        "p99 ms": durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1000
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--comments", type=int, default=20, help="Concurrent comments per engine")
+    parser.add_argument("--latency", type=float, default=50, help="Simulated latency per call in ms")
+    parser.add_argument("--write", type=float, default=100, help="Serialized contents write time in ms")
+    args = parser.parse_args()
+
+    print("%-10s %12s %10s %10s" % ("engine", "round trips", "mean ms", "p99 ms"))
+    for engine in github.GithubConfiguration.ENGINES:
+        result = await run_engine(engine, args.comments, args.latency / 1000, args.write / 1000)
+        print("%-10s %12.1f %10.1f %10.1f" % tuple(result.values()))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
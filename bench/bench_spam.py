@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""Benchmark the spam filter stages per comment
+
+A blocklist and a model are generated from random words; the comments mix ordinary words, blocked terms and links.
+
+Usage: python bench/bench_spam.py [--comments N] [--terms N] [--words N]
+"""
+
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+# noinspection PyPackageRequirements
+import spam  # noqa: E402
+
+
+def random_word(rnd: random.Random) -> str:
+    return "".join(rnd.choices(string.ascii_lowercase, k=rnd.randint(3, 10)))
+
+
+def make_comments(rnd: random.Random, count: int, words: int, terms: list[str]) -> list[str]:
+    comments = list()
+    for _ in range(count):
+        text = [random_word(rnd) for _ in range(words)]
+        if rnd.random() < 0.1:
+            text[rnd.randrange(words)] = rnd.choice(terms)
+        if rnd.random() < 0.2:
+            text[rnd.randrange(words)] = "https://%s.example" % random_word(rnd)
+        comments.append(" ".join(text))
+    return comments
+
+
+def per_comment(func, comments: list[str]) -> float:
+    """Microseconds per comment"""
+    start = time.perf_counter()
+    for comment in comments:
+        func(comment)
+    return (time.perf_counter() - start) / len(comments) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--comments", type=int, default=2000, help="Number of comments")
+    parser.add_argument("--terms", type=int, default=10000, help="Number of blocked terms")
+    parser.add_argument("--words", type=int, default=100, help="Words per comment")
+    args = parser.parse_args()
+
+    rnd = random.Random(42)
+    terms = [random_word(rnd) for _ in range(args.terms)]
+    comments = make_comments(rnd, args.comments, args.words, terms)
+    trained = spam.NaiveBayesModel.train(spam=make_comments(rnd, 500, args.words, terms),
+                                         ham=make_comments(rnd, 500, args.words, terms))
+    model = spam.NaiveBayesModel(trained)
+
+    with tempfile.TemporaryDirectory() as directory:
+        blocklist_path = os.path.join(directory, "blocklist.txt")
+        with open(blocklist_path, "w") as f:
+            f.write("\n".join(terms))
+        model_path = os.path.join(directory, "model.json")
+        with open(model_path, "w") as f:
+            json.dump(trained, f)
+
+        start = time.perf_counter()
+        blocklist = spam.BlocklistMatcher.load(blocklist_path)
+        build = time.perf_counter() - start
+
+        spam_filter = spam.SpamFilter(spam.SpamConfiguration(blocklist=blocklist_path, model=model_path,
+                                                              max_links=5))
+
+    print("blocklist with %i terms built in %.1f ms" % (args.terms, build * 1000))
+    print("%-10s %14s" % ("stage", "µs per comment"))
+    for stage, func in [("blocklist", blocklist.find),
+                        ("links", spam.LINK_PATTERN.findall),
+                        ("tokenize", spam.tokenize),
+                        ("model", lambda text: model.probability(spam.tokenize(text))),
+                        ("total", spam_filter.classify)]:
+        print("%-10s %14.1f" % (stage, per_comment(func, comments)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+""" Module for admission control of the comment processing """
+
+from dataclasses import dataclass
+from typing import Callable, Awaitable, Optional, Any
+
+import asyncio
+import contextlib
+import math
+import os
+
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class AdmissionConfiguration(object):
+    """Configuration for the admission gate"""
+    DEFAULT_CONCURRENCY = 8
+    DEFAULT_QUEUE = 32
+    DEFAULT_TIMEOUT = 10.0
+    DEFAULT_MIN_BUDGET = 20
+    DEFAULT_RETRY_AFTER = 5
+
+    concurrency: int = DEFAULT_CONCURRENCY
+    queue: int = DEFAULT_QUEUE
+    timeout: float = DEFAULT_TIMEOUT
+    min_budget: int = DEFAULT_MIN_BUDGET
+    retry_after: int = DEFAULT_RETRY_AFTER
+
+    @staticmethod
+    def from_environment():
+        return AdmissionConfiguration(
+            concurrency=int(os.getenv("ADMISSION_CONCURRENCY", AdmissionConfiguration.DEFAULT_CONCURRENCY)),
+            queue=int(os.getenv("ADMISSION_QUEUE", AdmissionConfiguration.DEFAULT_QUEUE)),
+            timeout=float(os.getenv("ADMISSION_TIMEOUT", AdmissionConfiguration.DEFAULT_TIMEOUT)),
+            min_budget=int(os.getenv("ADMISSION_MIN_BUDGET", AdmissionConfiguration.DEFAULT_MIN_BUDGET)),
+            retry_after=int(os.getenv("ADMISSION_RETRY_AFTER", AdmissionConfiguration.DEFAULT_RETRY_AFTER))
+        )
+
+    def __post_init__(self):
+        if self.concurrency < 1:
+            raise ValueError("ADMISSION_CONCURRENCY (concurrency) must be at least 1!")
+
+        if self.queue < 0:
+            raise ValueError("ADMISSION_QUEUE (queue) must not be negative!")
+
+        if self.timeout <= 0:
+            raise ValueError("ADMISSION_TIMEOUT (timeout) must be positive!")
+
+        if self.min_budget < 0:
+            raise ValueError("ADMISSION_MIN_BUDGET (min_budget) must not be negative!")
+
+        if self.retry_after < 1:
+            raise ValueError("ADMISSION_RETRY_AFTER (retry_after) must be at least 1!")
+
+
+class Overloaded(Exception):
+    """The request has been shed and should be repeated after retry_after seconds"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionGate(object):
+    """Bound the number of comments processed concurrently
+
+    Up to `concurrency` comments are processed at once, up to `queue` further comments wait for a slot.
+    Requests are shed (Overloaded) when the queue is full, the wait exceeds the timeout,
+    or the remaining GitHub budget is too small to process them.
+    Preparations ahead of the admission (e.g. prefetching) are only started if a comment would be admitted now.
+    """
+
+    def __init__(self,
+                 cfg: AdmissionConfiguration,
+                 budget: Optional[Callable[[], tuple[Optional[int], float, float]]] = None):
+        """
+
+        :param cfg: Gate configuration
+        :param budget: (Optional) Return the remaining calls (None if unknown), the seconds calls are held back
+                       and the seconds until the budget is reset
+        """
+        if cfg is None:
+            raise ValueError("Admission configuration must be provided!")
+
+        self._cfg = cfg
+        self._budget = budget
+
+        self._slots = asyncio.Semaphore(cfg.concurrency)
+        self._in_flight = 0
+        self._queued = 0
+        self._admitted = 0
+        self._shed = 0
+        self._prefetching = 0
+
+    def wrap(self, cb: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        """Return the callback running behind the gate"""
+        async def gated(*args, **kwargs):
+            async with self.admit():
+                return await cb(*args, **kwargs)
+
+        return gated
+
+    def prefetch(self, call: Callable[[], Awaitable[Any]]) -> Optional[asyncio.Future]:
+        """Start a preparation of a comment that has not been admitted yet, e.g. read-only GitHub calls
+
+        It is only started if the budget suffices and a slot is free, and at most `concurrency` run at once,
+        so that a held back budget or an overload never makes the comment wait for it.
+
+        :return: The running preparation or None if it has not been started
+        """
+        if self._budget_exceeded() is not None or self._slots.locked() or \
+                self._prefetching >= self._cfg.concurrency:
+            return None
+
+        self._prefetching += 1
+        future = asyncio.ensure_future(call())
+        future.add_done_callback(self._prefetch_done)
+        return future
+
+    def _prefetch_done(self, _future: asyncio.Future) -> None:
+        self._prefetching -= 1
+
+    @contextlib.asynccontextmanager
+    async def admit(self):
+        exceeded = self._budget_exceeded()
+        if exceeded is not None:
+            self._reject(*exceeded)
+
+        if self._slots.locked() and self._queued >= self._cfg.queue:
+            self._reject("Too many comments in process", self._cfg.retry_after)
+
+        self._queued += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self._cfg.timeout)
+        except asyncio.TimeoutError:
+            self._reject("Timeout waiting for comment processing", self._cfg.retry_after)
+        finally:
+            self._queued -= 1
+
+        self._in_flight += 1
+        self._admitted += 1
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            self._slots.release()
+
+    def _budget_exceeded(self) -> Optional[tuple[str, int]]:
+        """Return the reason and the seconds to retry after if the budget does not suffice"""
+        if self._budget is None:
+            return None
+
+        remaining, blocked, reset_in = self._budget()
+        if blocked > 0:
+            return "GitHub calls are held back", max(self._cfg.retry_after, math.ceil(blocked))
+        if remaining is not None and remaining < self._cfg.min_budget:
+            return "GitHub rate limit is nearly used up", max(self._cfg.retry_after, math.ceil(reset_in))
+        return None
+
+    def _reject(self, reason: str, retry_after: int) -> None:
+        self._shed += 1
+        LOGGER.warning("Shedding comment: %s, retry after %i seconds", reason, retry_after)
+        raise Overloaded(reason, retry_after)
+
+    def get_health(self) -> tuple[dict, bool]:
+        """Return the gate statistics; status is always healthy"""
+        return {
+            "concurrency": self._cfg.concurrency,
+            "in-flight": self._in_flight,
+            "queued": self._queued,
+            "admitted": self._admitted,
+            "shed": self._shed,
+            "prefetching": self._prefetching
+        }, True
@@ -14,19 +14,40 @@ import logging
 
 import form
 import captcha
+import outbound
+import jobs
+import admission
+import metrics
+import dedup
+import idempotency
+import throttle
+import spam
+import lag
 
 LOG_FORMAT = '%(levelname) -10s %(asctime)s %(name) -15s %(lineno) -5d: %(message)s'
 LOGGER = logging.getLogger(__name__)
 
 
-def make_app(cmt_cfg, comment_cb, recaptcha=None) -> tornado.web.Application:
+def make_app(cmt_cfg, comment_cb, challenge=None, enqueue_cb=None, prefetch_cb=None,
+             duplicate_cb=None, idempotency_cb=None, rate_limiter=None, spam_filter=None,
+             admission_gate=None) -> tornado.web.Application:
     version_path = r"/v[0-9]"
     return tornado.web.Application([
         (version_path + r"/health", service.HealthHandler),
+        (version_path + r"/metrics", service.MetricsHandler),
         (version_path + r"/oas3", service.Oas3Handler),
+        (version_path + r"/challenge", form.ChallengeHandler, {"cfg": cmt_cfg,
+                                                               "challenge": challenge}),
         (version_path + r"/comment", form.CommentHandler, {"cfg": cmt_cfg,
                                                            "comment_cb": comment_cb,
-                                                           "recaptcha": recaptcha}),
+                                                           "challenge": challenge,
+                                                           "enqueue_cb": enqueue_cb,
+                                                           "prefetch_cb": prefetch_cb,
+                                                           "duplicate_cb": duplicate_cb,
+                                                           "idempotency_cb": idempotency_cb,
+                                                           "rate_limiter": rate_limiter,
+                                                           "spam_filter": spam_filter,
+                                                           "admission_gate": admission_gate}),
     ])
 
 
@@ -35,47 +56,164 @@ def main():
     logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 
     # Service Configuration
-    service_port = os.getenv('SERVICE_PORT', 8080)
+    service_port = int(os.getenv('SERVICE_PORT', 8080))
+    drain_timeout = float(os.getenv('SERVICE_DRAIN_TIMEOUT', service.TerminationGuard.DEFAULT_DEADLINE))
+    worker_cfg = service.WorkerConfiguration.from_environment()
+    loop_cfg = service.LoopConfiguration.from_environment()
     cmt_cfg = form.FormConfiguration.from_environment()
 
+    # Worker processes; everything below is set up per worker, e.g. the outbound connection pool
+    form.CommentIdGenerator.assert_workers(worker_cfg.count())
+    service.fork_workers(worker_cfg)
+
+    # Event loop implementation, before anything creates the loop
+    service.platform_setup(loop_cfg)
+
+    # Outbound HTTP client, shared by all modules
+    outbound_client = outbound.setup(outbound.OutboundConfiguration.from_environment())
+
     # Comment Processor
     github_cfg = github.GithubConfiguration.from_environment()
-    comment_processor = processor.CommentProcessor(github_cfg)
-
-    # reCAPTCHA
+    github.SCHEDULER.configure(github_cfg.rate, github_cfg.burst, github_cfg.rate_retries)
+    processor_cfg = processor.ProcessorConfiguration.from_environment()
+    comment_processor = processor.CommentProcessor(github_cfg, processor_cfg)
+
+    # Admission gate in front of the comment processing, checks the budget of the GitHub resources used
+    resources = comment_processor.resources()
+    admission_gate = admission.AdmissionGate(admission.AdmissionConfiguration.from_environment(),
+                                             lambda: github.SCHEDULER.budget(resources))
+    # In digest mode the comments only wait for their digest, so the digest is gated instead
+    comment_gate = admission_gate
+    if comment_processor.is_digest_enabled():
+        comment_processor.gate_digests(admission_gate.wrap)
+        comment_gate = None
+
+    # Challenge: local proof-of-work takes precedence over reCAPTCHA
+    pow_cfg = captcha.ProofOfWorkConfiguration.from_environment()
     recaptcha_cfg = captcha.RecaptchaConfiguration.from_environment()
-    recaptcha = None
-    if recaptcha_cfg.is_enabled():
+    challenge = None
+    if pow_cfg.is_enabled():
+        LOGGER.info("Proof-of-work setup has been recognized.")
+        challenge = captcha.ProofOfWork(pow_cfg)
+    elif recaptcha_cfg.is_enabled():
         LOGGER.info("reCAPTCHA setup has been recognized.")
-        recaptcha = captcha.Recaptcha(recaptcha_cfg)
+        challenge = captcha.Recaptcha(recaptcha_cfg)
 
     # Setup ioloop
-    service.platform_setup()
     ioloop = tornado.ioloop.IOLoop.current()
-    guard = service.TerminationGuard(ioloop)
+    guard = service.TerminationGuard(ioloop, drain_timeout)
+
+    # Event loop lag monitor
+    lag_cfg = lag.LagConfiguration.from_environment()
+    lag_monitor = None
+    if lag_cfg.is_enabled():
+        lag_monitor = lag.LagMonitor(lag_cfg)
+        ioloop.add_callback(lag_monitor.start)
+        guard.add_termination_handler(lag_monitor.stop)
 
     # Setup Service Management endpoint
-    mgmt_ep = service.ServiceEndpoint(listen_port=service_port)
+    mgmt_ep = service.ServiceEndpoint(listen_port=service_port, reuse_port=worker_cfg.is_enabled())
     guard.add_termination_handler(mgmt_ep.stop)
-    app = make_app(cmt_cfg, comment_processor.comment_to_github_pr, recaptcha)
+
+    # Job queue, if configured the comments are processed in the background
+    job_cfg = jobs.JobQueueConfiguration.from_environment()
+    job_queue = None
+    if job_cfg.is_enabled():
+        job_queue = jobs.JobQueue(job_cfg, comment_gate.wrap(comment_processor.comment_to_github_pr)
+                                  if comment_gate else comment_processor.comment_to_github_pr)
+        ioloop.add_callback(job_queue.start)
+        guard.add_termination_handler(job_queue.stop)
+
+    # Duplicate detection, answers repeated comments with the original response
+    duplicate_cfg = dedup.DuplicateConfiguration.from_environment()
+    duplicate_index = None
+    if duplicate_cfg.is_enabled():
+        duplicate_index = dedup.DuplicateIndex(duplicate_cfg)
+
+    # Idempotency keys, answer repeated requests with the first response
+    idempotency_cfg = idempotency.IdempotencyConfiguration.from_environment()
+    idempotency_store = None
+    if idempotency_cfg.is_enabled():
+        idempotency_store = idempotency.IdempotencyStore(idempotency_cfg)
+
+    # Rate limit per client address and post
+    rate_limit_cfg = throttle.RateLimitConfiguration.from_environment()
+    rate_limiter = None
+    if rate_limit_cfg.is_enabled():
+        rate_limiter = throttle.RateLimiter(rate_limit_cfg)
+
+    # Local spam filter
+    spam_cfg = spam.SpamConfiguration.from_environment()
+    spam_filter = None
+    if spam_cfg.is_enabled():
+        spam_filter = spam.SpamFilter(spam_cfg)
+
+    # The handler gates the comments itself, so that the prefetch does not run ahead of the gate
+    app = make_app(cmt_cfg, comment_processor.comment_to_github_pr, challenge,
+                   job_queue.submit if job_queue else None, comment_processor.prefetch,
+                   duplicate_index.run if duplicate_index else None,
+                   idempotency_store.run if idempotency_store else None,
+                   rate_limiter, spam_filter, comment_gate)
     mgmt_ep.setup(app)
 
+    # Gauges read from the component statistics
+    metrics.REGISTRY.gauge("comment2gh_outbound_in_flight", "Number of outbound HTTP calls queued or in flight",
+                           callback=lambda: outbound_client.get_health()[0]["in-flight"])
+    metrics.REGISTRY.gauge("comment2gh_admission_in_flight", "Number of comments in process",
+                           callback=lambda: admission_gate.get_health()[0]["in-flight"])
+    metrics.REGISTRY.gauge("comment2gh_admission_queued", "Number of comments waiting for processing",
+                           callback=lambda: admission_gate.get_health()[0]["queued"])
+    if job_queue:
+        metrics.REGISTRY.gauge("comment2gh_jobs_queued", "Number of unfinished jobs in the job queue",
+                               callback=job_queue.depth)
+
     # Health Provider map uses weak references, so make sure to store this instance in a variable
     git_health_provider = service.GitHealthProvider()
     service.HealthHandler.add_health_provider('git-version', git_health_provider.get_health)
+    service.HealthHandler.add_health_provider('outbound', outbound_client.get_health)
+    github_health_provider = github.GithubHealthProvider()
+    service.HealthHandler.add_health_provider('github', github_health_provider.get_health)
+    service.HealthHandler.add_health_provider('pipeline', comment_processor.get_health)
+    service.HealthHandler.add_health_provider('admission', admission_gate.get_health)
+    if job_queue:
+        service.HealthHandler.add_health_provider('jobs', job_queue.get_health)
+    if duplicate_index:
+        service.HealthHandler.add_health_provider('duplicates', duplicate_index.get_health)
+    if idempotency_store:
+        service.HealthHandler.add_health_provider('idempotency', idempotency_store.get_health)
+    if rate_limiter:
+        service.HealthHandler.add_health_provider('rate-limit', rate_limiter.get_health)
+    if spam_filter:
+        service.HealthHandler.add_health_provider('spam', spam_filter.get_health)
+    if isinstance(challenge, captcha.ProofOfWork):
+        service.HealthHandler.add_health_provider('pow', challenge.get_health)
+    elif isinstance(challenge, captcha.Recaptcha):
+        service.HealthHandler.add_health_provider('recaptcha', challenge.get_health)
+
+    if lag_monitor:
+        service.HealthHandler.add_health_provider('event-loop', lag_monitor.get_health)
+    service.HealthHandler.add_health_provider('shutdown', guard.get_health)
+
+    # Graceful shutdown: once the server does not accept connections anymore, wait for the comments in process,
+    # the current jobs and the post-commit tasks (e.g. labels), in this order
+    guard.add_drain_handler(form.PENDING_REQUESTS.wait)
+    if job_queue:
+        guard.add_drain_handler(job_queue.drain)
+    guard.add_drain_handler(lambda remaining: comment_processor.post_commit.drain(
+        min(remaining, processor_cfg.post_commit_drain)))
 
     # Run
     LOGGER.info("Starting ioloop")
-    while not guard.is_terminated():
+    while not guard.is_drained():
         try:
             ioloop.start()
         except KeyboardInterrupt:
+            if guard.is_terminated():
+                LOGGER.warning("Keyboard interrupt while draining, exiting")
+                break
             LOGGER.info("Keyboard interrupt")
             guard.terminate()
 
-    # Restart ioloop for clean-up
-    ioloop.start()
-
     # Teardown
     LOGGER.info("Service terminated")
 
@@ -1,12 +1,30 @@
-""" Module for Google reCaptcha v2 processing """
+""" Module for the challenges a client has to pass before a comment is processed
 
+Two providers are available: Google reCaptcha v2 (verified by a call to Google)
+and a self-hosted proof-of-work (verified locally with one hash).
+"""
+
+from abc import ABC, abstractmethod
 from dataclasses import dataclass
+from typing import Optional
 
+import asyncio
+import hashlib
+import hmac
 import json
+import math
 import os
+import secrets
+import time
 
 from tornado.escape import url_escape
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import HTTPRequest
+
+import metrics
+import outbound
+from admission import Overloaded
+import timing
+from store import ExpiringStore
 
 import logging
 
@@ -20,19 +38,169 @@ def _assert_value(value, name):
 
 @dataclass(frozen=True)
 class RecaptchaConfiguration(object):
+    BREAKER_POLICIES = ["reject", "queue", "accept"]  # First value is used as default
+    DEFAULT_TIMEOUT = 3.0
+    DEFAULT_REPLAY_TTL = 300.0
+    DEFAULT_REPLAY_SIZE = 10000
+    DEFAULT_BREAKER_FAILURES = 5
+    DEFAULT_BREAKER_COOLDOWN = 30.0
+
     secret: str = None
+    timeout: float = DEFAULT_TIMEOUT
+    replay_ttl: float = DEFAULT_REPLAY_TTL
+    replay_size: int = DEFAULT_REPLAY_SIZE
+    breaker_failures: int = DEFAULT_BREAKER_FAILURES
+    breaker_cooldown: float = DEFAULT_BREAKER_COOLDOWN
+    breaker_policy: str = BREAKER_POLICIES[0]
 
     @staticmethod
     def from_environment():
         return RecaptchaConfiguration(
-            secret=os.getenv("RECAPTCHA_SECRET", None)
+            secret=os.getenv("RECAPTCHA_SECRET", None),
+            timeout=float(os.getenv("RECAPTCHA_TIMEOUT", RecaptchaConfiguration.DEFAULT_TIMEOUT)),
+            replay_ttl=float(os.getenv("RECAPTCHA_REPLAY_TTL", RecaptchaConfiguration.DEFAULT_REPLAY_TTL)),
+            replay_size=int(os.getenv("RECAPTCHA_REPLAY_SIZE", RecaptchaConfiguration.DEFAULT_REPLAY_SIZE)),
+            breaker_failures=int(os.getenv("RECAPTCHA_BREAKER_FAILURES",
+                                           RecaptchaConfiguration.DEFAULT_BREAKER_FAILURES)),
+            breaker_cooldown=float(os.getenv("RECAPTCHA_BREAKER_COOLDOWN",
+                                             RecaptchaConfiguration.DEFAULT_BREAKER_COOLDOWN)),
+            breaker_policy=os.getenv("RECAPTCHA_BREAKER_POLICY", RecaptchaConfiguration.BREAKER_POLICIES[0])
         )
 
+    def __post_init__(self):
+        if self.timeout <= 0:
+            raise ValueError("RECAPTCHA_TIMEOUT (timeout) must be positive!")
+
+        if self.replay_ttl < 0:
+            raise ValueError("RECAPTCHA_REPLAY_TTL (replay_ttl) must not be negative!")
+
+        if self.replay_size < 1:
+            raise ValueError("RECAPTCHA_REPLAY_SIZE (replay_size) must be at least 1!")
+
+        if self.breaker_failures < 0:
+            raise ValueError("RECAPTCHA_BREAKER_FAILURES (breaker_failures) must not be negative!")
+
+        if self.breaker_cooldown <= 0:
+            raise ValueError("RECAPTCHA_BREAKER_COOLDOWN (breaker_cooldown) must be positive!")
+
+        if self.breaker_policy not in RecaptchaConfiguration.BREAKER_POLICIES:
+            raise ValueError("RECAPTCHA_BREAKER_POLICY (breaker_policy) must be one of %s"
+                             % str(RecaptchaConfiguration.BREAKER_POLICIES))
+
     def is_enabled(self):
         return self.secret is not None
 
 
-class Recaptcha(object):
+class CircuitBreaker(object):
+    """Stop calling a failing service for a while
+
+    After `failures` consecutive failures the breaker opens for `cooldown` seconds. Then a single
+    probe call is let through (half-open): its success closes the breaker, its failure opens it again.
+    With `failures` set to 0 the breaker never opens.
+    """
+
+    def __init__(self, failures: int, cooldown: float):
+        self._failures = failures
+        self._cooldown = cooldown
+
+        self._count = 0
+        self._opened = None
+        self._probe = None
+        self._trips = 0
+
+    def state(self) -> str:
+        if self._opened is None:
+            return "closed"
+        if self._probe is not None or time.monotonic() >= self._opened + self._cooldown:
+            return "half-open"
+        return "open"
+
+    def retry_after(self) -> float:
+        """Seconds until the next probe call is let through"""
+        if self._opened is None:
+            return 0.0
+        return max(self._opened + self._cooldown - time.monotonic(), 0.0)
+
+    async def admit(self, wait: float = 0.0) -> bool:
+        """Return if a call may be made, waiting up to `wait` seconds for the breaker to let it through
+
+        An admitted call must be followed by `record`.
+        """
+        deadline = time.monotonic() + wait
+        while self._opened is not None:
+            now = time.monotonic()
+            if self._probe is None and now >= self._opened + self._cooldown:
+                self._probe = asyncio.get_running_loop().create_future()
+                return True
+
+            remaining = deadline - now
+            if remaining <= 0:
+                return False
+
+            if self._probe is not None:
+                # Wait for the result of the probe call
+                try:
+                    await asyncio.wait_for(asyncio.shield(self._probe), remaining)
+                except asyncio.TimeoutError:
+                    return False
+            else:
+                await asyncio.sleep(min(remaining, self._opened + self._cooldown - now))
+
+        return True
+
+    def record(self, success: Optional[bool]) -> None:
+        """Record the result of an admitted call, None if it has been cancelled"""
+        if success:
+            self._count = 0
+            self._opened = None
+        elif success is not None:
+            self._count += 1
+            if self._probe is not None or (self._failures and self._count >= self._failures):
+                if self._opened is None:
+                    LOGGER.warning("Circuit breaker opened after %i failures", self._count)
+                    self._trips += 1
+                self._opened = time.monotonic()
+
+        probe, self._probe = self._probe, None
+        if probe is not None:
+            probe.set_result(success)
+
+    def get_health(self) -> dict:
+        return {
+            "state": self.state(),
+            "failures": self._count,
+            "trips": self._trips
+        }
+
+
+VERIFY_SECONDS = metrics.REGISTRY.histogram("comment2gh_recaptcha_verify_seconds",
+                                            "Latency of reCAPTCHA verifications by result",
+                                            ("result",))
+
+
+class ChallengeProvider(ABC):
+    """Verifies the response of a client to a challenge, e.g. a captcha"""
+
+    NAME = "challenge"
+    """Name for logs and error messages"""
+
+    RESPONSE_KEY = None
+    """Form field with the response of the client"""
+
+    def issue(self) -> Optional[dict]:
+        """Create a new challenge for the client, if the provider issues them itself"""
+        return None
+
+    @abstractmethod
+    async def verify(self, response: str) -> bool:
+        pass
+
+    def get_health(self) -> tuple[dict, bool]:
+        return dict(), True
+
+
+class Recaptcha(ChallengeProvider):
+    NAME = "reCAPTCHA"
     RESPONSE_KEY = "g-recaptcha-response"
 
     def __init__(self, cfg: RecaptchaConfiguration):
@@ -40,12 +208,67 @@ class Recaptcha(object):
             raise ValueError("Recaptcha configuration must be provided!")
         self._cfg = cfg
 
+        # Tokens are single-use, recently verified ones are rejected without asking Google
+        self._seen = None
+        if cfg.replay_ttl:
+            self._seen = ExpiringStore("recaptcha", cfg.replay_size, cfg.replay_ttl)
+        self._breaker = CircuitBreaker(cfg.breaker_failures, cfg.breaker_cooldown)
+        self._results = {"success": 0, "failure": 0, "replayed": 0, "error": 0, "rejected": 0, "accepted": 0}
+
     async def verify(self, captcha_response: str) -> bool:
-        response = await AsyncHTTPClient().fetch(
-            self._create_request(captcha_response)
-        )
+        start = time.monotonic()
+        result = "error"
+        try:
+            with timing.stage("recaptcha"):
+                success, result = await self._verify(captcha_response)
+            if success is None:
+                success = self._unavailable()
+                result = "accepted"
+            return success
+        finally:
+            self._results[result] += 1
+            VERIFY_SECONDS.observe(time.monotonic() - start, result=result)
+
+    async def _verify(self, captcha_response: str) -> tuple[Optional[bool], str]:
+        """Ask Google unless the token is known or the breaker is open
+
+        :return: The verification result (None if Google is unavailable) and the result label
+        """
+        request = self._create_request(captcha_response)
+
+        token = hashlib.sha256(captcha_response.encode("utf-8")).hexdigest()
+        if self._seen is not None and self._seen.get(token) is not None:
+            LOGGER.warning("Replayed reCAPTCHA response")
+            return False, "replayed"
+
+        wait = self._cfg.timeout if self._cfg.breaker_policy == "queue" else 0.0
+        if not await self._breaker.admit(wait):
+            return None, "rejected"
+
+        success = None
+        try:
+            response = await asyncio.wait_for(outbound.fetch(request), self._cfg.timeout)
+            success = True
+        except Exception as e:
+            success = False
+            LOGGER.warning("reCAPTCHA verification failed: %s", str(e) or type(e).__name__)
+            return None, "error"
+        finally:
+            self._breaker.record(success)
 
-        return Recaptcha._process_result(response.body)
+        if self._seen is not None:
+            self._seen.put(token, True)
+
+        verified = Recaptcha._process_result(response.body)
+        return verified, "success" if verified else "failure"
+
+    def _unavailable(self) -> bool:
+        """Apply the breaker policy when Google cannot be asked"""
+        if self._cfg.breaker_policy == "accept":
+            LOGGER.warning("reCAPTCHA is unavailable, accepting the comment without verification")
+            return True
+
+        raise Overloaded("reCAPTCHA is unavailable", max(1, math.ceil(self._breaker.retry_after())))
 
     def _create_request(self, captcha_response: str):
         if not captcha_response:
@@ -74,3 +297,147 @@ class Recaptcha(object):
             LOGGER.warning("Failed captcha: %s" + str(response))
 
         return success
+
+    def get_health(self) -> tuple[dict, bool]:
+        """Return the verification results and the circuit breaker state; status is always healthy"""
+        return {
+            "results": dict(self._results),
+            "replay-cache": len(self._seen) if self._seen is not None else 0,
+            "breaker": self._breaker.get_health()
+        }, True
+
+
+@dataclass(frozen=True)
+class ProofOfWorkConfiguration(object):
+    """Configuration for the proof-of-work challenges"""
+    DEFAULT_DIFFICULTY = 16
+    DEFAULT_TTL = 600.0
+    DEFAULT_SIZE = 100000
+
+    secret: Optional[str] = None
+    difficulty: int = DEFAULT_DIFFICULTY
+    ttl: float = DEFAULT_TTL
+    size: int = DEFAULT_SIZE
+    path: Optional[str] = None
+
+    @staticmethod
+    def from_environment():
+        return ProofOfWorkConfiguration(
+            secret=os.getenv("POW_SECRET", None),
+            difficulty=int(os.getenv("POW_DIFFICULTY", ProofOfWorkConfiguration.DEFAULT_DIFFICULTY)),
+            ttl=float(os.getenv("POW_TTL", ProofOfWorkConfiguration.DEFAULT_TTL)),
+            size=int(os.getenv("POW_SIZE", ProofOfWorkConfiguration.DEFAULT_SIZE)),
+            path=os.getenv("POW_PATH", None)
+        )
+
+    def __post_init__(self):
+        if not 0 < self.difficulty <= ProofOfWork.MAX_DIFFICULTY:
+            raise ValueError("POW_DIFFICULTY (difficulty) must be between 1 and %i!" % ProofOfWork.MAX_DIFFICULTY)
+
+        if self.ttl <= 0:
+            raise ValueError("POW_TTL (ttl) must be positive!")
+
+        if self.size < 1:
+            raise ValueError("POW_SIZE (size) must be at least 1!")
+
+    def is_enabled(self) -> bool:
+        return bool(self.secret)
+
+
+POW_VERIFICATIONS = metrics.REGISTRY.counter("comment2gh_pow_verifications_total",
+                                              "Proof-of-work verifications by result (valid, invalid, expired, replayed)",
+                                              ("result",))
+
+
+class ProofOfWork(ChallengeProvider):
+    """Self-hosted proof-of-work challenges
+
+    A challenge `<expires>.<difficulty>.<nonce>.<signature>` is signed with the secret (HMAC-SHA256),
+    so the service does not need to remember the issued challenges.
+    The client solves it by finding a `solution` for which the SHA-256 hash of `<challenge>:<solution>`
+    starts with `difficulty` zero bits, and sends `<challenge>:<solution>`.
+    Each challenge can only be used once: used challenges are remembered until they expire.
+    """
+
+    NAME = "proof-of-work"
+    RESPONSE_KEY = "pow-response"
+    MAX_DIFFICULTY = 32
+
+    def __init__(self, cfg: ProofOfWorkConfiguration):
+        if cfg is None or not cfg.is_enabled():
+            raise ValueError("Enabled proof-of-work configuration must be provided!")
+
+        self._cfg = cfg
+        self._key = cfg.secret.encode("utf-8")
+        self._used = ExpiringStore("pow", cfg.size, cfg.ttl, cfg.path)
+
+        self._issued = 0
+        self._results = {"valid": 0, "invalid": 0, "expired": 0, "replayed": 0}
+
+    def _sign(self, payload: str) -> str:
+        return hmac.new(self._key, payload.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def issue(self) -> dict:
+        expires = int(time.time() + self._cfg.ttl)
+        payload = "%i.%i.%s" % (expires, self._cfg.difficulty, secrets.token_hex(8))
+        self._issued += 1
+        return {
+            "challenge": payload + "." + self._sign(payload),
+            "difficulty": self._cfg.difficulty,
+            "expires": expires
+        }
+
+    @staticmethod
+    def solved(challenge: str, solution: str, difficulty: int) -> bool:
+        digest = hashlib.sha256(("%s:%s" % (challenge, solution)).encode("utf-8")).digest()
+        return int.from_bytes(digest[:4], "big") >> (32 - difficulty) == 0
+
+    @staticmethod
+    def solve(challenge: str, difficulty: int) -> str:
+        """Find a solution, as the client does"""
+        solution = 0
+        while not ProofOfWork.solved(challenge, str(solution), difficulty):
+            solution += 1
+        return str(solution)
+
+    async def verify(self, response: str) -> bool:
+        with timing.stage("pow"):
+            result = self._check(response)
+
+        self._results[result] += 1
+        POW_VERIFICATIONS.inc(result=result)
+        if result != "valid":
+            LOGGER.warning("Failed proof-of-work: %s", result)
+        return result == "valid"
+
+    def _check(self, response: str) -> str:
+        if not response:
+            raise ValueError("Proof-of-work response must be provided!")
+
+        challenge, _, solution = response.rpartition(":")
+        try:
+            payload, signature = challenge.rsplit(".", 1)
+            expires, difficulty, _ = payload.split(".", 2)
+            expires, difficulty = int(expires), int(difficulty)
+        except ValueError:
+            return "invalid"
+
+        if not hmac.compare_digest(signature, self._sign(payload)) or \
+                not 0 < difficulty <= ProofOfWork.MAX_DIFFICULTY:
+            return "invalid"
+        if expires < time.time():
+            return "expired"
+        if not ProofOfWork.solved(challenge, solution, difficulty):
+            return "invalid"
+
+        if self._used.get(challenge) is not None:
+            return "replayed"
+        self._used.put(challenge, expires)
+        return "valid"
+
+    def close(self) -> None:
+        self._used.close()
+
+    def get_health(self) -> tuple[dict, bool]:
+        """Return the number of issued and verified challenges; status is always healthy"""
+        return dict(issued=self._issued, used=len(self._used), **self._results), True
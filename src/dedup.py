@@ -0,0 +1,85 @@
+""" Module for the detection of duplicate comments
+
+Double clicks and repeated requests send the same comment again. The comments are identified
+by a fingerprint of their content, and a duplicate is answered with the response of the original comment.
+"""
+
+from dataclasses import dataclass
+from typing import Callable, Awaitable, Optional
+
+import hashlib
+import os
+
+import form
+from store import ExpiringStore, ResponseStore
+
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class DuplicateConfiguration(object):
+    """Configuration for the duplicate detection"""
+    DEFAULT_TTL = 600.0
+    DEFAULT_SIZE = 10000
+
+    ttl: float = DEFAULT_TTL
+    size: int = DEFAULT_SIZE
+    path: Optional[str] = None
+
+    @staticmethod
+    def from_environment():
+        return DuplicateConfiguration(
+            ttl=float(os.getenv("DUPLICATE_TTL", DuplicateConfiguration.DEFAULT_TTL)),
+            size=int(os.getenv("DUPLICATE_SIZE", DuplicateConfiguration.DEFAULT_SIZE)),
+            path=os.getenv("DUPLICATE_PATH", None)
+        )
+
+    def __post_init__(self):
+        if self.ttl < 0:
+            raise ValueError("DUPLICATE_TTL (ttl) must not be negative!")
+
+        if self.size < 1:
+            raise ValueError("DUPLICATE_SIZE (size) must be at least 1!")
+
+    def is_enabled(self) -> bool:
+        return self.ttl > 0
+
+
+class DuplicateIndex(object):
+    """Responses by comment fingerprint, see store.ResponseStore"""
+
+    def __init__(self, cfg: DuplicateConfiguration):
+        if cfg is None or not cfg.is_enabled():
+            raise ValueError("Enabled duplicate configuration must be provided!")
+
+        self._store = ExpiringStore("duplicates", cfg.size, cfg.ttl, cfg.path)
+        self._responses = ResponseStore(self._store, "duplicates")
+
+    @staticmethod
+    def fingerprint(cmt: form.Comment) -> str:
+        """Hash of the comment content; case and whitespace of the message do not matter"""
+        content = "\n".join([
+            cmt.slug,
+            cmt.name,
+            (cmt.email or "").strip().casefold(),
+            " ".join(cmt.message.split()).casefold()
+        ])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    async def run(self, cmt: form.Comment, process: Callable[[], Awaitable[dict]]) -> tuple[dict, bool]:
+        """Process the comment unless it is a duplicate
+
+        :return: The response of the comment or of its original, and if it is a duplicate
+        """
+        response, duplicate = await self._responses.run(DuplicateIndex.fingerprint(cmt), process)
+        if duplicate:
+            LOGGER.info("Comment %i is a duplicate", cmt.cid)
+        return response, duplicate
+
+    def close(self) -> None:
+        self._store.close()
+
+    def get_health(self) -> tuple[dict, bool]:
+        return self._responses.get_health()
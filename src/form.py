@@ -3,13 +3,23 @@
 from abc import ABCMeta
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Callable, Optional, Awaitable
+from typing import Callable, Optional, Awaitable, Any
 
+import tornado.process
 import tornado.web
 
+import asyncio
+import contextlib
 import os
+import time
 
-from captcha import Recaptcha
+import metrics
+import timing
+from admission import AdmissionGate, Overloaded
+from captcha import ChallengeProvider
+from service import InFlight
+from spam import SpamFilter
+from throttle import RateLimiter
 
 import logging
 
@@ -33,6 +43,7 @@ class FormConfiguration(object):
     DEFAULT_MESSAGE_FIELD = "cmt_message"
 
     MAIL_OPTIONS = ["optional", "none", "required"]  # First value is used as default
+    TIMING_OPTIONS = ["header", "body", "none"]  # First value is used as default
 
     origin: str = DEFAULT_CORS_ORIGIN
     form_slug: str = DEFAULT_SLUG_FIELD
@@ -41,6 +52,7 @@ class FormConfiguration(object):
     form_url: str = DEFAULT_URL_FIELD
     form_message: str = DEFAULT_MESSAGE_FIELD
     mail_option: str = MAIL_OPTIONS[0]
+    timing_option: str = TIMING_OPTIONS[0]
 
     @staticmethod
     def from_environment():
@@ -51,7 +63,8 @@ class FormConfiguration(object):
             form_email=os.getenv('FORM_EMAIL', FormConfiguration.DEFAULT_EMAIL_FIELD),
             form_url=os.getenv("FORM_URL", FormConfiguration.DEFAULT_URL_FIELD),
             form_message=os.getenv('FORM_MESSAGE', FormConfiguration.DEFAULT_MESSAGE_FIELD),
-            mail_option=os.getenv('FORM_EMAIL_CHECK', FormConfiguration.MAIL_OPTIONS[0])
+            mail_option=os.getenv('FORM_EMAIL_CHECK', FormConfiguration.MAIL_OPTIONS[0]),
+            timing_option=os.getenv('FORM_TIMING', FormConfiguration.TIMING_OPTIONS[0])
         )
 
     def __post_init__(self):
@@ -64,6 +77,9 @@ class FormConfiguration(object):
         if self.mail_option not in FormConfiguration.MAIL_OPTIONS:
             raise ValueError("FORM_EMAIL_CHECK (mail_option) must be one of %s", str(FormConfiguration.MAIL_OPTIONS))
 
+        if self.timing_option not in FormConfiguration.TIMING_OPTIONS:
+            raise ValueError("FORM_TIMING (timing_option) must be one of %s" % str(FormConfiguration.TIMING_OPTIONS))
+
     def _assert_field_values(self):
         req = [
             'form_slug',
@@ -71,7 +87,8 @@ class FormConfiguration(object):
             'form_email',
             'form_url',
             'form_message',
-            'mail_option'
+            'mail_option',
+            'timing_option'
         ]
         for attr in req:
             _assert_value(self.__getattribute__(attr), attr)
@@ -89,43 +106,210 @@ class FormConfiguration(object):
                 raise ValueError("Field %s must not have newlines!")
 
 
+class CommentIdGenerator(object):
+    """Generate unique, time-ordered comment IDs
+
+    Like a Snowflake ID, but with 53 bits so that it is safe as a JavaScript number:
+    40 bits milliseconds since 2022-01-01 (enough until 2056), 6 bits node and 7 bits sequence.
+    The node separates processes that generate IDs at the same time, e.g. forked workers or replicas.
+    If more than 128 IDs are needed within one millisecond or the clock goes back,
+    the following milliseconds are used, so that the IDs keep increasing.
+    """
+
+    EPOCH_MS = 1640995200000  # 2022-01-01T00:00:00Z
+    NODE_BITS = 6
+    SEQUENCE_BITS = 7
+    MAX_NODE = (1 << NODE_BITS) - 1
+    MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+    def __init__(self, node: Optional[int] = None):
+        """
+
+        :param node: (Optional) Node number from 0 to 63, default is COMMENT_NODE_ID
+                     plus the task ID of a forked worker, determined on first use
+        """
+        if node is not None:
+            CommentIdGenerator._assert_node(node)
+        self._node = node
+        self._last_ms = -1
+        self._sequence = 0
+
+    @staticmethod
+    def _assert_node(node: int) -> None:
+        if not 0 <= node <= CommentIdGenerator.MAX_NODE:
+            raise ValueError("COMMENT_NODE_ID (node) must be between 0 and %i!" % CommentIdGenerator.MAX_NODE)
+
+    @staticmethod
+    def assert_workers(workers: int) -> None:
+        """Check that all forked workers get a valid node, must be called before they are forked"""
+        node = int(os.getenv("COMMENT_NODE_ID", None) or 0)
+        CommentIdGenerator._assert_node(node)
+        if node + workers - 1 > CommentIdGenerator.MAX_NODE:
+            raise ValueError("COMMENT_NODE_ID (%i) plus the number of workers (%i) must not exceed %i nodes!"
+                             % (node, workers, CommentIdGenerator.MAX_NODE + 1))
+
+    @staticmethod
+    def default_node() -> int:
+        node = int(os.getenv("COMMENT_NODE_ID", None) or 0)
+        # Forked workers are numbered from 0, unforked processes have no task ID
+        node += tornado.process.task_id() or 0
+        CommentIdGenerator._assert_node(node)
+        return node
+
+    @staticmethod
+    def _now_ms() -> int:
+        return time.time_ns() // 1000000 - CommentIdGenerator.EPOCH_MS
+
+    def next_id(self) -> int:
+        if self._node is None:
+            self._node = CommentIdGenerator.default_node()
+
+        now = CommentIdGenerator._now_ms()
+        if now > self._last_ms:
+            self._last_ms = now
+            self._sequence = 0
+        elif self._sequence < CommentIdGenerator.MAX_SEQUENCE:
+            self._sequence += 1
+        else:
+            self._last_ms += 1
+            self._sequence = 0
+
+        return (self._last_ms << (CommentIdGenerator.NODE_BITS + CommentIdGenerator.SEQUENCE_BITS)) | \
+            (self._node << CommentIdGenerator.SEQUENCE_BITS) | self._sequence
+
+
+CID_GENERATOR = CommentIdGenerator()
+"""Process-wide comment ID generator"""
+
+
 @dataclass(frozen=True)
 class Comment:
-    cid: int = field(init=False, default=0)
-    date: str = field(init=False, default="")
+    # Generated unless given, e.g. when a stored comment is restored
+    cid: Optional[int] = field(kw_only=True, default=None)
+    date: Optional[str] = field(kw_only=True, default=None)
     slug: str
     name: str
     message: str
     email: str = field(repr=False, default=None)
     url: Optional[str] = None
+    spam: Optional[str] = field(init=False, default=None)
 
     def __post_init__(self):
         _assert_value(self.slug, "Post ID")
         _assert_value(self.name, "name")
         _assert_value(self.message, "message")
 
-        super().__setattr__('date', str(datetime.now().isoformat()))
-        super().__setattr__('cid', self.__hash__() % 1000000000)
+        if self.date is None:
+            super().__setattr__('date', str(datetime.now().isoformat()))
+        if self.cid is None:
+            super().__setattr__('cid', CID_GENERATOR.next_id())
 
     def delete_email(self):
         super().__setattr__('email', None)
 
+    def flag_spam(self, reason: str):
+        """Mark the comment as possible spam for the reviewer"""
+        super().__setattr__('spam', reason)
+
+    def to_dict(self) -> dict:
+        """Return all fields, including the generated ones, e.g. for persisting the comment"""
+        return {
+            "cid": self.cid,
+            "date": self.date,
+            "slug": self.slug,
+            "name": self.name,
+            "message": self.message,
+            "email": self.email,
+            "url": self.url,
+            "spam": self.spam
+        }
+
+    @staticmethod
+    def from_dict(values: dict):
+        """Restore a comment from to_dict() with its original ID and date"""
+        cmt = Comment(cid=values["cid"],
+                      date=values["date"],
+                      slug=values["slug"],
+                      name=values["name"],
+                      message=values["message"],
+                      email=values.get("email", None),
+                      url=values.get("url", None))
+        super(Comment, cmt).__setattr__('spam', values.get("spam", None))
+        return cmt
+
+
+REQUEST_SECONDS = metrics.REGISTRY.histogram("comment2gh_comment_request_seconds",
+                                             "Latency of comment requests by method and status code",
+                                             ("method", "code"))
+REQUESTS_IN_FLIGHT = metrics.REGISTRY.gauge("comment2gh_comment_requests_in_flight",
+                                            "Number of comment requests in process")
+
+PENDING_REQUESTS = InFlight()
+"""Comment requests in process, awaited on shutdown"""
+
 
 class CommentHandler(tornado.web.RequestHandler, metaclass=ABCMeta):
+    IDEMPOTENCY_HEADER = "Idempotency-Key"
+    IDEMPOTENCY_FIELD = "idempotency_key"
+
     # noinspection PyAttributeOutsideInit,PyMethodOverriding
     def initialize(self,
                    cfg: FormConfiguration,
                    comment_cb: Callable[[Comment], Awaitable[int]],
-                   recaptcha: Optional[Recaptcha] = None) -> None:
+                   challenge: Optional[ChallengeProvider] = None,
+                   enqueue_cb: Optional[Callable[[Comment], Optional[int]]] = None,
+                   prefetch_cb: Optional[Callable[[], Awaitable[Any]]] = None,
+                   duplicate_cb: Optional[Callable[[Comment, Callable[[], Awaitable[dict]]],
+                                                   Awaitable[tuple[dict, bool]]]] = None,
+                   idempotency_cb: Optional[Callable[[str, Comment, Callable[[], Awaitable[dict]]],
+                                                     Awaitable[tuple[dict, bool]]]] = None,
+                   rate_limiter: Optional[RateLimiter] = None,
+                   spam_filter: Optional[SpamFilter] = None,
+                   admission_gate: Optional[AdmissionGate] = None) -> None:
         """
 
         :param cfg: Handler configuration
         :param comment_cb: Callback to handle comments
-        :param recaptcha: (Optional) Recaptcha verification handler
+        :param challenge: (Optional) Verification of the challenge response, e.g. reCAPTCHA
+        :param enqueue_cb: (Optional) Callback to queue comments for later processing instead,
+                           returns the job ID or None if the queue is full
+        :param prefetch_cb: (Optional) Side-effect-free preparation of the comment processing,
+                            runs during the challenge verification, the result is passed to the
+                            comment callback as `prefetched`
+        :param duplicate_cb: (Optional) Run the processing of a comment unless it is a duplicate,
+                             returns the response and if it is a duplicate, see dedup.DuplicateIndex
+        :param idempotency_cb: (Optional) Run the processing of a comment with an idempotency key unless the key
+                               has been used, returns the response and if it is a repeated request,
+                               see idempotency.IdempotencyStore
+        :param rate_limiter: (Optional) Limit the comments per client address and post
+        :param spam_filter: (Optional) Reject or flag comments that look like spam
+        :param admission_gate: (Optional) Gate the comment callback, the prefetch is only started
+                               if the gate would admit the comment and is awaited once it has been admitted
         """
         self._cfg = cfg
         self._cb = comment_cb
-        self._recaptcha = recaptcha
+        self._challenge = challenge
+        self._enqueue = enqueue_cb
+        self._prefetch = prefetch_cb
+        self._duplicate = duplicate_cb
+        self._idempotency = idempotency_cb
+        self._rate_limiter = rate_limiter
+        self._spam_filter = spam_filter
+        self._admission = admission_gate
+        # Errors before prepare(), e.g. 405 for unsupported methods, still end in on_finish()
+        self._prepared = False
+
+    def prepare(self) -> None:
+        REQUESTS_IN_FLIGHT.inc()
+        PENDING_REQUESTS.enter()
+        self._prepared = True
+        self._timings = timing.start()
+
+    def on_finish(self) -> None:
+        if self._prepared:
+            REQUESTS_IN_FLIGHT.dec()
+            PENDING_REQUESTS.exit()
+        REQUEST_SECONDS.observe(self.request.request_time(), method=self.request.method, code=self.get_status())
 
     def set_default_headers(self) -> None:
         # CORS headers have to be set here so that they are also available for error responses.
@@ -137,6 +321,8 @@ class CommentHandler(tornado.web.RequestHandler, metaclass=ABCMeta):
             if self._cfg.origin:
                 self.set_header("Access-Control-Allow-Origin", self._cfg.origin)
                 self.set_header("Access-Control-Allow-Methods", "POST, OPTIONS")
+                if self._idempotency:
+                    self.set_header("Access-Control-Allow-Headers", CommentHandler.IDEMPOTENCY_HEADER)
 
     def options(self):
         self.set_default_headers()  # Because it's not always happening
@@ -150,30 +336,134 @@ class CommentHandler(tornado.web.RequestHandler, metaclass=ABCMeta):
 
         try:
             comment = self._cmt_from_body()
+
+            retry_after = self._check_rate_limit(comment)
+            if retry_after:
+                self.send_error(429, reason="Too many comments", retry_after=retry_after)
+                return
+
             LOGGER.info("Processing comment %s", comment)
 
+            self._check_spam(comment)
             self._handle_comment_mail(comment)
 
-            if self._recaptcha:
-                if not await self._validate_recaptcha():
-                    LOGGER.warning("Could not validate reCAPTCHA response!")
-                    raise tornado.web.HTTPError(status_code=400,
-                                                reason="Invalid reCAPTCHA response!")
-                else:
-                    LOGGER.info("reCAPTCHA validation successful")
+            key = self._idempotency_key()
+            if key is not None:
+                response, repeated = await self._idempotency(key, comment, lambda: self._deduplicate(comment))
+                if repeated:
+                    self.set_header("Idempotent-Replayed", "true")
+            else:
+                response = await self._deduplicate(comment)
 
-            pr = await self._call_cb(comment)
-
-            self.set_status(201)
-            await self.finish({
-                "cid": comment.cid,
-                "date": comment.date,
-                "pr": pr
-            })
+            self.set_status(response["status"])
+            await self.finish(self._with_timing(dict(response["body"])))
         except ValueError as e:
             LOGGER.error("Invalid input from client: %s", str(e))
             raise tornado.web.HTTPError(status_code=400,
                                         reason=str(e))
+        except Overloaded as e:
+            self.send_error(503, reason=e.reason, retry_after=e.retry_after)
+
+    def _check_rate_limit(self, comment: Comment) -> int:
+        """Check the rate limit before anything else is done, return the seconds to wait if exceeded"""
+        if not self._rate_limiter:
+            return 0
+
+        ip = self._rate_limiter.client_ip(self.request.remote_ip, self.request.headers.get("X-Forwarded-For", None))
+        return self._rate_limiter.check(ip, comment.slug)
+
+    def _check_spam(self, comment: Comment) -> None:
+        if not self._spam_filter:
+            return
+
+        with timing.stage("spam"):
+            verdict = self._spam_filter.classify(comment.message, comment.url)
+        if verdict.reject:
+            LOGGER.warning("Comment %i rejected as spam: %s", comment.cid, verdict.reason())
+            raise ValueError("Comment has been rejected as spam!")
+        if verdict.flag:
+            LOGGER.info("Comment %i flagged as possible spam: %s", comment.cid, verdict.reason())
+            comment.flag_spam(verdict.reason())
+
+    def _idempotency_key(self) -> Optional[str]:
+        if not self._idempotency:
+            return None
+        return self.request.headers.get(CommentHandler.IDEMPOTENCY_HEADER, None) or \
+            self._arg_or_default(CommentHandler.IDEMPOTENCY_FIELD) or None
+
+    async def _deduplicate(self, comment: Comment) -> dict:
+        if self._duplicate:
+            response, _ = await self._duplicate(comment, lambda: self._process(comment))
+            return response
+        return await self._process(comment)
+
+    async def _process(self, comment: Comment) -> dict:
+        """Verify and process the comment
+
+        :return: Status code and body of the response
+        """
+        prefetch = None
+        if self._challenge:
+            # Queued comments are processed later, there is nothing to prepare
+            if self._prefetch and not self._enqueue:
+                prefetch = self._start_prefetch()
+
+            try:
+                valid = await self._validate_challenge()
+            except BaseException:
+                await self._cancel_prefetch(prefetch)
+                raise
+
+            if not valid:
+                await self._cancel_prefetch(prefetch)
+                LOGGER.warning("Could not validate %s response!", self._challenge.NAME)
+                raise tornado.web.HTTPError(status_code=400,
+                                            reason="Invalid %s response!" % self._challenge.NAME)
+            else:
+                LOGGER.info("%s validation successful", self._challenge.NAME)
+
+        if self._enqueue:
+            job = self._call_enqueue(comment)
+            return {
+                "status": 202,
+                "body": {
+                    "cid": comment.cid,
+                    "date": comment.date,
+                    "job": job
+                }
+            }
+
+        pr = await self._call_cb(comment, prefetch)
+        return {
+            "status": 201,
+            "body": {
+                "cid": comment.cid,
+                "date": comment.date,
+                "pr": pr
+            }
+        }
+
+    def _with_timing(self, response: dict) -> dict:
+        """Add the stage timings to the response header and (if configured) body"""
+        if self._cfg.timing_option == "none":
+            return response
+
+        self._timings["total"] = self.request.request_time()
+        self.set_header("Server-Timing", timing.header(self._timings))
+        if self._cfg.origin:
+            # Make the timings available to the form script on the (other) origin
+            self.set_header("Timing-Allow-Origin", self._cfg.origin)
+
+        if self._cfg.timing_option == "body":
+            response["timing"] = timing.milliseconds(self._timings)
+
+        return response
+
+    def write_error(self, status_code: int, **kwargs) -> None:
+        # Headers set before the error are cleared, so Retry-After has to be passed along
+        if "retry_after" in kwargs:
+            self.set_header("Retry-After", str(kwargs["retry_after"]))
+        super().write_error(status_code, **kwargs)
 
     def _validate_origin(self):
         if self._cfg.origin == "*":
@@ -186,24 +476,66 @@ class CommentHandler(tornado.web.RequestHandler, metaclass=ABCMeta):
         raise tornado.web.HTTPError(status_code=400,
                                     reason="Invalid origin!")
 
-    async def _call_cb(self, comment):
+    def _start_prefetch(self) -> Optional[asyncio.Future]:
+        if self._admission:
+            return self._admission.prefetch(self._prefetch)
+        return asyncio.ensure_future(self._prefetch())
+
+    @staticmethod
+    async def _cancel_prefetch(prefetch: Optional[asyncio.Future]) -> None:
+        if prefetch is not None:
+            prefetch.cancel()
+            # Wait for the cancellation to finish, the result is not needed
+            await asyncio.gather(prefetch, return_exceptions=True)
+
+    @staticmethod
+    async def _prefetched(prefetch: Optional[asyncio.Future]) -> Any:
+        if prefetch is None:
+            return None
+
+        result = (await asyncio.gather(prefetch, return_exceptions=True))[0]
+        if isinstance(result, BaseException):
+            LOGGER.warning("Prefetch failed: %s", str(result))
+            return None
+        return result
+
+    async def _call_cb(self, comment, prefetch: Optional[asyncio.Future] = None):
         if not self._cb:
+            await self._cancel_prefetch(prefetch)
             raise tornado.web.HTTPError(status_code=500,
                                         reason="Comment processing not set up")
 
-        pr = await self._cb(comment)
+        try:
+            # A shed comment does not wait for its prefetch
+            async with self._admission.admit() if self._admission else contextlib.nullcontext():
+                prefetched = await self._prefetched(prefetch)
+                if prefetched is not None:
+                    pr = await self._cb(comment, prefetched=prefetched)
+                else:
+                    pr = await self._cb(comment)
+        except BaseException:
+            await self._cancel_prefetch(prefetch)
+            raise
+
         if pr is None:
             raise tornado.web.HTTPError(status_code=500,
                                         reason="Comment processing failed")
         return pr
 
-    async def _validate_recaptcha(self) -> bool:
-        if not self._recaptcha:
-            LOGGER.warning("reCAPTCHA check is not configured")
+    def _call_enqueue(self, comment):
+        job = self._enqueue(comment)
+        if job is None:
+            raise tornado.web.HTTPError(status_code=503,
+                                        reason="Comment queue is full")
+        return job
+
+    async def _validate_challenge(self) -> bool:
+        if not self._challenge:
+            LOGGER.warning("Challenge check is not configured")
             return False
 
-        response = self.get_body_argument(Recaptcha.RESPONSE_KEY, None)
-        return await self._recaptcha.verify(response)
+        response = self.get_body_argument(self._challenge.RESPONSE_KEY, None)
+        return await self._challenge.verify(response)
 
     def _cmt_from_body(self) -> Comment:
         return Comment(
@@ -226,3 +558,34 @@ class CommentHandler(tornado.web.RequestHandler, metaclass=ABCMeta):
         return default \
             if key not in self.request.body_arguments.keys() \
             else self.get_body_argument(key)
+
+
+class ChallengeHandler(tornado.web.RequestHandler, metaclass=ABCMeta):
+    """Issue challenges for the comment form, if the challenge provider creates them itself"""
+
+    # noinspection PyAttributeOutsideInit,PyMethodOverriding
+    def initialize(self, cfg: FormConfiguration, challenge: Optional[ChallengeProvider] = None) -> None:
+        """
+
+        :param cfg: Handler configuration, only the origin is used
+        :param challenge: (Optional) Challenge provider
+        """
+        self._cfg = cfg
+        self._challenge = challenge
+
+    def set_default_headers(self) -> None:
+        # See CommentHandler.set_default_headers
+        if hasattr(self, "_cfg"):
+            if self._cfg.origin:
+                self.set_header("Access-Control-Allow-Origin", self._cfg.origin)
+                self.set_header("Access-Control-Allow-Methods", "GET")
+        # Each challenge can only be used once
+        self.set_header("Cache-Control", "no-store")
+
+    def get(self):
+        self.set_default_headers()  # Because it's not always happening
+        issued = self._challenge.issue() if self._challenge else None
+        if issued is None:
+            raise tornado.web.HTTPError(status_code=404,
+                                        reason="No challenges are issued")
+        self.finish(issued)
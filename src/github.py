@@ -4,16 +4,29 @@ There are available libraries for accessing the GitHub API.
 However, there is not a lot of documentation. It turned out to be easier to call the API directly.
 """
 
+from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Optional
+from functools import cached_property
+from typing import Optional, Callable, Awaitable, Any
 
+import asyncio
 import base64
+import contextvars
+import itertools
 import json
 import os
+import time
+
+import isodate
 
 import logging
 
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import HTTPRequest
+from tornado.httputil import url_concat
+
+import metrics
+import outbound
+from throttle import TokenBucket
 
 LOGGER = logging.getLogger(__name__)
 
@@ -23,10 +36,140 @@ def _assert_value(value, name):
         raise ValueError(f"Attribute %s is required, but was None!" % name)
 
 
+class GithubAuthenticationError(Exception):
+    """No valid authentication is available for a GitHub call"""
+    pass
+
+
+class GithubCredentials(ABC):
+    """Authentication for GitHub calls
+
+    The authentication header is built once and reused for every call.
+    Each credential has its own rate limit budget, identified by the name.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    async def prepare(self) -> None:
+        """Make sure that the header is valid before a call
+
+        :raises GithubAuthenticationError: if no valid header is available
+        """
+        pass
+
+    @abstractmethod
+    def header(self) -> dict:
+        pass
+
+
+class GithubTokenCredentials(GithubCredentials):
+    """Basic authentication with a personal access token"""
+
+    def __init__(self, user: str, token: str, name: str = "token"):
+        super().__init__(name)
+        auth = f"%s:%s" % (user, token)
+        b64 = base64.b64encode(auth.encode("utf-8"))
+        self._header = {
+            "Authorization": f"Basic %s" % b64.decode("utf-8")
+        }
+
+    def header(self) -> dict:
+        return self._header
+
+
+class GithubAppCredentials(GithubCredentials):
+    """Authentication as GitHub App installation
+
+    The installation access token is requested with a locally signed JWT
+    and refreshed ahead of its expiry. Concurrent refreshes share one request.
+    """
+
+    REFRESH_AHEAD = 300
+    """Refresh the token this many seconds before it expires"""
+
+    JWT_LIFETIME = 540
+    """Lifetime of the app JWT in seconds (GitHub allows 10 minutes at most)"""
+
+    def __init__(self, app_id: str, installation_id: str, private_key: str):
+        super().__init__(f"app-%s" % app_id)
+        try:
+            import jwt
+        except ImportError:
+            raise ValueError("GitHub App authentication requires the PyJWT package!")
+        self._jwt = jwt
+
+        self._app_id = app_id
+        self._installation_id = installation_id
+        self._private_key = private_key
+
+        self._header = dict()
+        self._expires = 0.0
+
+    def header(self) -> dict:
+        return self._header
+
+    def app_token(self) -> str:
+        now = int(time.time())
+        return self._jwt.encode({
+            "iat": now - 60,  # allow for clock drift
+            "exp": now + GithubAppCredentials.JWT_LIFETIME,
+            "iss": str(self._app_id)
+        }, self._private_key, algorithm="RS256")
+
+    async def prepare(self) -> None:
+        if time.time() < self._expires - GithubAppCredentials.REFRESH_AHEAD:
+            return
+
+        await SINGLE_FLIGHT.do(("app-token", self._app_id, self._installation_id), self._refresh)
+
+        # A token that could not be refreshed may still be valid for a while
+        if time.time() >= self._expires:
+            raise GithubAuthenticationError("No valid installation token for GitHub App %s" % self._app_id)
+
+    async def _refresh(self) -> None:
+        result = await outbound.fetch(
+            HTTPRequest(
+                method="POST",
+                url=f"https://api.github.com/app/installations/%s/access_tokens" % self._installation_id,
+                headers={
+                    "Authorization": f"Bearer %s" % self.app_token(),
+                    "Accept": "application/vnd.github.v3+json"
+                },
+                body=""
+            ),
+            raise_error=False
+        )
+
+        body = json.loads(result.body.decode("utf-8")) if result.body else None
+        if result.code != 201:
+            LOGGER.error("Error %i when requesting installation token: %s", result.code, str(body))
+            return
+
+        try:
+            token = body["token"]
+            expires = isodate.parse_datetime(body["expires_at"]).timestamp()
+        except (KeyError, TypeError, ValueError, isodate.ISO8601Error) as e:
+            LOGGER.warning("Got weird result from GitHub, error: %s", e)
+            return
+
+        self._header = {
+            "Authorization": f"Bearer %s" % token
+        }
+        self._expires = expires
+        LOGGER.info("Installation token refreshed, valid until %s", body["expires_at"])
+
+
 @dataclass(frozen=True)
 class GithubConfiguration(object):
     DEFAULT_BRANCH = "main"
     DEFAULT_AUTHOR = "comment2gh Bot"
+    DEFAULT_HEAD_TTL = 0.0
+    DEFAULT_RATE = 0.0
+    DEFAULT_BURST = 10
+    DEFAULT_RATE_RETRIES = 3
+
+    ENGINES = ["contents", "gitdata", "graphql"]  # First value is used as default
 
     user: str
     token: str
@@ -35,6 +178,14 @@ class GithubConfiguration(object):
     author: str = DEFAULT_AUTHOR
     branch: str = DEFAULT_BRANCH
     label: str = None
+    engine: str = ENGINES[0]
+    head_ttl: float = DEFAULT_HEAD_TTL
+    rate: float = DEFAULT_RATE
+    burst: int = DEFAULT_BURST
+    rate_retries: int = DEFAULT_RATE_RETRIES
+    app_id: str = None
+    app_installation: str = None
+    app_key_file: str = None
 
     @staticmethod
     def from_environment():
@@ -45,29 +196,355 @@ class GithubConfiguration(object):
             email=os.getenv("GITHUB_EMAIL", None),
             author=os.getenv("GITHUB_AUTHOR", GithubConfiguration.DEFAULT_AUTHOR),
             branch=os.getenv("GITHUB_DEFAULT_BRANCH", GithubConfiguration.DEFAULT_BRANCH),
-            label=os.getenv("GITHUB_LABEL", None)
+            label=os.getenv("GITHUB_LABEL", None),
+            engine=os.getenv("GITHUB_COMMIT_ENGINE", GithubConfiguration.ENGINES[0]),
+            head_ttl=float(os.getenv("GITHUB_HEAD_TTL", GithubConfiguration.DEFAULT_HEAD_TTL)),
+            rate=float(os.getenv("GITHUB_RATE", GithubConfiguration.DEFAULT_RATE)),
+            burst=int(os.getenv("GITHUB_BURST", GithubConfiguration.DEFAULT_BURST)),
+            rate_retries=int(os.getenv("GITHUB_RATE_RETRIES", GithubConfiguration.DEFAULT_RATE_RETRIES)),
+            app_id=os.getenv("GITHUB_APP_ID", None),
+            app_installation=os.getenv("GITHUB_APP_INSTALLATION_ID", None),
+            app_key_file=os.getenv("GITHUB_APP_KEY_FILE", None)
         )
 
     def __post_init__(self):
         for attr in [
             'user',
-            'token',
             'repository',
             'email',
             'author',
             'branch'
-        ]:
+        ] + (['app_installation', 'app_key_file'] if self.app_id else ['token']):
             _assert_value(self.__getattribute__(attr), attr)
 
+        if self.engine not in GithubConfiguration.ENGINES:
+            raise ValueError("GITHUB_COMMIT_ENGINE (engine) must be one of %s" % str(GithubConfiguration.ENGINES))
+
+        if self.head_ttl < 0:
+            raise ValueError("GITHUB_HEAD_TTL (head_ttl) must not be negative!")
+
+        if self.rate < 0:
+            raise ValueError("GITHUB_RATE (rate) must not be negative!")
+
+        if self.burst < 1:
+            raise ValueError("GITHUB_BURST (burst) must be at least 1!")
+
+        if self.rate_retries < 0:
+            raise ValueError("GITHUB_RATE_RETRIES (rate_retries) must not be negative!")
+
+    @cached_property
+    def credentials(self) -> list[GithubCredentials]:
+        """All configured credentials: one per comma-separated token and the GitHub App, if configured"""
+        tokens = [token.strip() for token in (self.token or "").split(",") if token.strip()]
+        credentials = [GithubTokenCredentials(self.user, token, f"token-%i" % i) for i, token in enumerate(tokens)]
+
+        if self.app_id:
+            with open(self.app_key_file, "r") as f:
+                credentials.append(GithubAppCredentials(self.app_id, self.app_installation, f.read()))
+
+        return credentials
+
+    @cached_property
+    def _credential_cycle(self):
+        return itertools.cycle(self.credentials)
+
+    def next_credentials(self) -> GithubCredentials:
+        """Return the credentials for the next call, round-robin over all configured credentials"""
+        return next(self._credential_cycle)
+
     def create_auth_header(self):
-        auth = f"%s:%s" % (self.user, self.token)
-        b64 = base64.b64encode(auth.encode("utf-8"))
+        return self.next_credentials().header()
+
+
+@dataclass
+class _HeadEntry(object):
+    sha: str
+    etag: Optional[str]
+    checked: float
+
+
+class GithubHeadCache(object):
+    """Process-wide cache of branch head SHAs
+
+    Entries are considered fresh for the configured TTL. After that they are revalidated
+    with the stored ETag, which GitHub answers with 304 without counting against the rate limit.
+    """
+
+    def __init__(self):
+        self._entries = dict()
+
+    def get(self, key) -> Optional[_HeadEntry]:
+        return self._entries.get(key, None)
+
+    def store(self, key, sha: str, etag: Optional[str]) -> None:
+        self._entries[key] = _HeadEntry(sha=sha, etag=etag, checked=time.monotonic())
+
+    def touch(self, key) -> None:
+        entry = self._entries.get(key, None)
+        if entry:
+            entry.checked = time.monotonic()
+
+    def invalidate(self, key) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    @staticmethod
+    def is_fresh(entry: _HeadEntry, ttl: float) -> bool:
+        return time.monotonic() - entry.checked < ttl
+
+
+HEAD_CACHE = GithubHeadCache()
+
+
+class SingleFlight(object):
+    """Coalesce concurrent identical calls into one in-flight call
+
+    The first caller for a key starts the call, all callers arriving while it is in flight
+    share its result (or exception). Cancelling one caller does not cancel the shared call.
+    """
+
+    def __init__(self):
+        self._inflight = dict()
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key, call: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._inflight.get(key, None)
+        if future is None:
+            self.started += 1
+            future = asyncio.ensure_future(call())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _f: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+
+        return await asyncio.shield(future)
+
+    def stats(self) -> dict:
         return {
-            "Authorization": f"Basic %s" % b64.decode("utf-8")
+            "in-flight": len(self._inflight),
+            "started": self.started,
+            "coalesced": self.coalesced
+        }
+
+
+SINGLE_FLIGHT = SingleFlight()
+
+
+@dataclass
+class _RateBudget(object):
+    limit: Optional[int] = None
+    remaining: Optional[int] = None
+    reset: Optional[int] = None
+    blocked_until: float = 0.0
+    secondary_hits: int = 0
+
+    def blocked_for(self) -> float:
+        return max(self.blocked_until - time.monotonic(), 0.0)
+
+    def reset_in(self) -> float:
+        return max(self.reset - time.time(), 0.0) if self.reset is not None else 0.0
+
+
+class GithubScheduler(object):
+    """Process-wide scheduler for all GitHub calls
+
+    Calls wait in FIFO order for a token (if a rate is configured) and while GitHub asks to back off.
+    Each credential has its own rate limit for each resource (e.g. core REST calls and GraphQL),
+    so the budget is tracked per budget key (credential/resource), which is updated
+    from the rate limit headers of each response. A held back budget does not delay calls for other keys.
+    Calls that were rejected by a rate limit are queued again instead of failing,
+    up to the configured number of retries.
+    """
+
+    SECONDARY_BACKOFF = 60.0
+    """Initial back-off for secondary rate limits without Retry-After, doubled on each consecutive hit"""
+
+    DEFAULT_KEY = "default"
+
+    def __init__(self, rate: float = 0.0, burst: int = 1, retries: int = GithubConfiguration.DEFAULT_RATE_RETRIES):
+        self._bucket = None
+        self.retries = 0
+        self.configure(rate, burst, retries)
+
+        self._lock = asyncio.Lock()
+        self._queued = 0
+        self._budgets = dict()
+
+    def configure(self, rate: float, burst: int, retries: int) -> None:
+        self._bucket = TokenBucket(rate, burst) if rate else None
+        self.retries = retries
+
+    def _budget(self, key: str) -> _RateBudget:
+        budget = self._budgets.get(key, None)
+        if budget is None:
+            budget = _RateBudget()
+            self._budgets[key] = budget
+        return budget
+
+    def blocked_for(self, key: str = DEFAULT_KEY) -> float:
+        return self._budget(key).blocked_for()
+
+    async def acquire(self, key: str = DEFAULT_KEY) -> None:
+        """Wait until a call with this budget key may be sent"""
+        self._queued += 1
+        try:
+            while True:
+                # Wait for a held back budget outside the queue, so that it does not delay other keys
+                wait = self.blocked_for(key)
+                if wait:
+                    await asyncio.sleep(wait)
+                    continue
+
+                async with self._lock:
+                    while self._bucket:
+                        wait = self._bucket.take()
+                        if not wait:
+                            break
+                        await asyncio.sleep(wait)
+
+                if not self.blocked_for(key):
+                    return
+        finally:
+            self._queued -= 1
+
+    def update(self, code: int, headers, body=None, key: str = DEFAULT_KEY) -> bool:
+        """Update the budget from a response
+
+        :return: True if the call has been rejected by a rate limit and should be sent again
+        """
+        budget = self._budget(key)
+
+        limit = headers.get("X-RateLimit-Limit", None)
+        remaining = headers.get("X-RateLimit-Remaining", None)
+        reset = headers.get("X-RateLimit-Reset", None)
+        retry_after = headers.get("Retry-After", None)
+
+        if limit is not None:
+            budget.limit = int(limit)
+        if remaining is not None:
+            budget.remaining = int(remaining)
+        if reset is not None:
+            budget.reset = int(reset)
+
+        exhausted = remaining is not None and budget.remaining == 0
+        if exhausted and budget.reset is not None:
+            # Do not send calls that are bound to fail until the budget has been reset
+            self._block(key, budget.reset - time.time() + 1)
+
+        if code not in (403, 429):
+            budget.secondary_hits = 0
+            return False
+
+        if retry_after is not None:
+            self._block(key, float(retry_after))
+            return True
+
+        if exhausted:
+            return True
+
+        message = body.get("message", "") if isinstance(body, dict) else ""
+        if code == 429 or "rate limit" in message.lower():
+            self._block(key, GithubScheduler.SECONDARY_BACKOFF * 2 ** budget.secondary_hits)
+            budget.secondary_hits += 1
+            return True
+
+        return False
+
+    def _block(self, key: str, seconds: float) -> None:
+        budget = self._budget(key)
+        until = time.monotonic() + max(seconds, 0.0)
+        if until > budget.blocked_until:
+            LOGGER.warning("GitHub rate limit for %s: holding back calls for %.0f seconds", key, seconds)
+            budget.blocked_until = until
+
+    @staticmethod
+    def _resource(key: str) -> str:
+        """Resource of a budget key (credential/resource), empty for keys without a resource"""
+        return key.partition("/")[2]
+
+    def budget(self, resources: Optional[tuple[str, ...]] = None) -> tuple[Optional[int], float, float]:
+        """Return the remaining calls (None if unknown), the seconds calls are held back
+        and the seconds until the budget is reset (0 if unknown)
+
+        The calls of a resource are summed up over the credentials and held back only if they are held back
+        for all credentials. Of several resources, the one with the fewest remaining calls counts,
+        and calls are held back if they are for any resource.
+
+        :param resources: Resources the calls will use (e.g. core, graphql), default is all known resources
+        """
+        if resources is None:
+            resources = tuple(set(GithubScheduler._resource(key) for key in self._budgets))
+
+        remaining, blocked, reset_in = None, 0.0, 0.0
+        for resource in resources:
+            budgets = [b for key, b in self._budgets.items() if GithubScheduler._resource(key) == resource]
+            blocked = max(blocked, min((b.blocked_for() for b in budgets), default=0.0))
+
+            known = [b for b in budgets if b.remaining is not None]
+            if known and (remaining is None or sum(b.remaining for b in known) < remaining):
+                remaining = sum(b.remaining for b in known)
+                reset_in = min((b.reset_in() for b in known if b.reset is not None), default=0.0)
+
+        return remaining, blocked, reset_in
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queued,
+            "tokens": round(self._bucket.tokens(), 1) if self._bucket else None,
+            "budgets": {
+                key: {
+                    "limit": b.limit,
+                    "remaining": b.remaining,
+                    "reset": b.reset,
+                    "blocked-for": round(b.blocked_for(), 1)
+                } for key, b in self._budgets.items()
+            }
         }
 
 
+SCHEDULER = GithubScheduler()
+
+
+class GithubHealthProvider(object):
+    """Provide GitHub client information for the health endpoint"""
+
+    # noinspection PyMethodMayBeStatic
+    def get_health(self) -> tuple[dict, bool]:
+        """Return the client statistics; status is always healthy"""
+        return {
+            "rate-limit": SCHEDULER.stats(),
+            "single-flight": SINGLE_FLIGHT.stats()
+        }, True
+
+
+CALL_SECONDS = metrics.REGISTRY.histogram("comment2gh_github_call_seconds",
+                                          "Latency of GitHub calls including scheduling, by call and status code",
+                                          ("call", "code"))
+CALLS_IN_FLIGHT = metrics.REGISTRY.gauge("comment2gh_github_calls_in_flight",
+                                         "Number of GitHub calls in flight")
+
+_LAST_STATUS = contextvars.ContextVar("github_last_status", default=None)
+
+
+def last_status() -> Optional[int]:
+    """Return the status code of the last GitHub call in the current context (None if it did not complete)"""
+    return _LAST_STATUS.get()
+
+
+def is_transient(status: Optional[int]) -> bool:
+    """Indicate if a call with this status may succeed when repeated"""
+    return status is None or status == 429 or status >= 500
+
+
 class GithubApiFunction(object):
+    READ_ONLY_METHODS = ("GET", "HEAD")
+    """Identical concurrent calls with these methods share one request"""
+
+    RESOURCE = "core"
+    """Rate limit resource of the call, as reported by GitHub in X-RateLimit-Resource"""
 
     @staticmethod
     def assert_cfg(cfg: GithubConfiguration):
@@ -90,9 +567,11 @@ class GithubApiFunction(object):
 
         self._method = method
         self._body = body
+        self._response_headers = None
+        self._credentials = cfg.next_credentials()
 
     def _headers(self):
-        return self._cfg.create_auth_header() | {
+        return self._credentials.header() | {
             "Accept": "application/vnd.github.v3+json"
         }
 
@@ -104,14 +583,55 @@ class GithubApiFunction(object):
             body=self._body
         )
 
+    def _is_read_only(self) -> bool:
+        return self._method in GithubApiFunction.READ_ONLY_METHODS
+
     async def _fetch(self):
-        result = await AsyncHTTPClient().fetch(
-            self._request(),
-            raise_error=False
-        )
+        _LAST_STATUS.set(None)
+        start = time.monotonic()
+        code = "error"
+        CALLS_IN_FLIGHT.inc()
+        try:
+            await self._credentials.prepare()
+            request = self._request()
+
+            if self._is_read_only():
+                # Without the credentials, so that calls with pooled tokens are coalesced as well;
+                # other headers (e.g. If-None-Match) change the response and are part of the key
+                key = (request.method, request.url, request.body,
+                       tuple(sorted((name, value) for name, value in request.headers.items()
+                                    if name.lower() != "authorization")))
+                code, body, self._response_headers = await SINGLE_FLIGHT.do(
+                    key, lambda: self._fetch_request(request, self._budget_key()))
+            else:
+                code, body, self._response_headers = await self._fetch_request(request, self._budget_key())
+        finally:
+            CALLS_IN_FLIGHT.dec()
+            CALL_SECONDS.observe(time.monotonic() - start, call=type(self).__name__, code=code)
+
+        _LAST_STATUS.set(code)
+        return code, body
+
+    def _budget_key(self) -> str:
+        return f"%s/%s" % (self._credentials.name, self.RESOURCE)
+
+    @staticmethod
+    async def _fetch_request(request: HTTPRequest, budget_key: str):
+        attempt = 0
+        while True:
+            await SCHEDULER.acquire(budget_key)
+            result = await outbound.fetch(
+                request,
+                raise_error=False
+            )
+
+            body = json.loads(result.body.decode("utf-8")) if result.body else None
 
-        body = json.loads(result.body.decode("utf-8")) if result.body is not None else None
-        return result.code, body
+            if not SCHEDULER.update(result.code, result.headers, body, budget_key) or attempt >= SCHEDULER.retries:
+                return result.code, body, result.headers
+
+            attempt += 1
+            LOGGER.warning("Rate limited, queueing %s %s again (attempt %i)", request.method, request.url, attempt)
 
 
 class GithubDefaultRef(GithubApiFunction):
@@ -126,15 +646,48 @@ class GithubDefaultRef(GithubApiFunction):
                 f"heads/%s" % cfg.branch  # Could be optimized, but that would hide the API endpoint URL
             )
         )
+        self._etag = None
+
+    @staticmethod
+    def _cache_key(cfg: GithubConfiguration):
+        return cfg.user, cfg.repository, cfg.branch
+
+    @staticmethod
+    def invalidate(cfg: GithubConfiguration) -> None:
+        """Drop the cached head, e.g. when it turned out to be stale"""
+        HEAD_CACHE.invalidate(GithubDefaultRef._cache_key(cfg))
+
+    def _headers(self):
+        hdr = super()._headers()
+        if self._etag:
+            hdr["If-None-Match"] = self._etag
+        return hdr
 
     async def default_head(self) -> Optional[str]:
+        key = GithubDefaultRef._cache_key(self._cfg)
+        entry = HEAD_CACHE.get(key)
+        if entry and GithubHeadCache.is_fresh(entry, self._cfg.head_ttl):
+            return entry.sha
+        self._etag = entry.etag if entry else None
+
         code, body = await self._fetch()
 
+        if code == 304 and entry:
+            HEAD_CACHE.touch(key)
+            return entry.sha
+
         if code != 200:
             LOGGER.error("Error %i when fetching ref id: %s", code, str(body))
+            HEAD_CACHE.invalidate(key)
             return None
 
-        return GithubDefaultRef._sha(body)
+        sha = GithubDefaultRef._sha(body)
+        if sha:
+            HEAD_CACHE.store(key, sha, self._response_headers.get("ETag", None))
+        else:
+            HEAD_CACHE.invalidate(key)
+
+        return sha
 
     @staticmethod
     def _sha(body):
@@ -145,6 +698,36 @@ class GithubDefaultRef(GithubApiFunction):
             return None
 
 
+class GithubGetBranch(GithubApiFunction):
+    def __init__(self,
+                 cfg: GithubConfiguration,
+                 branch: str):
+        GithubApiFunction.assert_cfg(cfg)
+        super().__init__(
+            cfg,
+            url=f"https://api.github.com/repos/%s/%s/git/ref/heads/%s" % (
+                cfg.user,
+                cfg.repository,
+                branch
+            )
+        )
+
+    async def head(self) -> Optional[str]:
+        """Return the head SHA of the branch, None if it does not exist"""
+        code, body = await self._fetch()
+
+        if code != 200:
+            if code != 404:
+                LOGGER.error("Error %i when fetching branch: %s", code, str(body))
+            return None
+
+        try:
+            return body["object"]["sha"]
+        except (KeyError, TypeError) as e:
+            LOGGER.warning("Got weird result from GitHub, error: %s", e)
+            return None
+
+
 class GithubCreateBranch(GithubApiFunction):
     def __init__(self,
                  cfg: GithubConfiguration,
@@ -173,6 +756,123 @@ class GithubCreateBranch(GithubApiFunction):
         return code == 201
 
 
+class GithubCommitTree(GithubApiFunction):
+    """Look up the tree of an existing commit (Git Data API)"""
+
+    def __init__(self,
+                 cfg: GithubConfiguration,
+                 sha: str):
+        GithubApiFunction.assert_cfg(cfg)
+        super().__init__(
+            cfg,
+            url=f"https://api.github.com/repos/%s/%s/git/commits/%s" % (
+                cfg.user,
+                cfg.repository,
+                sha
+            )
+        )
+
+    async def tree_sha(self) -> Optional[str]:
+        code, body = await self._fetch()
+
+        if code != 200:
+            LOGGER.error("Error %i when fetching commit: %s", code, str(body))
+            return None
+
+        return GithubCommitTree._sha(body)
+
+    @staticmethod
+    def _sha(body):
+        try:
+            return body["tree"]["sha"]
+        except (KeyError, TypeError) as e:
+            LOGGER.warning("Got weird result from GitHub, error: %s", e)
+            return None
+
+
+class GithubCreateTree(GithubApiFunction):
+    """Create a tree on top of a base tree (Git Data API)
+
+    The file contents are sent inline, so GitHub creates the blobs as part of this call.
+    """
+
+    def __init__(self,
+                 cfg: GithubConfiguration,
+                 base_tree: str,
+                 files: dict[str, str]):
+        GithubApiFunction.assert_cfg(cfg)
+        if not files:
+            raise ValueError("At least one file must be provided!")
+        super().__init__(
+            cfg,
+            url=f"https://api.github.com/repos/%s/%s/git/trees" % (
+                cfg.user,
+                cfg.repository
+            ),
+            method="POST",
+            body=json.dumps({
+                "base_tree": base_tree,
+                "tree": [{
+                    "path": path,
+                    "mode": "100644",
+                    "type": "blob",
+                    "content": content
+                } for path, content in files.items()]
+            })
+        )
+
+    async def create(self) -> Optional[str]:
+        code, body = await self._fetch()
+
+        if code != 201:
+            LOGGER.error("Error %i when creating tree: %s", code, str(body))
+            return None
+
+        return body.get("sha", None)
+
+
+class GithubCreateCommit(GithubApiFunction):
+    """Create a commit object for a tree (Git Data API)"""
+
+    def __init__(self,
+                 cfg: GithubConfiguration,
+                 message: str,
+                 tree: str,
+                 parent: str,
+                 committer_name: str, committer_email: str):
+        GithubApiFunction.assert_cfg(cfg)
+        super().__init__(
+            cfg,
+            url=f"https://api.github.com/repos/%s/%s/git/commits" % (
+                cfg.user,
+                cfg.repository
+            ),
+            method="POST",
+            body=json.dumps({
+                "message": message,
+                "tree": tree,
+                "parents": [parent],
+                "author": {
+                    "name": committer_name,
+                    "email": committer_email
+                },
+                "committer": {
+                    "name": committer_name,
+                    "email": committer_email
+                }
+            })
+        )
+
+    async def create(self) -> Optional[str]:
+        code, body = await self._fetch()
+
+        if code != 201:
+            LOGGER.error("Error %i when creating commit: %s", code, str(body))
+            return None
+
+        return body.get("sha", None)
+
+
 class GithubUpload(GithubApiFunction):
     def __init__(self,
                  cfg: GithubConfiguration,
@@ -211,6 +911,61 @@ class GithubUpload(GithubApiFunction):
         return code == 201
 
 
+class GithubGetContent(GithubApiFunction):
+    def __init__(self,
+                 cfg: GithubConfiguration,
+                 branch: str,
+                 path: str):
+        GithubApiFunction.assert_cfg(cfg)
+        super().__init__(
+            cfg,
+            url=url_concat(f"https://api.github.com/repos/%s/%s/contents/%s" % (
+                cfg.user,
+                cfg.repository,
+                path
+            ), {"ref": branch})
+        )
+
+    async def sha(self) -> Optional[str]:
+        """Return the blob SHA of the file on the branch, None if it does not exist"""
+        code, body = await self._fetch()
+
+        if code != 200:
+            if code != 404:
+                LOGGER.error("Error %i when fetching content: %s", code, str(body))
+            return None
+
+        return body.get("sha", None) if isinstance(body, dict) else None
+
+
+class GithubFindPR(GithubApiFunction):
+    def __init__(self,
+                 cfg: GithubConfiguration,
+                 head: str):
+        GithubApiFunction.assert_cfg(cfg)
+        super().__init__(
+            cfg,
+            url=url_concat(f"https://api.github.com/repos/%s/%s/pulls" % (
+                cfg.user,
+                cfg.repository
+            ), {"head": f"%s:%s" % (cfg.user, head), "state": "open"})
+        )
+
+    async def find(self) -> Optional[tuple[int, str]]:
+        """Return number and node ID of the open PR for the head branch, None if there is none"""
+        code, body = await self._fetch()
+
+        if code != 200:
+            LOGGER.error("Error %i when searching PR: %s", code, str(body))
+            return None
+
+        try:
+            return (body[0]["number"], body[0]["node_id"]) if body else None
+        except (KeyError, TypeError) as e:
+            LOGGER.warning("Got weird result from GitHub, error: %s", e)
+            return None
+
+
 class GithubPR(GithubApiFunction):
     def __init__(self,
                  cfg: GithubConfiguration,
@@ -284,3 +1039,190 @@ class GithubLabel(GithubApiFunction):
             LOGGER.error("Add label: Validation failed! %s", str(body))
 
         return code == 200
+
+
+class GithubGraphQL(GithubApiFunction):
+    """Base for calls to the GitHub GraphQL API"""
+
+    URL = "https://api.github.com/graphql"
+    RESOURCE = "graphql"
+
+    def __init__(self,
+                 cfg: GithubConfiguration,
+                 query: str,
+                 variables: dict):
+        GithubApiFunction.assert_cfg(cfg)
+        super().__init__(
+            cfg,
+            url=GithubGraphQL.URL,
+            method="POST",
+            body=json.dumps({
+                "query": query,
+                "variables": variables
+            })
+        )
+
+    async def _execute(self) -> Optional[dict]:
+        code, body = await self._fetch()
+
+        if code != 200:
+            LOGGER.error("Error %i when calling GraphQL API: %s", code, str(body))
+            return None
+
+        if body.get("errors", None):
+            LOGGER.error("GraphQL API returned errors: %s", str(body["errors"]))
+            return None
+
+        return body.get("data", None)
+
+
+class GithubGraphQLRepository(GithubGraphQL):
+    """Look up the node IDs of the repository and the configured label
+
+    Node IDs do not change, so they are cached for the process lifetime.
+    """
+
+    QUERY = """\
+query($owner: String!, $name: String!, $label: String!, $withLabel: Boolean!) {
+  repository(owner: $owner, name: $name) {
+    id
+    label(name: $label) @include(if: $withLabel) { id }
+  }
+}"""
+
+    _ids = dict()
+
+    def __init__(self,
+                 cfg: GithubConfiguration):
+        GithubApiFunction.assert_cfg(cfg)
+        super().__init__(
+            cfg,
+            query=GithubGraphQLRepository.QUERY,
+            variables={
+                "owner": cfg.user,
+                "name": cfg.repository,
+                "label": cfg.label or "",
+                "withLabel": bool(cfg.label)
+            }
+        )
+
+    def _is_read_only(self) -> bool:
+        return True
+
+    async def ids(self) -> Optional[tuple[str, Optional[str]]]:
+        """Return the repository ID and the label ID (None if no label is configured or found)"""
+        key = (self._cfg.user, self._cfg.repository, self._cfg.label)
+        ids = GithubGraphQLRepository._ids.get(key, None)
+        if ids is not None:
+            return ids
+
+        data = await self._execute()
+        try:
+            repository = data["repository"]
+            label = repository.get("label", None)
+            ids = repository["id"], label["id"] if label else None
+        except (KeyError, TypeError, AttributeError) as e:
+            LOGGER.warning("Got weird result from GitHub, error: %s", e)
+            return None
+
+        GithubGraphQLRepository._ids[key] = ids
+        return ids
+
+
+class GithubGraphQLCommitPR(GithubGraphQL):
+    """Create the branch, commit the files and open the PR in one batch of mutations
+
+    GitHub executes the mutations in order. The commit is authored by the token owner,
+    as createCommitOnBranch does not allow to set the committer.
+    """
+
+    MUTATION = """\
+mutation($ref: CreateRefInput!, $commit: CreateCommitOnBranchInput!, $pr: CreatePullRequestInput!) {
+  createRef(input: $ref) { ref { id } }
+  createCommitOnBranch(input: $commit) { commit { oid } }
+  createPullRequest(input: $pr) { pullRequest { id number } }
+}"""
+
+    def __init__(self,
+                 cfg: GithubConfiguration,
+                 repository_id: str,
+                 sha: str,
+                 branch: str,
+                 files: dict[str, str],
+                 message: str,
+                 title: str,
+                 base: str,
+                 body: str,
+                 maintainer_can_modify: Optional[bool] = True):
+        GithubApiFunction.assert_cfg(cfg)
+        super().__init__(
+            cfg,
+            query=GithubGraphQLCommitPR.MUTATION,
+            variables={
+                "ref": {
+                    "repositoryId": repository_id,
+                    "name": f"refs/heads/%s" % branch,
+                    "oid": sha
+                },
+                "commit": {
+                    "branch": {
+                        "repositoryNameWithOwner": f"%s/%s" % (cfg.user, cfg.repository),
+                        "branchName": branch
+                    },
+                    "message": {
+                        "headline": message
+                    },
+                    "fileChanges": {
+                        "additions": [{
+                            "path": path,
+                            "contents": base64.b64encode(content.encode("utf-8")).decode("utf-8")
+                        } for path, content in files.items()]
+                    },
+                    "expectedHeadOid": sha
+                },
+                "pr": {
+                    "repositoryId": repository_id,
+                    "baseRefName": base,
+                    "headRefName": branch,
+                    "title": title,
+                    "body": body,
+                    "maintainerCanModify": maintainer_can_modify
+                }
+            }
+        )
+
+    async def create(self) -> Optional[tuple[int, str]]:
+        """Return the PR number and node ID"""
+        data = await self._execute()
+        try:
+            pr = data["createPullRequest"]["pullRequest"]
+            return pr["number"], pr["id"]
+        except (KeyError, TypeError) as e:
+            LOGGER.warning("Got weird result from GitHub, error: %s", e)
+            return None
+
+
+class GithubGraphQLLabel(GithubGraphQL):
+    MUTATION = """\
+mutation($input: AddLabelsToLabelableInput!) {
+  addLabelsToLabelable(input: $input) { clientMutationId }
+}"""
+
+    def __init__(self,
+                 cfg: GithubConfiguration,
+                 labelable_id: str,
+                 label_id: str):
+        GithubApiFunction.assert_cfg(cfg)
+        super().__init__(
+            cfg,
+            query=GithubGraphQLLabel.MUTATION,
+            variables={
+                "input": {
+                    "labelableId": labelable_id,
+                    "labelIds": [label_id]
+                }
+            }
+        )
+
+    async def add(self) -> bool:
+        return await self._execute() is not None
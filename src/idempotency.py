@@ -0,0 +1,97 @@
+""" Module for idempotent comment requests
+
+A client can send an idempotency key with a comment. Repeated requests with the same key
+get the response of the first request instead of being processed again.
+"""
+
+from dataclasses import dataclass
+from typing import Callable, Awaitable, Optional
+
+import os
+
+import form
+from dedup import DuplicateIndex
+from store import ExpiringStore, ResponseStore
+
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class IdempotencyConfiguration(object):
+    """Configuration for the idempotency keys"""
+    DEFAULT_TTL = 86400.0
+    DEFAULT_SIZE = 10000
+
+    ttl: float = DEFAULT_TTL
+    size: int = DEFAULT_SIZE
+    path: Optional[str] = None
+
+    @staticmethod
+    def from_environment():
+        return IdempotencyConfiguration(
+            ttl=float(os.getenv("IDEMPOTENCY_TTL", IdempotencyConfiguration.DEFAULT_TTL)),
+            size=int(os.getenv("IDEMPOTENCY_SIZE", IdempotencyConfiguration.DEFAULT_SIZE)),
+            path=os.getenv("IDEMPOTENCY_PATH", None)
+        )
+
+    def __post_init__(self):
+        if self.ttl < 0:
+            raise ValueError("IDEMPOTENCY_TTL (ttl) must not be negative!")
+
+        if self.size < 1:
+            raise ValueError("IDEMPOTENCY_SIZE (size) must be at least 1!")
+
+    def is_enabled(self) -> bool:
+        return self.ttl > 0
+
+
+class IdempotencyStore(object):
+    """Responses by idempotency key, see store.ResponseStore
+
+    A key can only be used for one comment: a request with a known key but another comment is rejected.
+    """
+
+    MAX_KEY_LENGTH = 255
+
+    def __init__(self, cfg: IdempotencyConfiguration):
+        if cfg is None or not cfg.is_enabled():
+            raise ValueError("Enabled idempotency configuration must be provided!")
+
+        self._store = ExpiringStore("idempotency", cfg.size, cfg.ttl, cfg.path)
+        self._responses = ResponseStore(self._store, "idempotency")
+
+    @staticmethod
+    def assert_key(key: str) -> None:
+        if len(key) > IdempotencyStore.MAX_KEY_LENGTH or not key.isprintable():
+            raise ValueError("Idempotency key must be printable and have at most %i characters!"
+                             % IdempotencyStore.MAX_KEY_LENGTH)
+
+    async def run(self, key: str, cmt: form.Comment, process: Callable[[], Awaitable[dict]]) -> tuple[dict, bool]:
+        """Process the comment unless the key has already been used
+
+        :return: The response of the first request with the key, and if it is a repeated request
+        """
+        IdempotencyStore.assert_key(key)
+        fingerprint = DuplicateIndex.fingerprint(cmt)
+
+        async def produce():
+            return {
+                "fingerprint": fingerprint,
+                "response": await process()
+            }
+
+        stored, repeated = await self._responses.run(key, produce)
+        if repeated:
+            if stored["fingerprint"] != fingerprint:
+                raise ValueError("Idempotency key has already been used for another comment!")
+            LOGGER.info("Repeated request for idempotency key %s", key)
+
+        return stored["response"], repeated
+
+    def close(self) -> None:
+        self._store.close()
+
+    def get_health(self) -> tuple[dict, bool]:
+        return self._responses.get_health()
@@ -0,0 +1,285 @@
+""" Module for the persistent comment job queue
+
+Comments are stored in a local SQLite database (WAL mode) and processed by a pool of async workers,
+so that the HTTP request can be answered right away and no comment is lost on errors or restarts.
+"""
+
+from dataclasses import dataclass
+from typing import Callable, Awaitable, Optional
+
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import time
+import uuid
+
+import form
+import store
+from admission import Overloaded
+
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class JobQueueConfiguration(object):
+    """Configuration for the comment job queue"""
+    DEFAULT_WORKERS = 2
+    DEFAULT_RETRIES = 5
+    DEFAULT_RETRY_DELAY = 30.0
+    DEFAULT_MAX_DEPTH = 1000
+    DEFAULT_LEASE = 30.0
+
+    path: Optional[str] = None
+    workers: int = DEFAULT_WORKERS
+    retries: int = DEFAULT_RETRIES
+    retry_delay: float = DEFAULT_RETRY_DELAY
+    max_depth: int = DEFAULT_MAX_DEPTH
+    lease: float = DEFAULT_LEASE
+
+    @staticmethod
+    def from_environment():
+        return JobQueueConfiguration(
+            path=os.getenv("JOB_QUEUE_PATH", None),
+            workers=int(os.getenv("JOB_WORKERS", JobQueueConfiguration.DEFAULT_WORKERS)),
+            retries=int(os.getenv("JOB_RETRIES", JobQueueConfiguration.DEFAULT_RETRIES)),
+            retry_delay=float(os.getenv("JOB_RETRY_DELAY", JobQueueConfiguration.DEFAULT_RETRY_DELAY)),
+            max_depth=int(os.getenv("JOB_QUEUE_MAX", JobQueueConfiguration.DEFAULT_MAX_DEPTH)),
+            lease=float(os.getenv("JOB_LEASE", JobQueueConfiguration.DEFAULT_LEASE))
+        )
+
+    def __post_init__(self):
+        if self.workers < 1:
+            raise ValueError("JOB_WORKERS (workers) must be at least 1!")
+
+        if self.retries < 0:
+            raise ValueError("JOB_RETRIES (retries) must not be negative!")
+
+        if self.retry_delay < 0:
+            raise ValueError("JOB_RETRY_DELAY (retry_delay) must not be negative!")
+
+        if self.max_depth < 1:
+            raise ValueError("JOB_QUEUE_MAX (max_depth) must be at least 1!")
+
+        if self.lease <= 0:
+            raise ValueError("JOB_LEASE (lease) must be positive!")
+
+    def is_enabled(self) -> bool:
+        return bool(self.path)
+
+
+class JobQueue(object):
+    """Persistent queue of comments, drained by async workers
+
+    A job is a comment in one of the states queued, running or failed; finished jobs are deleted.
+    Failed attempts are rescheduled with exponential back-off until the retries are used up.
+
+    Several queues (e.g. of forked workers) can share the database. A running job is leased by its queue,
+    which renews the lease while the job runs. Jobs whose lease has expired, because their queue has
+    stopped or crashed, are taken over by any queue.
+
+    The SQLite statements are short and run on the event loop.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cid INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_run REAL NOT NULL,
+            created REAL NOT NULL,
+            owner TEXT,
+            lease REAL NOT NULL DEFAULT 0
+        )"""
+
+    def __init__(self, cfg: JobQueueConfiguration, comment_cb: Callable[[form.Comment], Awaitable[Optional[int]]]):
+        if cfg is None or not cfg.is_enabled():
+            raise ValueError("Job queue configuration with a path must be provided!")
+        if comment_cb is None:
+            raise ValueError("Comment callback must be provided!")
+
+        self._cfg = cfg
+        self._cb = comment_cb
+
+        # Unique, also if a restarted process gets the same PID (e.g. 1 in a container)
+        self._owner = f"%s-%i-%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+        self._db = store.connect(cfg.path)
+        # Queues starting at the same time set up the database one after the other
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.execute(JobQueue.SCHEMA)
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, next_run)")
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(jobs)")]
+            if "lease" not in columns:
+                # Database of an earlier version, its running jobs have expired leases
+                self._db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+                self._db.execute("ALTER TABLE jobs ADD COLUMN lease REAL NOT NULL DEFAULT 0")
+
+            resumed = self._db.execute("UPDATE jobs SET state = 'queued', owner = NULL "
+                                       "WHERE state = 'running' AND lease <= ?", (time.time(),)).rowcount
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        if resumed:
+            LOGGER.warning("Resuming %i unfinished jobs", resumed)
+
+        self._wakeup = asyncio.Event()
+        self._workers = list()
+        self._heartbeat = None
+        self._stopping = False
+        self._done = 0
+
+    def start(self) -> None:
+        """Start the workers (must be called on the running event loop)"""
+        self._stopping = False
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self._cfg.workers)]
+        self._heartbeat = asyncio.ensure_future(self._renew_leases())
+        LOGGER.info("Job queue %s started with %i workers, %i jobs queued",
+                    self._cfg.path, self._cfg.workers, self.depth())
+
+    def stop(self) -> None:
+        """Let the workers finish their current job and stop; queued jobs stay in the database"""
+        self._stopping = True
+        self._wakeup.set()
+
+    async def join(self) -> None:
+        """Wait for the workers to stop"""
+        try:
+            await asyncio.gather(*self._workers)
+        finally:
+            self._workers = list()
+            if self._heartbeat is not None:
+                self._heartbeat.cancel()
+                self._heartbeat = None
+
+    async def drain(self, timeout: float) -> bool:
+        """Stop the workers and wait for their current jobs
+
+        :param timeout: Seconds after which the workers are cancelled; their jobs are resumed on the next start
+        :return: True if all workers have finished in time
+        """
+        self.stop()
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            # Release the cancelled jobs, so that other queues do not have to wait for the leases to expire
+            self._db.execute("UPDATE jobs SET state = 'queued', owner = NULL WHERE state = 'running' AND owner = ?",
+                             (self._owner,))
+            LOGGER.error("Job queue workers cancelled, their jobs are resumed by the next queue")
+            return False
+
+    def close(self) -> None:
+        self._db.close()
+
+    def submit(self, cmt: form.Comment) -> Optional[int]:
+        """Store a comment for processing
+
+        :return: The job ID or None if the queue is full
+        """
+        if self.depth() >= self._cfg.max_depth:
+            LOGGER.error("Job queue is full, rejecting comment %i", cmt.cid)
+            return None
+
+        now = time.time()
+        job = self._db.execute("INSERT INTO jobs (cid, payload, next_run, created) VALUES (?, ?, ?, ?)",
+                               (cmt.cid, json.dumps(cmt.to_dict()), now, now)).lastrowid
+        LOGGER.info("Queued comment %i as job %i", cmt.cid, job)
+
+        self._wakeup.set()
+        return job
+
+    def depth(self) -> int:
+        """Number of jobs waiting or in process"""
+        return self._count("state IN ('queued', 'running')")
+
+    def _count(self, condition: str) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM jobs WHERE " + condition).fetchone()[0]
+
+    def _claim(self) -> Optional[tuple[int, str, int]]:
+        """Lease the oldest due job (or running job with an expired lease), return its ID, payload and attempt"""
+        now = time.time()
+        return self._db.execute("""
+            UPDATE jobs SET state = 'running', attempts = attempts + 1, owner = ?, lease = ?
+            WHERE id = (SELECT id FROM jobs
+                        WHERE (state = 'queued' AND next_run <= ?) OR (state = 'running' AND lease <= ?)
+                        ORDER BY id LIMIT 1)
+            RETURNING id, payload, attempts""", (self._owner, now + self._cfg.lease, now, now)).fetchone()
+
+    def _next_due(self) -> Optional[float]:
+        """Seconds until the next scheduled job is due or the next lease expires, None if there is none"""
+        due = self._db.execute("""
+            SELECT MIN(due) FROM (
+                SELECT MIN(next_run) AS due FROM jobs WHERE state = 'queued'
+                UNION ALL SELECT MIN(lease) FROM jobs WHERE state = 'running')""").fetchone()[0]
+        return None if due is None else max(due - time.time(), 0.0)
+
+    async def _renew_leases(self) -> None:
+        """Extend the leases of the running jobs of this queue, three times per lease"""
+        while True:
+            await asyncio.sleep(self._cfg.lease / 3)
+            try:
+                self._db.execute("UPDATE jobs SET lease = ? WHERE state = 'running' AND owner = ?",
+                                 (time.time() + self._cfg.lease, self._owner))
+            except sqlite3.Error as e:
+                LOGGER.error("Could not renew the job leases: %s", str(e))
+
+    async def _worker(self) -> None:
+        while not self._stopping:
+            job = self._claim()
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self._next_due())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._run(*job)
+
+    async def _run(self, job: int, payload: str, attempt: int) -> None:
+        cmt = form.Comment.from_dict(json.loads(payload))
+
+        try:
+            pr = await self._cb(cmt)
+        except Overloaded as e:
+            # Shed by the admission gate: try again later without using up an attempt
+            self._db.execute("UPDATE jobs SET state = 'queued', attempts = attempts - 1, next_run = ? WHERE id = ?",
+                             (time.time() + e.retry_after, job))
+            LOGGER.warning("Job %i for comment %i postponed by %i seconds: %s", job, cmt.cid, e.retry_after, e.reason)
+            return
+        except Exception as e:
+            LOGGER.exception("Job %i for comment %i raised an error: %s", job, cmt.cid, str(e))
+            pr = None
+
+        if pr is not None:
+            self._db.execute("DELETE FROM jobs WHERE id = ?", (job,))
+            self._done += 1
+            LOGGER.info("Job %i for comment %i done with PR %s", job, cmt.cid, str(pr))
+        elif attempt > self._cfg.retries:
+            self._db.execute("UPDATE jobs SET state = 'failed' WHERE id = ?", (job,))
+            LOGGER.error("Job %i for comment %i failed after %i attempts", job, cmt.cid, attempt)
+        else:
+            delay = self._cfg.retry_delay * 2 ** (attempt - 1)
+            self._db.execute("UPDATE jobs SET state = 'queued', next_run = ? WHERE id = ?",
+                             (time.time() + delay, job))
+            LOGGER.warning("Job %i for comment %i failed, retrying in %.0f seconds", job, cmt.cid, delay)
+
+    def get_health(self) -> tuple[dict, bool]:
+        """Return the queue statistics; unhealthy if the queue is full"""
+        depth = self.depth()
+        return {
+            "workers": len(self._workers),
+            "queued": self._count("state = 'queued'"),
+            "running": self._count("state = 'running'"),
+            "failed": self._count("state = 'failed'"),
+            "done": self._done,
+            "max-depth": self._cfg.max_depth
+        }, depth < self._cfg.max_depth
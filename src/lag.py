@@ -0,0 +1,171 @@
+""" Module for the event loop lag monitor
+
+A probe sleeps on the event loop for a fixed interval and measures how much later than planned it wakes up:
+this scheduling delay is the time every other callback had to wait, e.g. because a callback blocked the loop.
+A watchdog thread notices when the probe is overdue and logs the stack of the event loop thread,
+i.e. the code blocking the loop while it is still blocking.
+"""
+
+from collections import deque
+from dataclasses import dataclass
+
+import asyncio
+import math
+import os
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+LAG = metrics.REGISTRY.histogram("comment2gh_event_loop_lag_seconds",
+                                 "Delay of the event loop probe beyond its interval",
+                                 buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+STALLS = metrics.REGISTRY.counter("comment2gh_event_loop_stalls_total",
+                                  "Number of times the event loop was blocked longer than the lag threshold")
+
+
+@dataclass(frozen=True)
+class LagConfiguration(object):
+    """Configuration for the event loop lag monitor"""
+    DEFAULT_INTERVAL = 0.5
+    DEFAULT_THRESHOLD = 0.25
+    DEFAULT_WINDOW = 1000
+
+    interval: float = DEFAULT_INTERVAL
+    threshold: float = DEFAULT_THRESHOLD
+    window: int = DEFAULT_WINDOW
+
+    @staticmethod
+    def from_environment():
+        return LagConfiguration(
+            interval=float(os.getenv("LAG_INTERVAL", LagConfiguration.DEFAULT_INTERVAL)),
+            threshold=float(os.getenv("LAG_THRESHOLD", LagConfiguration.DEFAULT_THRESHOLD)),
+            window=int(os.getenv("LAG_WINDOW", LagConfiguration.DEFAULT_WINDOW))
+        )
+
+    def __post_init__(self):
+        if self.interval < 0:
+            raise ValueError("LAG_INTERVAL (interval) must not be negative!")
+
+        if self.threshold <= 0:
+            raise ValueError("LAG_THRESHOLD (threshold) must be positive!")
+
+        if self.window < 1:
+            raise ValueError("LAG_WINDOW (window) must be at least 1!")
+
+    def is_enabled(self) -> bool:
+        return self.interval > 0
+
+
+def percentile(ordered: list, fraction: float) -> float:
+    """Nearest-rank percentile of sorted values, 0 if there are none"""
+    if not ordered:
+        return 0.0
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+class LagMonitor(object):
+    """Measure the event loop lag and log the stack of the event loop thread when it is blocked
+
+    The last `window` probes are kept for the percentiles. A stall is only noticed by the watchdog
+    if the loop is blocked for `threshold` seconds beyond the probe interval, so short stalls show up
+    in the lag percentiles only.
+    """
+
+    def __init__(self, cfg: LagConfiguration):
+        if cfg is None or not cfg.is_enabled():
+            raise ValueError("Enabled lag configuration must be provided!")
+
+        self._cfg = cfg
+        self._samples = deque(maxlen=cfg.window)
+        self._probes = 0
+        self._stalls = 0
+        self._max_lag = 0.0
+        self._loop = None
+
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        self._thread_id = None
+        # Set by the probe on the event loop thread, read by the watchdog thread
+        self._heartbeat = 0.0
+        self._reported = 0.0
+
+    def start(self) -> None:
+        """Start the probe and the watchdog, must be called on the event loop thread"""
+        if self._task is not None:
+            return
+
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.ensure_future(self._probe())
+        self._watchdog = threading.Thread(target=self._watch, name="lag-watchdog", daemon=True)
+        self._watchdog.start()
+        LOGGER.info("Event loop lag monitor started: probe every %.3f s, stall threshold %.3f s",
+                    self._cfg.interval, self._cfg.threshold)
+
+    def stop(self) -> None:
+        if self._task is None:
+            return
+
+        self._stopped.set()
+        self._task.cancel()
+        self._task = None
+
+    async def _probe(self) -> None:
+        interval = self._cfg.interval
+        while True:
+            planned = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            self._record(max(now - planned, 0.0))
+
+    def _record(self, lag: float) -> None:
+        self._probes += 1
+        self._samples.append(lag)
+        self._max_lag = max(self._max_lag, lag)
+        LAG.observe(lag)
+        if lag >= self._cfg.threshold:
+            LOGGER.warning("Event loop lagged %.3f s behind", lag)
+
+    def _watch(self) -> None:
+        # Overdue means the probe should have woken up at least `threshold` seconds ago
+        overdue = self._cfg.interval + self._cfg.threshold
+        while not self._stopped.wait(self._cfg.threshold / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat
+            if blocked > overdue and heartbeat != self._reported:
+                # Once per stall, the stack does not change much while the loop is blocked
+                self._reported = heartbeat
+                self._report(blocked - self._cfg.interval)
+
+    def _report(self, lag: float) -> None:
+        self._stalls += 1
+        STALLS.inc()
+
+        frame = sys._current_frames().get(self._thread_id, None)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else "(not available)\n"
+        LOGGER.warning("Event loop blocked for more than %.3f s, stack of the event loop thread:\n%s",
+                       lag, stack.rstrip())
+
+    def get_health(self) -> tuple[dict, bool]:
+        """Return the lag percentiles in milliseconds over the recent probes; status is always healthy"""
+        ordered = sorted(self._samples)
+        return {
+            "loop": type(self._loop).__module__.split(".")[0] if self._loop is not None else None,
+            "probes": self._probes,
+            "p50": round(percentile(ordered, 0.50) * 1000, 1),
+            "p90": round(percentile(ordered, 0.90) * 1000, 1),
+            "p99": round(percentile(ordered, 0.99) * 1000, 1),
+            "max": round(self._max_lag * 1000, 1),
+            "stalls": self._stalls
+        }, True
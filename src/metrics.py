@@ -0,0 +1,190 @@
+""" Module for Prometheus metrics
+
+A small, dependency-free implementation of counters, gauges and histograms
+with the Prometheus text exposition format. Recording a value is a dictionary lookup
+and an addition, so the metrics can be used on the hot path.
+"""
+
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Optional
+
+import math
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+"""Latency buckets in seconds"""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: Optional[tuple] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'%s="%s"' % (name, _escape(value)) for name, value in pairs) + "}"
+
+
+class _Metric(ABC):
+    TYPE = None
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def _key(self, labels: dict) -> tuple:
+        if len(labels) != len(self.labels):
+            raise ValueError("Metric %s requires the labels %s" % (self.name, str(self.labels)))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    @abstractmethod
+    def samples(self) -> list[str]:
+        pass
+
+    def render(self) -> str:
+        return "\n".join([
+            f"# HELP %s %s" % (self.name, self.documentation),
+            f"# TYPE %s %s" % (self.name, self.TYPE)
+        ] + self.samples())
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        super().__init__(name, documentation, labels)
+        self._values = dict()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        return [f"%s%s %s" % (self.name, _format_labels(self.labels, key), _format_value(value))
+                for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Gauge, either set directly or read from a callback when rendered"""
+    TYPE = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (),
+                 callback: Optional[Callable[[], float]] = None):
+        if callback is not None and labels:
+            raise ValueError("Gauges with a callback cannot have labels!")
+        super().__init__(name, documentation, labels)
+        self._values = dict()
+        self._callback = callback
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        if self._callback is not None:
+            return self._callback()
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        if self._callback is not None:
+            return [f"%s %s" % (self.name, _format_value(self._callback()))]
+        return [f"%s%s %s" % (self.name, _format_labels(self.labels, key), _format_value(value))
+                for key, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        if list(buckets) != sorted(buckets) or not buckets:
+            raise ValueError("Buckets must be sorted and not empty!")
+        super().__init__(name, documentation, labels)
+        self._buckets = tuple(buckets) + (math.inf,)
+        self._values = dict()
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._values.get(key, None)
+        if series is None:
+            # Bucket counts (not cumulative), sum
+            series = [[0] * len(self._buckets), 0.0]
+            self._values[key] = series
+        series[0][bisect_left(self._buckets, value)] += 1
+        series[1] += value
+
+    def count(self, **labels) -> int:
+        series = self._values.get(self._key(labels), None)
+        return sum(series[0]) if series else 0
+
+    def samples(self) -> list[str]:
+        lines = list()
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self._buckets, counts):
+                cumulative += count
+                lines.append(f"%s_bucket%s %i" % (self.name,
+                                                  _format_labels(self.labels, key, ("le", _format_value(bound))),
+                                                  cumulative))
+            lines.append(f"%s_sum%s %s" % (self.name, _format_labels(self.labels, key), _format_value(total)))
+            lines.append(f"%s_count%s %i" % (self.name, _format_labels(self.labels, key), cumulative))
+        return lines
+
+
+class MetricsRegistry(object):
+    """Collection of metrics, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = dict()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name, None)
+        if existing is not None:
+            if type(existing) is not type(metric) or existing.labels != metric.labels:
+                raise ValueError("Metric %s is already registered with another type or labels!" % metric.name)
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: tuple = (),
+              callback: Optional[Callable[[], float]] = None) -> Gauge:
+        """Create a gauge; registering a callback gauge again replaces the callback"""
+        gauge = Gauge(name, documentation, labels, callback)
+        if callback is not None:
+            self._metrics[name] = gauge
+            return gauge
+        return self._register(gauge)
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+"""Process-wide registry, exposed on the metrics endpoint"""
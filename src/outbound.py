@@ -0,0 +1,178 @@
+""" Module for outbound HTTP calls
+
+All calls to other services (GitHub, Google reCAPTCHA) go through one shared client,
+so that pool size, per-host limits and timeouts are configured in one place.
+"""
+
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import urlsplit
+
+import asyncio
+import contextlib
+import os
+import time
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPResponse
+
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class OutboundConfiguration(object):
+    """Configuration for the outbound HTTP client"""
+    BACKENDS = ["simple", "curl"]  # First value is used as default
+    DEFAULT_MAX_CLIENTS = 10
+    DEFAULT_MAX_PER_HOST = 0
+    DEFAULT_CONNECT_TIMEOUT = 10.0
+    DEFAULT_REQUEST_TIMEOUT = 30.0
+
+    backend: str = BACKENDS[0]
+    max_clients: int = DEFAULT_MAX_CLIENTS
+    max_per_host: int = DEFAULT_MAX_PER_HOST
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT
+    request_timeout: float = DEFAULT_REQUEST_TIMEOUT
+
+    @staticmethod
+    def from_environment():
+        return OutboundConfiguration(
+            backend=os.getenv("HTTP_BACKEND", OutboundConfiguration.BACKENDS[0]),
+            max_clients=int(os.getenv("HTTP_MAX_CLIENTS", OutboundConfiguration.DEFAULT_MAX_CLIENTS)),
+            max_per_host=int(os.getenv("HTTP_MAX_PER_HOST", OutboundConfiguration.DEFAULT_MAX_PER_HOST)),
+            connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", OutboundConfiguration.DEFAULT_CONNECT_TIMEOUT)),
+            request_timeout=float(os.getenv("HTTP_REQUEST_TIMEOUT", OutboundConfiguration.DEFAULT_REQUEST_TIMEOUT))
+        )
+
+    def __post_init__(self):
+        if self.backend not in OutboundConfiguration.BACKENDS:
+            raise ValueError("HTTP_BACKEND (backend) must be one of %s" % str(OutboundConfiguration.BACKENDS))
+
+        if self.max_clients < 1:
+            raise ValueError("HTTP_MAX_CLIENTS (max_clients) must be positive!")
+
+        if self.max_per_host < 0:
+            raise ValueError("HTTP_MAX_PER_HOST (max_per_host) must not be negative!")
+
+        if self.connect_timeout <= 0 or self.request_timeout <= 0:
+            raise ValueError("HTTP timeouts must be positive!")
+
+    def client_impl(self) -> Optional[str]:
+        if self.backend == "curl":
+            try:
+                import pycurl  # noqa: F401
+            except ImportError:
+                raise ValueError("HTTP_BACKEND curl requires the pycurl package!")
+            return "tornado.curl_httpclient.CurlAsyncHTTPClient"
+
+        return None
+
+
+class OutboundClient(object):
+    """Shared outbound HTTP client
+
+    Requests may wait twice before they hit the network: for a per-host slot (if limited)
+    and in the Tornado client queue (when all max_clients are busy).
+    Both waits are reported as queue time, separately from the network time.
+    """
+
+    def __init__(self, cfg: OutboundConfiguration):
+        if cfg is None:
+            raise ValueError("Outbound configuration must be provided!")
+        self._cfg = cfg
+
+        self._host_slots = dict()
+        self._in_flight = 0
+        self._requests = 0
+        self._queue_time = 0.0
+        self._network_time = 0.0
+        self._max_queue_time = 0.0
+
+    def configure(self) -> None:
+        """Configure the Tornado HTTP client (must happen before the first request)"""
+        AsyncHTTPClient.configure(self._cfg.client_impl(),
+                                  max_clients=self._cfg.max_clients,
+                                  defaults={
+                                      "connect_timeout": self._cfg.connect_timeout,
+                                      "request_timeout": self._cfg.request_timeout
+                                  })
+        LOGGER.info("Outbound HTTP client: %s backend, %i clients, %s per host",
+                    self._cfg.backend, self._cfg.max_clients, self._cfg.max_per_host or "unlimited")
+
+    async def fetch(self, request: HTTPRequest, **kwargs) -> HTTPResponse:
+        start = time.monotonic()
+        acquired = None
+        response = None
+        self._in_flight += 1
+        try:
+            async with self._host_slot(urlsplit(request.url).hostname):
+                acquired = time.monotonic()
+                response = await AsyncHTTPClient().fetch(request, **kwargs)
+            return response
+        finally:
+            self._in_flight -= 1
+            # Failed calls (e.g. timeouts) are recorded as well, they are often the slow ones
+            if acquired is not None:
+                # The Tornado clients measure the request time from leaving their queue
+                in_client = time.monotonic() - acquired
+                request_time = response.request_time if response is not None else None
+                network = request_time if request_time is not None else in_client
+                self._record(acquired - start + max(in_client - network, 0.0), network)
+
+    def _host_slot(self, host: str):
+        if not self._cfg.max_per_host:
+            return contextlib.nullcontext()
+
+        slot = self._host_slots.get(host, None)
+        if slot is None:
+            slot = asyncio.Semaphore(self._cfg.max_per_host)
+            self._host_slots[host] = slot
+        return slot
+
+    def _record(self, queue: float, network: float) -> None:
+        self._requests += 1
+        self._queue_time += queue
+        self._network_time += network
+        self._max_queue_time = max(self._max_queue_time, queue)
+
+    def get_health(self) -> tuple[dict, bool]:
+        """Return the client statistics; status is always healthy"""
+        return {
+            "backend": self._cfg.backend,
+            "max-clients": self._cfg.max_clients,
+            "in-flight": self._in_flight,
+            "requests": self._requests,
+            "queue-ms-avg": round(self._queue_time * 1000 / self._requests, 1) if self._requests else 0.0,
+            "queue-ms-max": round(self._max_queue_time * 1000, 1),
+            "network-ms-avg": round(self._network_time * 1000 / self._requests, 1) if self._requests else 0.0
+        }, True
+
+
+_CLIENT = None
+
+
+def setup(cfg: OutboundConfiguration) -> OutboundClient:
+    """Configure and install the shared outbound client"""
+    global _CLIENT
+
+    client = OutboundClient(cfg)
+    client.configure()
+    _CLIENT = client
+
+    return client
+
+
+def client() -> OutboundClient:
+    """Return the shared outbound client, with default settings if not set up"""
+    global _CLIENT
+
+    if _CLIENT is None:
+        _CLIENT = OutboundClient(OutboundConfiguration())
+
+    return _CLIENT
+
+
+async def fetch(request: HTTPRequest, **kwargs) -> HTTPResponse:
+    """Fetch a request through the shared outbound client"""
+    return await client().fetch(request, **kwargs)
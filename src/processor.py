@@ -1,14 +1,111 @@
 """ Module for comment processing """
 
 import form
-from github import GithubConfiguration, GithubUpload, GithubPR, GithubDefaultRef, GithubCreateBranch, GithubLabel
+import github
+import timing
+from github import GithubConfiguration, GithubUpload, GithubPR, GithubDefaultRef, GithubCreateBranch, GithubLabel, \
+    GithubCommitTree, GithubCreateTree, GithubCreateCommit, GithubGraphQLRepository, GithubGraphQLCommitPR, \
+    GithubGraphQLLabel, GithubGetBranch, GithubGetContent, GithubFindPR
 
-from typing import Optional
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional, Callable, Awaitable, Any
+
+import asyncio
+import json
+import os
+import random
+
+import tornado.ioloop
+from tornado.httpclient import HTTPClientError
 
 import logging
 
 LOGGER = logging.getLogger(__name__)
 
+TRANSIENT_ERRORS = (OSError, json.JSONDecodeError, HTTPClientError, github.GithubAuthenticationError)
+"""Errors of a pipeline stage that may not occur when the stage is repeated"""
+
+
+@dataclass(frozen=True)
+class ProcessorConfiguration(object):
+    """Configuration for the comment processor"""
+    DEFAULT_DIGEST_WINDOW = 0.0
+    DEFAULT_DIGEST_SIZE = 20
+    DEFAULT_RETRIES = 3
+    DEFAULT_BACKOFF = 0.5
+    DEFAULT_BACKOFF_MAX = 8.0
+    DEFAULT_POST_COMMIT_MAX = 100
+    DEFAULT_POST_COMMIT_RETRIES = 5
+    DEFAULT_POST_COMMIT_BACKOFF = 2.0
+    DEFAULT_POST_COMMIT_BACKOFF_MAX = 60.0
+    DEFAULT_POST_COMMIT_DRAIN = 10.0
+
+    digest_window: float = DEFAULT_DIGEST_WINDOW
+    digest_size: int = DEFAULT_DIGEST_SIZE
+    retries: int = DEFAULT_RETRIES
+    backoff: float = DEFAULT_BACKOFF
+    backoff_max: float = DEFAULT_BACKOFF_MAX
+    post_commit_max: int = DEFAULT_POST_COMMIT_MAX
+    post_commit_retries: int = DEFAULT_POST_COMMIT_RETRIES
+    post_commit_backoff: float = DEFAULT_POST_COMMIT_BACKOFF
+    post_commit_backoff_max: float = DEFAULT_POST_COMMIT_BACKOFF_MAX
+    post_commit_drain: float = DEFAULT_POST_COMMIT_DRAIN
+
+    @staticmethod
+    def from_environment():
+        return ProcessorConfiguration(
+            digest_window=float(os.getenv("DIGEST_WINDOW", ProcessorConfiguration.DEFAULT_DIGEST_WINDOW)),
+            digest_size=int(os.getenv("DIGEST_SIZE", ProcessorConfiguration.DEFAULT_DIGEST_SIZE)),
+            retries=int(os.getenv("PIPELINE_RETRIES", ProcessorConfiguration.DEFAULT_RETRIES)),
+            backoff=float(os.getenv("PIPELINE_BACKOFF", ProcessorConfiguration.DEFAULT_BACKOFF)),
+            backoff_max=float(os.getenv("PIPELINE_BACKOFF_MAX", ProcessorConfiguration.DEFAULT_BACKOFF_MAX)),
+            post_commit_max=int(os.getenv("POST_COMMIT_MAX", ProcessorConfiguration.DEFAULT_POST_COMMIT_MAX)),
+            post_commit_retries=int(os.getenv("POST_COMMIT_RETRIES",
+                                              ProcessorConfiguration.DEFAULT_POST_COMMIT_RETRIES)),
+            post_commit_backoff=float(os.getenv("POST_COMMIT_BACKOFF",
+                                                ProcessorConfiguration.DEFAULT_POST_COMMIT_BACKOFF)),
+            post_commit_backoff_max=float(os.getenv("POST_COMMIT_BACKOFF_MAX",
+                                                    ProcessorConfiguration.DEFAULT_POST_COMMIT_BACKOFF_MAX)),
+            post_commit_drain=float(os.getenv("POST_COMMIT_DRAIN", ProcessorConfiguration.DEFAULT_POST_COMMIT_DRAIN))
+        )
+
+    def __post_init__(self):
+        if self.digest_window < 0:
+            raise ValueError("DIGEST_WINDOW (digest_window) must not be negative!")
+
+        if self.digest_size < 1:
+            raise ValueError("DIGEST_SIZE (digest_size) must be at least 1!")
+
+        if self.retries < 0:
+            raise ValueError("PIPELINE_RETRIES (retries) must not be negative!")
+
+        if self.backoff < 0 or self.backoff_max < self.backoff:
+            raise ValueError("PIPELINE_BACKOFF must not be negative and not exceed PIPELINE_BACKOFF_MAX!")
+
+        if self.post_commit_max < 1:
+            raise ValueError("POST_COMMIT_MAX (post_commit_max) must be at least 1!")
+
+        if self.post_commit_retries < 0:
+            raise ValueError("POST_COMMIT_RETRIES (post_commit_retries) must not be negative!")
+
+        if self.post_commit_backoff < 0 or self.post_commit_backoff_max < self.post_commit_backoff:
+            raise ValueError("POST_COMMIT_BACKOFF must not be negative and not exceed POST_COMMIT_BACKOFF_MAX!")
+
+        if self.post_commit_drain < 0:
+            raise ValueError("POST_COMMIT_DRAIN (post_commit_drain) must not be negative!")
+
+    def backoff_delay(self, retry: int) -> float:
+        """Jittered exponential back-off before the given retry (starting at 1)"""
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** (retry - 1)))
+
+    def post_commit_delay(self, retry: int) -> float:
+        """Jittered exponential back-off before the given retry of a post-commit task (starting at 1)"""
+        return random.uniform(0, min(self.post_commit_backoff_max, self.post_commit_backoff * 2 ** (retry - 1)))
+
+    def is_digest_enabled(self) -> bool:
+        return self.digest_window > 0
+
 
 class CommentFormatter(object):
     def __init__(self, cmt: form.Comment):
@@ -40,6 +137,9 @@ message: |
     def commit_path(self) -> str:
         return "_data/comments/%s/%s.yml" % (self._cmt.slug, self._cmt.cid)
 
+    def files(self) -> dict[str, str]:
+        return {self.commit_path(): self.file_content()}
+
     def commit_message(self) -> str:
         return "Comment %s" % self._cmt.cid
 
@@ -47,9 +147,12 @@ message: |
         return "Blog Comment %s" % self._cmt.cid
 
     def pr_body(self) -> str:
-        return f"""\
-Please consider this blog comment.
+        return "Please consider this blog comment.\n\n" + self.pr_details()
 
+    def pr_details(self) -> str:
+        """Meta data and message of the comment for the PR body"""
+        warning = "**Possible spam:** %s\n\n" % self._cmt.spam if self._cmt.spam else ""
+        return warning + f"""\
 ## Meta Data
 
 Slug: %s
@@ -70,54 +173,550 @@ URL: %s
         )
 
 
+class DigestFormatter(object):
+    """Format a batch of comments for a single commit and PR"""
+
+    def __init__(self, cmts: list[form.Comment]):
+        if not cmts:
+            raise ValueError("Comments must not be empty!")
+        self._formatters = [CommentFormatter(cmt) for cmt in cmts]
+        self._cmts = cmts
+
+    def branch_name(self) -> str:
+        return "comments-%s" % self._cmts[0].cid
+
+    def files(self) -> dict[str, str]:
+        files = dict()
+        for formatter in self._formatters:
+            files |= formatter.files()
+        return files
+
+    def commit_message(self) -> str:
+        return "Comments %s" % ", ".join(str(cmt.cid) for cmt in self._cmts)
+
+    def pr_title(self) -> str:
+        return "Blog Comments %s (%i)" % (self._cmts[0].cid, len(self._cmts))
+
+    def pr_body(self) -> str:
+        return "Please consider these %i blog comments.\n\n%s" % (
+            len(self._cmts),
+            "\n\n".join("# Comment %s\n\n%s" % (cmt.cid, formatter.pr_details())
+                         for cmt, formatter in zip(self._cmts, self._formatters))
+        )
+
+
+@dataclass(frozen=True)
+class Prefetch(object):
+    """Results of the read-only GitHub calls that can be made before the comment is accepted"""
+    head: Optional[str] = None
+    tree: Optional[str] = None
+    ids: Optional[tuple[str, Optional[str]]] = None
+
+
+class CommentDigest(object):
+    """Collect comments for a time window or up to a maximum number and process them as one batch
+
+    Each submitter waits for the result of the batch its comment ended up in.
+    """
+
+    def __init__(self,
+                 window: float,
+                 size: int,
+                 batch_cb: Callable[[list[form.Comment]], Awaitable[Optional[int]]]):
+        self._window = window
+        self._size = size
+        self._cb = batch_cb
+
+        self._pending = list()
+        self._timeout = None
+        self._batches = set()
+
+    async def submit(self, cmt: form.Comment) -> Optional[int]:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((cmt, future))
+
+        if len(self._pending) >= self._size:
+            self.flush()
+        elif self._timeout is None:
+            self._timeout = tornado.ioloop.IOLoop.current().call_later(self._window, self.flush)
+
+        return await future
+
+    def flush(self) -> None:
+        """Process all pending comments now"""
+        if self._timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+
+        if not self._pending:
+            return
+
+        batch = asyncio.ensure_future(self._process(self._pending))
+        self._batches.add(batch)
+        batch.add_done_callback(self._batches.discard)
+        self._pending = list()
+
+    async def _process(self, pending) -> None:
+        LOGGER.info("Processing digest of %i comments", len(pending))
+        try:
+            issue = await self._cb([cmt for cmt, _ in pending])
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for _, future in pending:
+            if not future.done():
+                future.set_result(issue)
+
+
+class PostCommitRunner(object):
+    """Run the follow-up tasks of a created PR (e.g. adding the label) in the background
+
+    The comment processing does not wait for these tasks, so they are off the response path.
+    Up to `post_commit_max` tasks are pending at once, further tasks are dropped, as they are not essential.
+    A failing task is retried with jittered exponential back-off as long as its error is transient.
+    """
+
+    def __init__(self, proc_cfg: ProcessorConfiguration):
+        self._cfg = proc_cfg
+
+        self._tasks = set()
+        self._done = 0
+        self._failed = 0
+        self._dropped = 0
+
+    def submit(self, name: str, task: Callable[[], Awaitable[Any]]) -> bool:
+        """Schedule a task, which returns a falsy value on failure
+
+        :param name: Task name for logging
+        :param task: Carry out the task
+        :return: False if the task has been dropped
+        """
+        if len(self._tasks) >= self._cfg.post_commit_max:
+            self._dropped += 1
+            LOGGER.error("Too many post-commit tasks, dropping %s", name)
+            return False
+
+        future = asyncio.ensure_future(self._run(name, task))
+        self._tasks.add(future)
+        future.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _run(self, name: str, task: Callable[[], Awaitable[Any]]) -> None:
+        retry = 0
+        while True:
+            try:
+                result = await task()
+                transient = github.is_transient(github.last_status())
+            except TRANSIENT_ERRORS as e:
+                LOGGER.warning("Post-commit task %s failed: %s", name, str(e))
+                result, transient = None, True
+            except Exception as e:
+                LOGGER.exception("Post-commit task %s raised an error: %s", name, str(e))
+                result, transient = None, False
+
+            if result:
+                self._done += 1
+                return
+
+            if not transient or retry >= self._cfg.post_commit_retries:
+                self._failed += 1
+                LOGGER.error("Post-commit task %s failed after %i attempts", name, retry + 1)
+                return
+
+            retry += 1
+            delay = self._cfg.post_commit_delay(retry)
+            LOGGER.warning("Post-commit task %s failed, retry %i/%i in %.2f seconds",
+                           name, retry, self._cfg.post_commit_retries, delay)
+            await asyncio.sleep(delay)
+
+    async def drain(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the pending tasks, including those submitted meanwhile
+
+        :param timeout: Seconds after which the remaining tasks are cancelled, default `post_commit_drain`
+        :return: True if all tasks have finished
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (self._cfg.post_commit_drain if timeout is None else timeout)
+
+        while self._tasks:
+            _, pending = await asyncio.wait(set(self._tasks), timeout=max(deadline - loop.time(), 0))
+            if pending and loop.time() >= deadline:
+                LOGGER.error("Cancelling %i unfinished post-commit tasks", len(pending))
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                return False
+
+        return True
+
+    def get_health(self) -> dict:
+        return {
+            "in-flight": len(self._tasks),
+            "done": self._done,
+            "failed": self._failed,
+            "dropped": self._dropped
+        }
+
+
 class CommentProcessor(object):
-    def __init__(self, cfg: GithubConfiguration):
+    """Turn comments into GitHub PRs
+
+    The pipeline is split into stages (branch, upload, PR). Each stage is retried with
+    jittered exponential back-off on transient errors and checks for state left by an earlier
+    attempt (existing branch, file or PR), so that a repeated comment resumes instead of failing.
+    The label is added afterwards by the post-commit runner.
+    """
+
+    def __init__(self, cfg: GithubConfiguration, proc_cfg: Optional[ProcessorConfiguration] = None):
         if cfg is None:
             raise ValueError("Configuration must be provided!")
         self._cfg = cfg
+        self._proc_cfg = proc_cfg if proc_cfg is not None else ProcessorConfiguration()
 
-    async def comment_to_github_pr(self, cmt: form.Comment) -> Optional[int]:
-        formatter = CommentFormatter(cmt)
+        self._retries = Counter()
+        self._resumed = Counter()
+        self.post_commit = PostCommitRunner(self._proc_cfg)
+
+        self._digest = None
+        self._digest_cb = self.digest_to_github_pr
+        if self._proc_cfg.is_digest_enabled():
+            self._digest = CommentDigest(self._proc_cfg.digest_window,
+                                         self._proc_cfg.digest_size,
+                                         lambda cmts: self._digest_cb(cmts))
+
+    def is_digest_enabled(self) -> bool:
+        return self._digest is not None
+
+    def gate_digests(self, wrap: Callable[[Callable[..., Awaitable[Any]]], Callable[..., Awaitable[Any]]]) -> None:
+        """Process the digests behind a gate, e.g. AdmissionGate.wrap
+
+        Comments in digest mode only wait for their digest, so the digest is gated instead of each comment.
+        """
+        self._digest_cb = wrap(self.digest_to_github_pr)
 
-        if not await self._create_branch(formatter):
+    def resources(self) -> tuple[str, ...]:
+        """GitHub rate limit resources used by the comments (digests always use the REST API)"""
+        if self._cfg.engine == "graphql" and not self._digest:
+            return github.GithubApiFunction.RESOURCE, github.GithubGraphQL.RESOURCE
+        return github.GithubApiFunction.RESOURCE,
+
+    async def prefetch(self) -> Prefetch:
+        """Make the read-only GitHub calls of the pipeline ahead, e.g. while the captcha is verified
+
+        This has no side effects and can be cancelled at any time. Failed calls leave the respective
+        result empty, the pipeline then repeats them.
+        """
+        if self._digest:
+            # Digests are committed later on a then current head
+            return Prefetch()
+
+        with timing.stage("prefetch"):
+            if self._cfg.engine == "graphql":
+                head, ids = await asyncio.gather(self._default_head(),
+                                                 GithubGraphQLRepository(self._cfg).ids(),
+                                                 return_exceptions=True)
+                return Prefetch(head=CommentProcessor._prefetched(head), ids=CommentProcessor._prefetched(ids))
+
+            head = CommentProcessor._prefetched(await self._gather(self._default_head()))
+            tree = None
+            if head is not None and self._cfg.engine == "gitdata":
+                tree = CommentProcessor._prefetched(await self._gather(GithubCommitTree(self._cfg, head).tree_sha()))
+            return Prefetch(head=head, tree=tree)
+
+    @staticmethod
+    async def _gather(call: Awaitable[Any]) -> Any:
+        return (await asyncio.gather(call, return_exceptions=True))[0]
+
+    @staticmethod
+    def _prefetched(result: Any) -> Any:
+        if isinstance(result, BaseException):
+            if not isinstance(result, TRANSIENT_ERRORS):
+                raise result
+            LOGGER.warning("Prefetch failed: %s", str(result))
             return None
+        return result
+
+    async def comment_to_github_pr(self, cmt: form.Comment, prefetched: Optional[Prefetch] = None) -> Optional[int]:
+        """Create a PR for a comment
+
+        :param cmt: The comment
+        :param prefetched: (Optional) Results of an earlier prefetch
+        """
+        if self._digest:
+            return await self._digest.submit(cmt)
+
+        formatter = CommentFormatter(cmt)
+        if prefetched is None:
+            prefetched = Prefetch()
+
+        if self._cfg.engine == "graphql":
+            return await self._graphql_pr(formatter, prefetched)
+
+        if self._cfg.engine == "gitdata":
+            if not await self._commit_tree(formatter, prefetched=prefetched):
+                return None
+        else:
+            if not await self._create_branch(formatter, prefetched=prefetched):
+                return None
+
+            if not await self._upload_file(formatter):
+                return None
+
+        issue = await self._create_pr(formatter)
+        self._add_label(formatter, issue)
+
+        return issue
+
+    async def digest_to_github_pr(self, cmts: list[form.Comment]) -> Optional[int]:
+        """Commit several comments on one branch and open a single PR for them"""
+        formatter = DigestFormatter(cmts)
 
-        if not await self._upload_file(formatter):
+        # The Contents API cannot commit several files at once, so digests always use the Git Data API
+        if not await self._commit_tree(formatter):
             return None
 
         issue = await self._create_pr(formatter)
+        self._add_label(formatter, issue)
+
+        return issue
+
+    def get_health(self) -> tuple[dict, bool]:
+        """Return the retry and resume counts per stage and the post-commit tasks; status is always healthy"""
+        return {
+            "retries": dict(self._retries),
+            "resumed": dict(self._resumed),
+            "post-commit": self.post_commit.get_health()
+        }, True
+
+    async def _stage(self,
+                     name: str,
+                     branch: str,
+                     attempt: Callable[[], Awaitable[Any]],
+                     resume: Optional[Callable[[], Awaitable[Any]]] = None) -> Any:
+        """Run a pipeline stage
+
+        :param name: Stage name for logs and statistics
+        :param branch: Branch of the processed comment(s), used for logging
+        :param attempt: Carry out the stage, returns a falsy value on failure
+        :param resume: Look for the result of an earlier attempt, returns a falsy value if there is none
+        """
+        with timing.stage(name):
+            return await self._run_stage(name, branch, attempt, resume)
+
+    async def _run_stage(self, name, branch, attempt, resume) -> Any:
+        retry = 0
+        while True:
+            try:
+                result = await attempt()
+                transient = github.is_transient(github.last_status())
+            except TRANSIENT_ERRORS as e:
+                LOGGER.warning("Stage %s of %s failed: %s", name, branch, str(e))
+                result, transient = None, True
+
+            if result:
+                return result
+
+            if resume is not None:
+                try:
+                    existing = await resume()
+                except TRANSIENT_ERRORS:
+                    existing = None
+                if existing:
+                    LOGGER.info("Stage %s of %s has already been done, resuming", name, branch)
+                    self._resumed[name] += 1
+                    return existing
+
+            if not transient or retry >= self._proc_cfg.retries:
+                return result
+
+            retry += 1
+            self._retries[name] += 1
+            delay = self._proc_cfg.backoff_delay(retry)
+            LOGGER.warning("Stage %s of %s failed, retry %i/%i in %.2f seconds",
+                           name, branch, retry, self._proc_cfg.retries, delay)
+            await asyncio.sleep(delay)
+
+    async def _graphql_pr(self, formatter, prefetched: Prefetch) -> Optional[int]:
+        """Create branch, commit and PR with one batch of GraphQL mutations"""
+        ids = prefetched.ids or await self._stage("repository", formatter.branch_name(),
+                                                  GithubGraphQLRepository(self._cfg).ids)
+        if ids is None:
+            return None
+        repository_id, label_id = ids
+
+        async def commit_pr():
+            main_head = prefetched.head or await self._default_head()
+            if main_head is None:
+                return None
+
+            return await GithubGraphQLCommitPR(
+                self._cfg,
+                repository_id=repository_id,
+                sha=main_head,
+                branch=formatter.branch_name(),
+                files=formatter.files(),
+                message=formatter.commit_message(),
+                title=formatter.pr_title(),
+                base=self._cfg.branch,
+                body=formatter.pr_body()
+            ).create()
+
+        pr = await self._stage("pr", formatter.branch_name(), commit_pr, self._find_pr(formatter))
+        if not pr:
+            return None
+        issue, pr_id = pr
 
         # Failed label does not kill the whole process
-        if issue and GithubLabel.applicable(self._cfg):
-            if not await GithubLabel(self._cfg, issue).add():
-                LOGGER.error("Could not add label!")
+        if GithubLabel.applicable(self._cfg):
+            if label_id is None:
+                LOGGER.error("Could not add label, it does not exist!")
+            else:
+                self.post_commit.submit("label on %s" % formatter.branch_name(),
+                                        GithubGraphQLLabel(self._cfg, pr_id, label_id).add)
 
         return issue
 
-    async def _create_branch(self, formatter) -> bool:
-        main_head = await GithubDefaultRef(self._cfg).default_head()
-        return await GithubCreateBranch(
-            self._cfg,
-            branch=formatter.branch_name(),
-            sha=main_head
-        ).create_branch()
+    def _find_pr(self, formatter) -> Callable[[], Awaitable[Optional[tuple[int, str]]]]:
+        return GithubFindPR(self._cfg, head=formatter.branch_name()).find
+
+    def _branch_exists(self, formatter) -> Callable[[], Awaitable[bool]]:
+        async def exists():
+            return await GithubGetBranch(self._cfg, branch=formatter.branch_name()).head() is not None
+        return exists
+
+    def _add_label(self, formatter, issue: Optional[int]) -> None:
+        # Failed label does not kill the whole process, so it is added after the response
+        if issue and GithubLabel.applicable(self._cfg):
+            self.post_commit.submit("label on %s" % formatter.branch_name(), GithubLabel(self._cfg, issue).add)
+
+    async def _default_head(self) -> Optional[str]:
+        with timing.stage("ref"):
+            return await GithubDefaultRef(self._cfg).default_head()
+
+    async def _on_default_head(self, action, head: Optional[str] = None) -> bool:
+        """Run an action on the default branch head.
+
+        The head may come from the cache or a prefetch. If the action fails, the head is looked up again
+        and the action is retried once if the head turned out to be stale.
+        """
+        main_head = head or await self._default_head()
+        if main_head is None:
+            return False
+
+        if await action(main_head):
+            return True
+
+        # A stale head cannot be the reason for a transient error, keep its status for the retry decision
+        if github.is_transient(github.last_status()):
+            return False
+
+        GithubDefaultRef.invalidate(self._cfg)
+        fresh_head = await self._default_head()
+        if fresh_head is None or fresh_head == main_head:
+            return False
+
+        LOGGER.warning("Default head %s was stale, retrying with %s", main_head, fresh_head)
+        return await action(fresh_head)
+
+    async def _create_branch(self, formatter, prefetched: Optional[Prefetch] = None) -> bool:
+        if prefetched is None:
+            prefetched = Prefetch()
+
+        async def create_branch(main_head):
+            return await GithubCreateBranch(
+                self._cfg,
+                branch=formatter.branch_name(),
+                sha=main_head
+            ).create_branch()
+
+        return await self._stage("branch", formatter.branch_name(),
+                                 lambda: self._on_default_head(create_branch, prefetched.head),
+                                 self._branch_exists(formatter))
 
     async def _upload_file(self, formatter) -> bool:
-        return await GithubUpload(
+        async def file_exists():
+            return await GithubGetContent(
+                self._cfg,
+                branch=formatter.branch_name(),
+                path=formatter.commit_path()
+            ).sha() is not None
+
+        return await self._stage("upload", formatter.branch_name(),
+                                 GithubUpload(
+                                     self._cfg,
+                                     branch=formatter.branch_name(),
+                                     path=formatter.commit_path(),
+                                     message=formatter.commit_message(),
+                                     committer_name=self._cfg.author,
+                                     committer_email=self._cfg.email,
+                                     content=formatter.file_content()
+                                 ).upload,
+                                 file_exists)
+
+    async def _commit_tree(self, formatter, prefetched: Optional[Prefetch] = None) -> bool:
+        """Build the commit with the Git Data API and point a new branch at it.
+
+        This avoids the Contents API, which GitHub serializes per repository.
+        """
+        if prefetched is None:
+            prefetched = Prefetch()
+
+        async def commit_tree(main_head):
+            # The prefetched tree belongs to the prefetched head only
+            base_tree = prefetched.tree if main_head == prefetched.head else None
+            return await self._commit_tree_on(formatter, main_head, base_tree)
+
+        return await self._stage("commit", formatter.branch_name(),
+                                 lambda: self._on_default_head(commit_tree, prefetched.head),
+                                 self._branch_exists(formatter))
+
+    async def _commit_tree_on(self, formatter, main_head, base_tree: Optional[str] = None) -> bool:
+        if base_tree is None:
+            base_tree = await GithubCommitTree(self._cfg, main_head).tree_sha()
+        if base_tree is None:
+            return False
+
+        tree = await GithubCreateTree(
+            self._cfg,
+            base_tree=base_tree,
+            files=formatter.files()
+        ).create()
+        if tree is None:
+            return False
+
+        commit = await GithubCreateCommit(
             self._cfg,
-            branch=formatter.branch_name(),
-            path=formatter.commit_path(),
             message=formatter.commit_message(),
+            tree=tree,
+            parent=main_head,
             committer_name=self._cfg.author,
-            committer_email=self._cfg.email,
-            content=formatter.file_content()
-        ).upload()
+            committer_email=self._cfg.email
+        ).create()
+        if commit is None:
+            return False
+
+        return await GithubCreateBranch(
+            self._cfg,
+            branch=formatter.branch_name(),
+            sha=commit
+        ).create_branch()
 
     async def _create_pr(self, formatter) -> Optional[int]:
-        return await GithubPR(
-            cfg=self._cfg,
-            head=formatter.branch_name(),
-            base=self._cfg.branch,
-            title=formatter.pr_title(),
-            body=formatter.pr_body()
-        ).create()
+        find_pr = self._find_pr(formatter)
+
+        async def existing_pr():
+            pr = await find_pr()
+            return pr[0] if pr else None
+
+        return await self._stage("pr", formatter.branch_name(),
+                                 GithubPR(
+                                     cfg=self._cfg,
+                                     head=formatter.branch_name(),
+                                     base=self._cfg.branch,
+                                     title=formatter.pr_title(),
+                                     body=formatter.pr_body()
+                                 ).create,
+                                 existing_pr)
@@ -3,51 +3,217 @@
 import signal
 import platform
 import asyncio
+from dataclasses import dataclass
 from functools import partial
 
 import tornado.ioloop
 import tornado.netutil
 import tornado.httpserver
+import tornado.process
 
 from abc import ABCMeta
 import tornado.web
 
 import os
 import subprocess
+import time
 from datetime import datetime
 import isodate
 import weakref
 
 import json
 
-from typing import Callable, Optional, Any, Union
+import metrics
+
+from typing import Callable, Awaitable, Optional, Any, Union
 
 import logging
 LOGGER = logging.getLogger(__name__)
 
 
-def platform_setup() -> None:
-    """Platform-specific setup, especially for asyncio."""
-    if platform.system() == 'Windows':
+@dataclass(frozen=True)
+class LoopConfiguration(object):
+    """Configuration for the event loop implementation"""
+    LOOPS = ("asyncio", "uvloop")
+
+    loop: str = LOOPS[0]
+
+    @staticmethod
+    def from_environment():
+        return LoopConfiguration(
+            loop=os.getenv("SERVICE_LOOP", LoopConfiguration.LOOPS[0])
+        )
+
+    def __post_init__(self):
+        if self.loop not in LoopConfiguration.LOOPS:
+            raise ValueError("SERVICE_LOOP (loop) must be one of %s" % str(LoopConfiguration.LOOPS))
+
+    def policy(self) -> Optional[asyncio.AbstractEventLoopPolicy]:
+        if self.loop == "uvloop":
+            try:
+                import uvloop
+            except ImportError:
+                raise ValueError("SERVICE_LOOP uvloop requires the uvloop package!")
+            return uvloop.EventLoopPolicy()
+
+        return None
+
+
+def platform_setup(cfg: Optional[LoopConfiguration] = None) -> None:
+    """Platform-specific setup, especially for asyncio; must be called before the ioloop is created"""
+    policy = cfg.policy() if cfg is not None else None
+    if policy is not None:
+        asyncio.set_event_loop_policy(policy)
+        LOGGER.info("Event loop: %s", cfg.loop)
+    elif platform.system() == 'Windows':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 
+@dataclass(frozen=True)
+class WorkerConfiguration(object):
+    """Configuration for the worker processes"""
+    DEFAULT_WORKERS = 1
+    DEFAULT_MAX_RESTARTS = 100
+
+    workers: int = DEFAULT_WORKERS
+    max_restarts: int = DEFAULT_MAX_RESTARTS
+
+    @staticmethod
+    def from_environment():
+        return WorkerConfiguration(
+            workers=int(os.getenv("SERVICE_WORKERS", WorkerConfiguration.DEFAULT_WORKERS)),
+            max_restarts=int(os.getenv("SERVICE_MAX_RESTARTS", WorkerConfiguration.DEFAULT_MAX_RESTARTS))
+        )
+
+    def __post_init__(self):
+        if self.workers < 0:
+            raise ValueError("SERVICE_WORKERS (workers) must not be negative!")
+
+        if self.max_restarts < 0:
+            raise ValueError("SERVICE_MAX_RESTARTS (max_restarts) must not be negative!")
+
+    def is_enabled(self) -> bool:
+        return self.workers != 1
+
+    def count(self) -> int:
+        """Number of workers, 0 means one per CPU"""
+        return self.workers or tornado.process.cpu_count()
+
+
+def _stop_workers(sig, _frame):
+    LOGGER.info("%s received, stopping workers" % sig)
+    # The supervisor is part of the process group as well
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    os.killpg(os.getpgrp(), signal.SIGTERM)
+
+
+def fork_workers(cfg: WorkerConfiguration) -> Optional[int]:
+    """Fork the worker processes, if enabled
+
+    The calling process becomes the supervisor: it restarts crashed workers (up to `max_restarts` in total),
+    passes SIGTERM and SIGINT to the workers as SIGTERM and exits when all workers have exited.
+    Must be called before any ioloop, thread or connection is created, as they cannot be shared.
+
+    :return: The task ID of the worker, or None if not enabled
+    """
+    if not cfg.is_enabled():
+        return None
+
+    try:
+        # Own process group, so that only the workers get the signals
+        os.setpgrp()
+    except PermissionError:
+        # Session leaders (e.g. the init process of a container) already lead their group
+        pass
+    signal.signal(signal.SIGTERM, _stop_workers)
+    signal.signal(signal.SIGINT, _stop_workers)
+
+    LOGGER.info("Starting %i workers", cfg.count())
+    task_id = tornado.process.fork_processes(cfg.count(), cfg.max_restarts)
+
+    # Worker: the TerminationGuard takes SIGTERM, SIGINT raises KeyboardInterrupt
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    LOGGER.info("Worker %i started", task_id)
+    return task_id
+
+
+class InFlight(object):
+    """Count operations in flight, e.g. requests, and wait until there are none"""
+
+    def __init__(self):
+        self._count = 0
+        self._waiters = list()
+
+    def enter(self) -> None:
+        self._count += 1
+
+    def exit(self) -> None:
+        self._count -= 1
+        if not self._count:
+            for waiter in self._waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            self._waiters = list()
+
+    def __len__(self) -> int:
+        return self._count
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait until no operation is in flight
+
+        :return: True if none is left, False if the timeout has expired before
+        """
+        if not self._count:
+            return True
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
 class TerminationGuard(object):
-    """Guard the ioloop for termination signals and call clean-up handlers"""
+    """Guard the ioloop for termination signals and shut the service down gracefully
+
+    On the signal, the termination handlers are called (e.g. to stop accepting connections),
+    then the drain handlers are awaited one after the other, each with the time left until the deadline,
+    and finally the ioloop is stopped. Meanwhile the health check fails, so that load balancers stop sending requests.
+    """
+
+    DEFAULT_DEADLINE = 25.0
+
+    def __init__(self, ioloop: Optional[tornado.ioloop.IOLoop] = None, deadline: float = DEFAULT_DEADLINE):
+        """
+
+        :param ioloop: The ioloop to stop
+        :param deadline: Seconds from the signal until the ioloop is stopped, regardless of unfinished drains
+        """
+        if deadline < 0:
+            raise ValueError("Drain deadline must not be negative!")
 
-    def __init__(self, ioloop: Optional[tornado.ioloop.IOLoop] = None):
         self._signal_received = False
+        self._drained = False
         self._handlers = list()
+        self._drain_handlers = list()
         self._ioloop = ioloop
+        self._deadline = deadline
 
         signal.signal(signal.SIGTERM, self._on_signal)
-        tornado.ioloop.PeriodicCallback(self._stop_on_signal, 1000).start()
 
     def is_terminated(self) -> bool:
         """Indicate if the termination signal has been received"""
 
         return self._signal_received
 
+    def is_drained(self) -> bool:
+        """Indicate if the shutdown has finished and the ioloop has been stopped"""
+
+        return self._drained
+
     def terminate(self) -> None:
         """Explicit trigger for the termination signal"""
 
@@ -59,17 +225,42 @@ class TerminationGuard(object):
         if handler is not None:
             self._handlers.append(handler)
 
+    def add_drain_handler(self, handler: Callable[[float], Awaitable[Any]]) -> None:
+        """Add a coroutine to await after the clean-up handlers, it gets the seconds left until the deadline"""
+
+        if handler is not None:
+            self._drain_handlers.append(handler)
+
     def _on_signal(self, sig, _frame):
         LOGGER.info("%s received, stopping server" % sig)
         if not self._signal_received:
-            for hnd in self._handlers:
-                hnd()
-        self._signal_received = True
+            self._signal_received = True
+            if self._ioloop:
+                # Runs the shutdown on the ioloop right away, it is woken up if it waits
+                self._ioloop.add_callback(self._shutdown)
+
+    async def _shutdown(self) -> None:
+        deadline = time.monotonic() + self._deadline
+
+        for hnd in self._handlers:
+            hnd()
+
+        for drain in self._drain_handlers:
+            try:
+                if await drain(max(deadline - time.monotonic(), 0.0)) is False:
+                    LOGGER.warning("Shutting down before everything has been drained")
+            except Exception as e:
+                LOGGER.exception("Drain handler failed: %s", str(e))
+
+        self._drained = True
+        self._ioloop.stop()
+        LOGGER.info("IOLoop stopped")
 
-    def _stop_on_signal(self):
-        if self._signal_received and self._ioloop:
-            self._ioloop.stop()
-            LOGGER.info("IOLoop stopped")
+    def get_health(self) -> tuple[dict, bool]:
+        """Return if the service is shutting down; status is unhealthy then"""
+        return {
+            "draining": self._signal_received
+        }, not self._signal_received
 
 
 class GitHealthProvider(object):
@@ -171,6 +362,14 @@ class HealthHandler(tornado.web.RequestHandler, metaclass=ABCMeta):
         self.set_status(200 if healthy else 500)
 
 
+class MetricsHandler(tornado.web.RequestHandler, metaclass=ABCMeta):
+    """Provide the metrics in the Prometheus text format"""
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.REGISTRY.render())
+
+
 class Oas3Handler(tornado.web.RequestHandler, metaclass=ABCMeta):
     """Return the OAS3 spec for the service endpoint"""
 
@@ -188,18 +387,26 @@ class Oas3Handler(tornado.web.RequestHandler, metaclass=ABCMeta):
 class ServiceEndpoint(object):
     """Open a Tornado HTTP server for the service management API"""
 
-    def __init__(self, listen_port: Optional[int] = 8080):
+    def __init__(self, listen_port: Optional[int] = 8080, reuse_port: bool = False):
+        """
+
+        :param listen_port: Port to listen on
+        :param reuse_port: Bind with SO_REUSEPORT, so that several worker processes can bind the port
+                           and the kernel distributes the connections between them
+        """
         if not isinstance(listen_port, int):
             raise ValueError("Server port must be an integer value!")
 
         self._listen_port = listen_port
+        self._reuse_port = reuse_port
         self._server = None
 
     def setup(self, app: tornado.web.Application) -> None:
         """Set up the server (does not start ioloop)"""
-        sockets = tornado.netutil.bind_sockets(self._listen_port, '')
+        sockets = tornado.netutil.bind_sockets(self._listen_port, '', reuse_port=self._reuse_port)
         server = tornado.httpserver.HTTPServer(app)
         server.add_sockets(sockets)
+        self._server = server
 
         port = None
 
@@ -209,6 +416,7 @@ class ServiceEndpoint(object):
                 port = s.getsockname()[1]
 
     def stop(self) -> None:
-        """Stop the server, if available"""
+        """Stop accepting connections, if available; requests in process are finished"""
         if self._server:
             self._server.stop()
+            LOGGER.info("Server stopped accepting connections")
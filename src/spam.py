@@ -0,0 +1,284 @@
+""" Module for the local spam pre-filter
+
+Comments are scored before any network call with a blocklist, the number of links and (optionally)
+a naive Bayes model. Obvious spam is rejected, suspicious comments are flagged in the PR.
+
+The model is trained offline from comment files, e.g. the files of merged and of closed comment PRs:
+
+    python src/spam.py --spam closed/ --ham merged/ --out spam-model.json
+"""
+
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Optional, Iterable
+
+import argparse
+import json
+import math
+import os
+import pathlib
+import re
+
+import metrics
+
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+VERDICTS = metrics.REGISTRY.counter("comment2gh_spam_verdicts_total",
+                                    "Number of comments scored by the spam filter by verdict (pass, flag, reject)",
+                                    ("verdict",))
+
+TOKEN_PATTERN = re.compile(r"[^\W_]+(?:[.'-][^\W_]+)*")
+LINK_PATTERN = re.compile(r"https?://|www\.", re.IGNORECASE)
+
+
+def tokenize(text: str) -> list[str]:
+    """Lower-case words; domains and words with apostrophes or hyphens are kept as one token"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+@dataclass(frozen=True)
+class SpamConfiguration(object):
+    """Configuration for the spam filter"""
+    DEFAULT_MAX_LINKS = 0
+    DEFAULT_FLAG = 0.5
+    DEFAULT_REJECT = 0.9
+
+    blocklist: Optional[str] = None
+    model: Optional[str] = None
+    max_links: int = DEFAULT_MAX_LINKS
+    flag: float = DEFAULT_FLAG
+    reject: float = DEFAULT_REJECT
+
+    @staticmethod
+    def from_environment():
+        return SpamConfiguration(
+            blocklist=os.getenv("SPAM_BLOCKLIST", None),
+            model=os.getenv("SPAM_MODEL", None),
+            max_links=int(os.getenv("SPAM_MAX_LINKS", SpamConfiguration.DEFAULT_MAX_LINKS)),
+            flag=float(os.getenv("SPAM_FLAG", SpamConfiguration.DEFAULT_FLAG)),
+            reject=float(os.getenv("SPAM_REJECT", SpamConfiguration.DEFAULT_REJECT))
+        )
+
+    def __post_init__(self):
+        if self.max_links < 0:
+            raise ValueError("SPAM_MAX_LINKS (max_links) must not be negative!")
+
+        if not 0 < self.flag <= self.reject:
+            raise ValueError("SPAM_FLAG must be positive and not exceed SPAM_REJECT!")
+
+    def is_enabled(self) -> bool:
+        """Only enabled if at least one check is configured"""
+        return bool(self.blocklist or self.model or self.max_links)
+
+
+class BlocklistMatcher(object):
+    """Find blocked words and domains in one pass over the text (Aho-Corasick automaton)
+
+    Terms only match as a whole, i.e. not as part of a longer word. Matching is case-insensitive.
+    """
+
+    def __init__(self, terms: Iterable[str]):
+        # State 0 is the root; per state: transitions, failure link, matched term lengths
+        self._goto = [dict()]
+        self._fail = [0]
+        self._out = [tuple()]
+
+        for term in terms:
+            term = term.strip().lower()
+            if term:
+                self._add(term)
+        self._link()
+
+    def _add(self, term: str) -> None:
+        state = 0
+        for char in term:
+            nxt = self._goto[state].get(char, None)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append(dict())
+                self._fail.append(0)
+                self._out.append(tuple())
+                self._goto[state][char] = nxt
+            state = nxt
+        self._out[state] += (len(term),)
+
+    def _link(self) -> None:
+        # Breadth-first, so that the failure links of shorter prefixes are known
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[nxt] = fail
+                self._out[nxt] += self._out[fail]
+
+    def __len__(self) -> int:
+        return len(self._goto) - 1
+
+    def find(self, text: str) -> list[str]:
+        """Return the blocked terms in the text"""
+        text = text.lower()
+        goto, fail, out = self._goto, self._fail, self._out
+        found = list()
+
+        state = 0
+        for end, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            for length in out[state]:
+                start = end - length + 1
+                if (start == 0 or not text[start - 1].isalnum()) and \
+                        (end + 1 == len(text) or not text[end + 1].isalnum()):
+                    found.append(text[start:end + 1])
+
+        return found
+
+    @staticmethod
+    def load(path: str):
+        """Load the terms from a file, one per line; lines starting with # are ignored"""
+        with open(path, "r", encoding="utf-8") as f:
+            return BlocklistMatcher(line for line in f if not line.startswith("#"))
+
+
+class NaiveBayesModel(object):
+    """Multinomial naive Bayes over the comment tokens with Laplace smoothing"""
+
+    def __init__(self, model: dict):
+        spam, ham = Counter(model["spam"]), Counter(model["ham"])
+        spam_docs, ham_docs = model["spam_docs"], model["ham_docs"]
+        if spam_docs < 1 or ham_docs < 1:
+            raise ValueError("The model must be trained with spam and ham!")
+
+        vocabulary = len(set(spam) | set(ham))
+        spam_total, ham_total = sum(spam.values()) + vocabulary, sum(ham.values()) + vocabulary
+
+        self._prior = math.log(spam_docs / ham_docs)
+        # Log likelihood ratio per token, unknown tokens do not count
+        self._ratios = {token: math.log((spam[token] + 1) / spam_total) - math.log((ham[token] + 1) / ham_total)
+                        for token in set(spam) | set(ham)}
+
+    def probability(self, tokens: list[str]) -> float:
+        """Probability of the tokens being spam"""
+        ratios = self._ratios
+        log_odds = self._prior + sum(ratios.get(token, 0.0) for token in tokens)
+        if log_odds < -50:
+            return 0.0
+        if log_odds > 50:
+            return 1.0
+        return 1 / (1 + math.exp(-log_odds))
+
+    @staticmethod
+    def train(spam: Iterable[str], ham: Iterable[str]) -> dict:
+        """Count the tokens of spam and ham texts, return the model as JSON serializable dictionary"""
+        model = {"spam_docs": 0, "ham_docs": 0, "spam": Counter(), "ham": Counter()}
+        for key, texts in [("spam", spam), ("ham", ham)]:
+            for text in texts:
+                model[key + "_docs"] += 1
+                model[key].update(tokenize(text))
+        return model
+
+    @staticmethod
+    def load(path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            return NaiveBayesModel(json.load(f))
+
+
+@dataclass(frozen=True)
+class SpamVerdict(object):
+    score: float
+    reasons: list[str] = field(default_factory=list)
+    flag: bool = False
+    reject: bool = False
+
+    def reason(self) -> str:
+        return "score %.2f (%s)" % (self.score, ", ".join(self.reasons))
+
+
+class SpamFilter(object):
+    """Score comments with the configured blocklist, link count and model
+
+    The score is the highest of the single scores, from 0 to 1:
+    a blocklist match scores 1, the links score their number relative to `max_links`,
+    the model scores its spam probability.
+    """
+
+    def __init__(self, cfg: SpamConfiguration):
+        if cfg is None or not cfg.is_enabled():
+            raise ValueError("Enabled spam configuration must be provided!")
+
+        self._cfg = cfg
+        self._blocklist = BlocklistMatcher.load(cfg.blocklist) if cfg.blocklist else None
+        self._model = NaiveBayesModel.load(cfg.model) if cfg.model else None
+        if self._blocklist is not None:
+            LOGGER.info("Spam blocklist with %i states loaded", len(self._blocklist))
+
+        self._verdicts = Counter()
+
+    def classify(self, message: str, url: Optional[str] = None) -> SpamVerdict:
+        score, reasons = 0.0, list()
+        text = message if not url else message + "\n" + url
+
+        if self._blocklist is not None:
+            found = self._blocklist.find(text)
+            if found:
+                score = 1.0
+                reasons.append("blocked: " + ", ".join(sorted(set(found))))
+
+        if self._cfg.max_links:
+            links = len(LINK_PATTERN.findall(message)) + (1 if url else 0)
+            if links:
+                score = max(score, min(1.0, links / self._cfg.max_links))
+                reasons.append("%i links" % links)
+
+        if self._model is not None and score < self._cfg.reject:
+            probability = self._model.probability(tokenize(text))
+            score = max(score, probability)
+            reasons.append("model %.2f" % probability)
+
+        verdict = SpamVerdict(score=score,
+                              reasons=reasons,
+                              flag=score >= self._cfg.flag,
+                              reject=score >= self._cfg.reject)
+
+        result = "reject" if verdict.reject else "flag" if verdict.flag else "pass"
+        self._verdicts[result] += 1
+        VERDICTS.inc(verdict=result)
+        return verdict
+
+    def get_health(self) -> tuple[dict, bool]:
+        """Return the number of comments per verdict; status is always healthy"""
+        return {
+            "pass": self._verdicts["pass"],
+            "flag": self._verdicts["flag"],
+            "reject": self._verdicts["reject"]
+        }, True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the spam model from comment files, one comment per file")
+    parser.add_argument("--spam", required=True, nargs="+", help="Directories with spam comments")
+    parser.add_argument("--ham", required=True, nargs="+", help="Directories with legitimate comments")
+    parser.add_argument("--out", required=True, help="Model file to write")
+    args = parser.parse_args()
+
+    def texts(directories):
+        for directory in directories:
+            for path in sorted(pathlib.Path(directory).rglob("*")):
+                if path.is_file():
+                    yield path.read_text(encoding="utf-8", errors="replace")
+
+    model = NaiveBayesModel.train(texts(args.spam), texts(args.ham))
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(model, f)
+    print("Trained with %i spam and %i ham comments" % (model["spam_docs"], model["ham_docs"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+""" Module for stored responses
+
+Responses are kept by key in memory with LRU eviction and a time-to-live,
+optionally also in a SQLite database, so that they survive restarts and are shared between processes.
+"""
+
+from collections import OrderedDict
+from typing import Callable, Awaitable, Optional, Any
+
+import asyncio
+import json
+import sqlite3
+import time
+
+import metrics
+
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+LOOKUPS = metrics.REGISTRY.counter("comment2gh_response_store_lookups_total",
+                                   "Lookups in the response stores by store and result (hit, waited, miss)",
+                                   ("store", "result"))
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open a SQLite database shared by several processes (WAL mode, autocommit)"""
+    db = sqlite3.connect(path, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+class ExpiringStore(object):
+    """Values by key with a time-to-live, the most recently used `size` entries are kept in memory
+
+    With a path, the entries are also written to a SQLite database (WAL mode) and looked up there
+    if they are not in memory. Several stores can share a database, they are separated by name.
+    The values must be JSON serializable.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            store TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            expires REAL NOT NULL,
+            PRIMARY KEY (store, key)
+        )"""
+
+    PRUNE_INTERVAL = 60.0
+    """Seconds between the removal of expired entries from the database"""
+
+    def __init__(self, name: str, size: int, ttl: float, path: Optional[str] = None):
+        if size < 1:
+            raise ValueError("Store size must be at least 1!")
+        if ttl <= 0:
+            raise ValueError("Store TTL must be positive!")
+
+        self._name = name
+        self._size = size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+
+        self._db = None
+        self._pruned = 0.0
+        if path:
+            self._db = connect(path)
+            self._db.execute(ExpiringStore.SCHEMA)
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+
+        entry = self._entries.get(key, None)
+        if entry is not None:
+            expires, value = entry
+            if expires > now:
+                self._entries.move_to_end(key)
+                return value
+            del self._entries[key]
+
+        if self._db is None:
+            return None
+
+        row = self._db.execute("SELECT value, expires FROM entries WHERE store = ? AND key = ? AND expires > ?",
+                               (self._name, key, now)).fetchone()
+        if row is None:
+            return None
+
+        value = json.loads(row[0])
+        self._remember(key, row[1], value)
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        now = time.time()
+        expires = now + self._ttl
+        self._remember(key, expires, value)
+
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO entries (store, key, value, expires) VALUES (?, ?, ?, ?)",
+                             (self._name, key, json.dumps(value), expires))
+            if now - self._pruned > ExpiringStore.PRUNE_INTERVAL:
+                self._pruned = now
+                self._db.execute("DELETE FROM entries WHERE expires <= ?", (now,))
+
+    def _remember(self, key: str, expires: float, value: Any) -> None:
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+
+
+class ResponseStore(object):
+    """Produce a response once per key and answer repeated requests with it
+
+    Requests arriving while the response for their key is produced wait for it.
+    Only successful responses are stored: if producing fails, the waiting requests
+    produce the response themselves, one after the other.
+    """
+
+    def __init__(self, store: ExpiringStore, name: str):
+        self._store = store
+        self._name = name
+        self._pending = dict()
+
+        self._hits = 0
+        self._waited = 0
+        self._misses = 0
+
+    async def run(self, key: str, produce: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        """Return the stored response or produce it
+
+        :param key: Key of the request
+        :param produce: Create the response (not None), raises an exception on failure
+        :return: The response and if it has been produced by an earlier request
+        """
+        while True:
+            response = self._store.get(key)
+            if response is not None:
+                self._count("hit")
+                return response, True
+
+            pending = self._pending.get(key, None)
+            if pending is None:
+                break
+
+            response = await asyncio.shield(pending)
+            if response is None:
+                # The other request failed, try on our own
+                continue
+
+            self._count("waited")
+            return response, True
+
+        self._count("miss")
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        response = None
+        try:
+            response = await produce()
+        finally:
+            del self._pending[key]
+            # None tells the waiting requests that producing failed
+            future.set_result(response)
+
+        try:
+            self._store.put(key, response)
+        except sqlite3.Error as e:
+            LOGGER.error("Could not store the response in %s: %s", self._name, str(e))
+
+        return response, False
+
+    def _count(self, result: str) -> None:
+        if result == "hit":
+            self._hits += 1
+        elif result == "waited":
+            self._waited += 1
+        else:
+            self._misses += 1
+        LOOKUPS.inc(store=self._name, result=result)
+
+    def get_health(self) -> tuple[dict, bool]:
+        """Return the lookup statistics; status is always healthy"""
+        return {
+            "entries": len(self._store),
+            "in-flight": len(self._pending),
+            "hits": self._hits,
+            "waited": self._waited,
+            "misses": self._misses
+        }, True
@@ -0,0 +1,292 @@
+""" Module for request throttling """
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import math
+import os
+import sqlite3
+import time
+
+import metrics
+import store
+
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+LIMITED = metrics.REGISTRY.counter("comment2gh_rate_limited_total",
+                                   "Number of comments rejected by the rate limit by key (ip, slug)",
+                                   ("key",))
+
+
+class TokenBucket(object):
+    """Token bucket with a refill rate per second and a maximum burst"""
+
+    def __init__(self, rate: float, burst: float):
+        if rate <= 0:
+            raise ValueError("Rate must be positive!")
+        if burst < 1:
+            raise ValueError("Burst must be at least 1!")
+
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def tokens(self, now: Optional[float] = None) -> float:
+        self._refill(time.monotonic() if now is None else now)
+        return self._tokens
+
+    def take(self, now: Optional[float] = None) -> float:
+        """Take a token if available
+
+        :return: 0 if a token has been taken, otherwise the seconds until a token is available
+        """
+        self._refill(time.monotonic() if now is None else now)
+
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+
+        return (1 - self._tokens) / self.rate
+
+
+class KeyedTokenBuckets(object):
+    """One token bucket per key, e.g. client address
+
+    Only the most recently used `size` buckets are kept, so that the memory stays bounded
+    also with many (spoofed) keys. A key whose bucket has been evicted starts with a full bucket again.
+    """
+
+    def __init__(self, rate: float, burst: float, size: int):
+        if size < 1:
+            raise ValueError("Size must be at least 1!")
+        # Check the values once, not with every new bucket
+        TokenBucket(rate, burst)
+
+        self.rate = rate
+        self.burst = burst
+        self._size = size
+        self._buckets = OrderedDict()
+
+    def take(self, key: str, now: Optional[float] = None) -> float:
+        """Take a token from the bucket of the key, see TokenBucket.take"""
+        bucket = self._buckets.get(key, None)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self._size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+
+        return bucket.take(now)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class SharedTokenBuckets(object):
+    """One token bucket per key like KeyedTokenBuckets, kept in a SQLite database
+
+    The buckets are shared by all processes using the database, e.g. forked workers, so that the limits
+    hold across them. Each take is one transaction. The wall clock is used, as it is the same for all processes.
+    Buckets that have been refilled completely are removed from time to time, as a new bucket is full as well;
+    beyond that, the least recently used buckets are removed when there are more than `size`.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS buckets (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            tokens REAL NOT NULL,
+            stamp REAL NOT NULL,
+            PRIMARY KEY (name, key)
+        )"""
+
+    PRUNE_INTERVAL = 60.0
+    """Seconds between the removal of full buckets from the database"""
+
+    def __init__(self, name: str, rate: float, burst: float, size: int, path: str):
+        if size < 1:
+            raise ValueError("Size must be at least 1!")
+        # Check the values once, not with every new bucket
+        TokenBucket(rate, burst)
+
+        self.rate = rate
+        self.burst = burst
+        self._name = name
+        self._size = size
+        self._pruned = 0.0
+
+        self._db = store.connect(path)
+        self._db.execute(SharedTokenBuckets.SCHEMA)
+
+    def take(self, key: str, now: Optional[float] = None) -> float:
+        """Take a token from the bucket of the key, see TokenBucket.take"""
+        now = time.time() if now is None else now
+
+        # Lock the database for writing before reading, so that concurrent takes are serialized
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._db.execute("SELECT tokens, stamp FROM buckets WHERE name = ? AND key = ?",
+                                   (self._name, key)).fetchone()
+            tokens = self.burst
+            if row is not None:
+                tokens = min(self.burst, row[0] + max(now - row[1], 0.0) * self.rate)
+
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+
+            self._db.execute("INSERT OR REPLACE INTO buckets (name, key, tokens, stamp) VALUES (?, ?, ?, ?)",
+                             (self._name, key, tokens, now))
+            if now - self._pruned > SharedTokenBuckets.PRUNE_INTERVAL:
+                self._pruned = now
+                self._prune(now)
+
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+        return wait
+
+    def _prune(self, now: float) -> None:
+        self._db.execute("DELETE FROM buckets WHERE name = ? AND stamp <= ?",
+                         (self._name, now - self.burst / self.rate))
+        self._db.execute("DELETE FROM buckets WHERE name = ? AND key IN "
+                         "(SELECT key FROM buckets WHERE name = ? ORDER BY stamp DESC LIMIT -1 OFFSET ?)",
+                         (self._name, self._name, self._size))
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM buckets WHERE name = ?", (self._name,)).fetchone()[0]
+
+    def close(self) -> None:
+        self._db.close()
+
+
+@dataclass(frozen=True)
+class RateLimitConfiguration(object):
+    """Configuration for the comment rate limit per client address and per post"""
+    DEFAULT_IP_RATE = 0.0
+    DEFAULT_IP_BURST = 5
+    DEFAULT_SLUG_RATE = 0.0
+    DEFAULT_SLUG_BURST = 20
+    DEFAULT_SIZE = 10000
+    DEFAULT_PROXIES = 0
+
+    ip_rate: float = DEFAULT_IP_RATE
+    ip_burst: int = DEFAULT_IP_BURST
+    slug_rate: float = DEFAULT_SLUG_RATE
+    slug_burst: int = DEFAULT_SLUG_BURST
+    size: int = DEFAULT_SIZE
+    proxies: int = DEFAULT_PROXIES
+    path: Optional[str] = None
+
+    @staticmethod
+    def from_environment():
+        return RateLimitConfiguration(
+            ip_rate=float(os.getenv("RATE_LIMIT_IP", RateLimitConfiguration.DEFAULT_IP_RATE)),
+            ip_burst=int(os.getenv("RATE_LIMIT_IP_BURST", RateLimitConfiguration.DEFAULT_IP_BURST)),
+            slug_rate=float(os.getenv("RATE_LIMIT_SLUG", RateLimitConfiguration.DEFAULT_SLUG_RATE)),
+            slug_burst=int(os.getenv("RATE_LIMIT_SLUG_BURST", RateLimitConfiguration.DEFAULT_SLUG_BURST)),
+            size=int(os.getenv("RATE_LIMIT_SIZE", RateLimitConfiguration.DEFAULT_SIZE)),
+            proxies=int(os.getenv("RATE_LIMIT_PROXIES", RateLimitConfiguration.DEFAULT_PROXIES)),
+            path=os.getenv("RATE_LIMIT_PATH", None)
+        )
+
+    def __post_init__(self):
+        if self.ip_rate < 0 or self.slug_rate < 0:
+            raise ValueError("RATE_LIMIT_IP and RATE_LIMIT_SLUG must not be negative!")
+
+        if self.ip_burst < 1 or self.slug_burst < 1:
+            raise ValueError("RATE_LIMIT_IP_BURST and RATE_LIMIT_SLUG_BURST must be at least 1!")
+
+        if self.size < 1:
+            raise ValueError("RATE_LIMIT_SIZE (size) must be at least 1!")
+
+        if self.proxies < 0:
+            raise ValueError("RATE_LIMIT_PROXIES (proxies) must not be negative!")
+
+    def is_enabled(self) -> bool:
+        return self.ip_rate > 0 or self.slug_rate > 0
+
+
+class RateLimiter(object):
+    """Limit the comments per client address and per post with token buckets
+
+    The rates are given in comments per minute. With a path, the buckets are kept in a SQLite database,
+    so that the limits hold across all processes using it.
+    """
+
+    def __init__(self, cfg: RateLimitConfiguration):
+        if cfg is None or not cfg.is_enabled():
+            raise ValueError("Enabled rate limit configuration must be provided!")
+
+        self._cfg = cfg
+        self._ip = RateLimiter._buckets(cfg, "ip", cfg.ip_rate, cfg.ip_burst)
+        self._slug = RateLimiter._buckets(cfg, "slug", cfg.slug_rate, cfg.slug_burst)
+        self._limited = {"ip": 0, "slug": 0}
+
+    @staticmethod
+    def _buckets(cfg: RateLimitConfiguration, name: str, rate: float, burst: int):
+        if rate <= 0:
+            return None
+        if cfg.path:
+            return SharedTokenBuckets(name, rate / 60, burst, cfg.size, cfg.path)
+        return KeyedTokenBuckets(rate / 60, burst, cfg.size)
+
+    def client_ip(self, remote_ip: str, forwarded_for: Optional[str] = None) -> str:
+        """Determine the client address
+
+        With `proxies` trusted proxies in front of the service, the client address is the one
+        added to X-Forwarded-For by the outermost trusted proxy. Addresses further left can be forged.
+        """
+        if not self._cfg.proxies or not forwarded_for:
+            return remote_ip
+
+        hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+        if not hops:
+            return remote_ip
+        return hops[max(len(hops) - self._cfg.proxies, 0)]
+
+    def check(self, ip: str, slug: str) -> int:
+        """Take a token for the client address and the post
+
+        :return: 0 if the comment may be processed, otherwise the seconds to wait
+        """
+        for key, buckets, value in [("ip", self._ip, ip), ("slug", self._slug, slug)]:
+            if buckets is None:
+                continue
+
+            try:
+                wait = buckets.take(value)
+            except sqlite3.Error as e:
+                # Rather let the comment pass than reject it
+                LOGGER.error("Could not check the rate limit for %s: %s", key, str(e))
+                continue
+
+            if wait > 0:
+                self._limited[key] += 1
+                LIMITED.inc(key=key)
+                LOGGER.warning("Rate limit for %s %s exceeded", key, value)
+                return math.ceil(wait)
+
+        return 0
+
+    def get_health(self) -> tuple[dict, bool]:
+        """Return the number of tracked keys and rejected comments; status is always healthy"""
+        return {
+            "ip-keys": len(self._ip) if self._ip is not None else 0,
+            "slug-keys": len(self._slug) if self._slug is not None else 0,
+            "limited": dict(self._limited)
+        }, True
@@ -0,0 +1,50 @@
+""" Module for the per-request stage timings
+
+The timings are collected in a context variable, so that all stages running on behalf of a request
+(also in other modules) add to the same record without passing it around.
+They are sent back in the Server-Timing header, see https://www.w3.org/TR/server-timing/
+"""
+
+from typing import Optional
+
+import contextlib
+import contextvars
+import time
+
+_TIMINGS = contextvars.ContextVar("server_timings", default=None)
+
+
+def start() -> dict:
+    """Start collecting timings for the current context, e.g. a request
+
+    :return: The timings by stage name in seconds
+    """
+    timings = dict()
+    _TIMINGS.set(timings)
+    return timings
+
+
+def record(name: str, seconds: float) -> None:
+    """Add the duration of a stage; durations of repeated stages are summed up"""
+    timings = _TIMINGS.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Record the duration of the enclosed block, which may contain awaits"""
+    begin = time.monotonic()
+    try:
+        yield
+    finally:
+        record(name, time.monotonic() - begin)
+
+
+def milliseconds(timings: Optional[dict]) -> dict:
+    return {name: round(seconds * 1000, 1) for name, seconds in (timings or dict()).items()}
+
+
+def header(timings: Optional[dict]) -> str:
+    """Format the timings as Server-Timing header value"""
+    return ", ".join(f"%s;dur=%.1f" % (name, ms) for name, ms in milliseconds(timings).items())
@@ -0,0 +1,166 @@
+""" Test the admission module """
+import asyncio
+from unittest import mock
+import pytest
+
+import os
+
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import admission
+
+
+class TestAdmissionConfiguration:
+    def test_default_init(self):
+        cfg = admission.AdmissionConfiguration()
+        assert cfg.concurrency == 8
+        assert cfg.queue == 32
+        assert cfg.timeout == 10
+        assert cfg.min_budget == 20
+        assert cfg.retry_after == 5
+
+    @mock.patch.dict(os.environ, {
+        "ADMISSION_CONCURRENCY": "1",
+        "ADMISSION_QUEUE": "2",
+        "ADMISSION_TIMEOUT": "3.5",
+        "ADMISSION_MIN_BUDGET": "4",
+        "ADMISSION_RETRY_AFTER": "5"
+    }, clear=True)
+    def test_env(self):
+        cfg = admission.AdmissionConfiguration.from_environment()
+        assert cfg.concurrency == 1
+        assert cfg.queue == 2
+        assert cfg.timeout == 3.5
+        assert cfg.min_budget == 4
+        assert cfg.retry_after == 5
+
+    def test_invalid_values(self):
+        with pytest.raises(ValueError):
+            admission.AdmissionConfiguration(concurrency=0)
+        with pytest.raises(ValueError):
+            admission.AdmissionConfiguration(queue=-1)
+        with pytest.raises(ValueError):
+            admission.AdmissionConfiguration(timeout=0)
+        with pytest.raises(ValueError):
+            admission.AdmissionConfiguration(min_budget=-1)
+        with pytest.raises(ValueError):
+            admission.AdmissionConfiguration(retry_after=0)
+
+
+class TestAdmissionGate:
+    def test_null_cfg(self):
+        with pytest.raises(ValueError):
+            admission.AdmissionGate(None)
+
+    @pytest.mark.asyncio
+    async def test_concurrency(self):
+        gate = admission.AdmissionGate(admission.AdmissionConfiguration(concurrency=2, queue=10))
+        running = list()
+        peak = list()
+
+        async def cb(i):
+            running.append(i)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(i)
+            return i
+
+        assert await asyncio.gather(*[gate.wrap(cb)(i) for i in range(5)]) == list(range(5))
+        assert max(peak) == 2
+
+        health, healthy = gate.get_health()
+        assert healthy
+        assert health["admitted"] == 5
+        assert health["in-flight"] == 0
+        assert health["queued"] == 0
+        assert health["shed"] == 0
+
+    @pytest.mark.asyncio
+    async def test_queue_full(self):
+        gate = admission.AdmissionGate(admission.AdmissionConfiguration(concurrency=1, queue=1, retry_after=3))
+        release = asyncio.Event()
+
+        async def cb():
+            await release.wait()
+            return True
+
+        first = asyncio.ensure_future(gate.wrap(cb)())
+        second = asyncio.ensure_future(gate.wrap(cb)())
+        while gate.get_health()[0]["in-flight"] != 1 or gate.get_health()[0]["queued"] != 1:
+            await asyncio.sleep(0.001)
+
+        with pytest.raises(admission.Overloaded) as e:
+            await gate.wrap(cb)()
+        assert e.value.retry_after == 3
+
+        release.set()
+        assert await first and await second
+        assert gate.get_health()[0]["shed"] == 1
+
+    @pytest.mark.asyncio
+    async def test_timeout(self):
+        gate = admission.AdmissionGate(admission.AdmissionConfiguration(concurrency=1, timeout=0.01))
+
+        async with gate.admit():
+            with pytest.raises(admission.Overloaded):
+                async with gate.admit():
+                    pass
+
+        assert gate.get_health()[0]["queued"] == 0
+
+    @pytest.mark.asyncio
+    async def test_budget(self):
+        budget = [(None, 0.0, 0.0)]
+        gate = admission.AdmissionGate(admission.AdmissionConfiguration(min_budget=10, retry_after=5),
+                                       lambda: budget[0])
+
+        async with gate.admit():
+            pass
+
+        budget[0] = (9, 0.0, 120.2)
+        with pytest.raises(admission.Overloaded) as e:
+            async with gate.admit():
+                pass
+        assert e.value.retry_after == 121
+
+        budget[0] = (100, 30.0, 0.0)
+        with pytest.raises(admission.Overloaded) as e:
+            async with gate.admit():
+                pass
+        assert e.value.retry_after == 30
+
+        budget[0] = (100, 0.0, 0.0)
+        async with gate.admit():
+            pass
+
+    @pytest.mark.asyncio
+    async def test_prefetch(self):
+        budget = [(None, 0.0, 0.0)]
+        gate = admission.AdmissionGate(admission.AdmissionConfiguration(concurrency=2), lambda: budget[0])
+        release = asyncio.Event()
+
+        async def prefetch():
+            await release.wait()
+            return "head"
+
+        # At most `concurrency` prefetches run at once
+        first = gate.prefetch(prefetch)
+        second = gate.prefetch(prefetch)
+        assert first is not None and second is not None
+        assert gate.prefetch(prefetch) is None
+        assert gate.get_health()[0]["prefetching"] == 2
+
+        release.set()
+        assert await first == "head"
+        await second
+        # The done callbacks run after the awaiting tasks
+        await asyncio.sleep(0)
+        assert gate.get_health()[0]["prefetching"] == 0
+
+        # Not started while the budget is held back or all slots are taken
+        budget[0] = (100, 3600.0, 0.0)
+        assert gate.prefetch(prefetch) is None
+        budget[0] = (None, 0.0, 0.0)
+        async with gate.admit(), gate.admit():
+            assert gate.prefetch(prefetch) is None
+        assert gate.get_health()[0]["shed"] == 0
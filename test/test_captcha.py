@@ -5,6 +5,7 @@ import pytest
 
 import os
 import io
+import asyncio
 
 from tornado.concurrent import Future
 from tornado.httpclient import AsyncHTTPClient
@@ -14,6 +15,9 @@ from tornado.httpclient import HTTPResponse
 # noinspection PyUnresolvedReferences
 # noinspection PyPackageRequirements
 import captcha
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+from admission import Overloaded
 
 
 def setup_fetch(fetch_mock, status_code, body=None):
@@ -118,15 +122,296 @@ class TestRecaptcha:
             setup_fetch(fetch_mock, 200, json.dumps({
                 "success": "True"
             }))
-            success = await recaptcha.verify("2")
+            success = await recaptcha.verify("3")
             assert success
 
             setup_fetch(fetch_mock, 200, json.dumps({
                 "success": False
             }))
-            success = await recaptcha.verify("2")
+            success = await recaptcha.verify("4")
             assert not success
 
             setup_fetch(fetch_mock, 200, "not json")
-            success = await recaptcha.verify("2")
+            success = await recaptcha.verify("5")
             assert not success
+
+
+class TestRecaptchaResilience:
+    @mock.patch.dict(os.environ, {
+        "RECAPTCHA_SECRET": "1",
+        "RECAPTCHA_TIMEOUT": "1.5",
+        "RECAPTCHA_REPLAY_TTL": "0",
+        "RECAPTCHA_BREAKER_FAILURES": "2",
+        "RECAPTCHA_BREAKER_COOLDOWN": "10",
+        "RECAPTCHA_BREAKER_POLICY": "accept"
+    }, clear=True)
+    def test_config(self):
+        cfg = captcha.RecaptchaConfiguration.from_environment()
+
+        assert cfg.timeout == 1.5
+        assert cfg.replay_ttl == 0
+        assert cfg.replay_size == captcha.RecaptchaConfiguration.DEFAULT_REPLAY_SIZE
+        assert cfg.breaker_failures == 2
+        assert cfg.breaker_cooldown == 10
+        assert cfg.breaker_policy == "accept"
+
+    def test_invalid_config(self):
+        with pytest.raises(ValueError):
+            captcha.RecaptchaConfiguration(secret="1", timeout=0)
+        with pytest.raises(ValueError):
+            captcha.RecaptchaConfiguration(secret="1", replay_ttl=-1)
+        with pytest.raises(ValueError):
+            captcha.RecaptchaConfiguration(secret="1", breaker_failures=-1)
+        with pytest.raises(ValueError):
+            captcha.RecaptchaConfiguration(secret="1", breaker_policy="ignore")
+
+    @pytest.mark.asyncio
+    async def test_replay(self):
+        recaptcha = captcha.Recaptcha(captcha.RecaptchaConfiguration(secret="1"))
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 200, json.dumps({"success": True}))
+
+            assert await recaptcha.verify("2")
+            assert not await recaptcha.verify("2")
+            assert fetch_mock.call_count == 1
+
+        health, healthy = recaptcha.get_health()
+        assert healthy
+        assert health["results"]["success"] == 1
+        assert health["results"]["replayed"] == 1
+        assert health["replay-cache"] == 1
+
+    @pytest.mark.asyncio
+    async def test_deadline(self):
+        recaptcha = captcha.Recaptcha(captcha.RecaptchaConfiguration(secret="1", timeout=0.01))
+
+        async def slow(_request, **_kwargs):
+            await asyncio.sleep(1)
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch', side_effect=slow):
+            with pytest.raises(Overloaded):
+                await recaptcha.verify("2")
+
+        assert recaptcha.get_health()[0]["results"]["error"] == 1
+        assert recaptcha.get_health()[0]["breaker"]["failures"] == 1
+
+    @pytest.mark.asyncio
+    async def test_breaker_reject(self):
+        recaptcha = captcha.Recaptcha(captcha.RecaptchaConfiguration(secret="1", breaker_failures=2,
+                                                                     breaker_cooldown=30))
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 200, json.dumps({"success": True}))
+            fetch_mock.side_effect = OSError("unreachable")
+
+            for token in ["2", "3"]:
+                with pytest.raises(Overloaded):
+                    await recaptcha.verify(token)
+            assert recaptcha.get_health()[0]["breaker"]["state"] == "open"
+
+            # Fails fast without calling Google
+            with pytest.raises(Overloaded) as e:
+                await recaptcha.verify("4")
+            assert 25 <= e.value.retry_after <= 30
+            assert fetch_mock.call_count == 2
+
+        health = recaptcha.get_health()[0]
+        assert health["results"]["error"] == 2
+        assert health["results"]["rejected"] == 1
+        assert health["breaker"]["trips"] == 1
+
+    @pytest.mark.asyncio
+    async def test_breaker_accept(self):
+        recaptcha = captcha.Recaptcha(captcha.RecaptchaConfiguration(secret="1", breaker_failures=1,
+                                                                     breaker_policy="accept"))
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch', side_effect=OSError("unreachable")) as fetch_mock:
+            assert await recaptcha.verify("2")
+            assert await recaptcha.verify("3")
+            assert fetch_mock.call_count == 1
+
+        assert recaptcha.get_health()[0]["results"]["accepted"] == 2
+
+    @pytest.mark.asyncio
+    async def test_breaker_queue(self):
+        recaptcha = captcha.Recaptcha(captcha.RecaptchaConfiguration(secret="1", timeout=1, breaker_failures=1,
+                                                                     breaker_cooldown=0.05, breaker_policy="queue"))
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            fetch_mock.side_effect = OSError("unreachable")
+            with pytest.raises(Overloaded):
+                await recaptcha.verify("2")
+
+            # Waits for the cooldown, then probes Google
+            setup_fetch(fetch_mock, 200, json.dumps({"success": True}))
+            assert await recaptcha.verify("3")
+
+        assert recaptcha.get_health()[0]["breaker"]["state"] == "closed"
+
+
+class TestCircuitBreaker:
+    @pytest.mark.asyncio
+    async def test_disabled(self):
+        breaker = captcha.CircuitBreaker(failures=0, cooldown=1)
+        for _ in range(10):
+            assert await breaker.admit()
+            breaker.record(False)
+        assert breaker.state() == "closed"
+
+    @pytest.mark.asyncio
+    async def test_half_open(self):
+        breaker = captcha.CircuitBreaker(failures=1, cooldown=0.01)
+
+        assert await breaker.admit()
+        breaker.record(False)
+        assert breaker.state() == "open"
+        assert not await breaker.admit()
+
+        await asyncio.sleep(0.02)
+        assert await breaker.admit()
+        assert breaker.state() == "half-open"
+        # Only one probe at a time
+        assert not await breaker.admit()
+
+        breaker.record(False)
+        assert breaker.state() == "open"
+
+        await asyncio.sleep(0.02)
+        assert await breaker.admit()
+        breaker.record(True)
+        assert breaker.state() == "closed"
+        assert breaker.get_health() == {"state": "closed", "failures": 0, "trips": 1}
+
+    @pytest.mark.asyncio
+    async def test_wait_for_probe(self):
+        breaker = captcha.CircuitBreaker(failures=1, cooldown=0.01)
+        assert await breaker.admit()
+        breaker.record(False)
+        await asyncio.sleep(0.02)
+        assert await breaker.admit()
+
+        waiting = asyncio.ensure_future(breaker.admit(wait=1))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+
+        breaker.record(True)
+        assert await waiting
+
+    @pytest.mark.asyncio
+    async def test_cancelled_probe(self):
+        breaker = captcha.CircuitBreaker(failures=1, cooldown=0.01)
+        assert await breaker.admit()
+        breaker.record(False)
+        await asyncio.sleep(0.02)
+        assert await breaker.admit()
+
+        # A cancelled probe lets the next call probe
+        breaker.record(None)
+        assert await breaker.admit()
+
+
+class TestProofOfWorkConfiguration:
+    @mock.patch.dict(os.environ, {
+        "POW_SECRET": "s",
+        "POW_DIFFICULTY": "20",
+        "POW_TTL": "60"
+    }, clear=True)
+    def test_full_config(self):
+        cfg = captcha.ProofOfWorkConfiguration.from_environment()
+
+        assert cfg.is_enabled()
+        assert cfg.secret == "s"
+        assert cfg.difficulty == 20
+        assert cfg.ttl == 60
+        assert cfg.size == captcha.ProofOfWorkConfiguration.DEFAULT_SIZE
+        assert cfg.path is None
+
+    @mock.patch.dict(os.environ, {
+    }, clear=True)
+    def test_empty_config(self):
+        assert not captcha.ProofOfWorkConfiguration.from_environment().is_enabled()
+
+    def test_invalid_values(self):
+        with pytest.raises(ValueError):
+            captcha.ProofOfWorkConfiguration(secret="s", difficulty=0)
+        with pytest.raises(ValueError):
+            captcha.ProofOfWorkConfiguration(secret="s", difficulty=33)
+        with pytest.raises(ValueError):
+            captcha.ProofOfWorkConfiguration(secret="s", ttl=0)
+        with pytest.raises(ValueError):
+            captcha.ProofOfWorkConfiguration(secret="s", size=0)
+
+
+class TestProofOfWork:
+    def test_disabled(self):
+        with pytest.raises(ValueError):
+            captcha.ProofOfWork(captcha.ProofOfWorkConfiguration())
+
+    def test_issue(self):
+        pow_ = captcha.ProofOfWork(captcha.ProofOfWorkConfiguration(secret="s", difficulty=4))
+
+        first, second = pow_.issue(), pow_.issue()
+        assert first["challenge"] != second["challenge"]
+        assert first["difficulty"] == 4
+        assert first["challenge"].startswith("%i.4." % first["expires"])
+
+    def test_solved(self):
+        assert captcha.ProofOfWork.solved("c", "1", 1) == \
+               (captcha.hashlib.sha256(b"c:1").digest()[0] < 0x80)
+
+    @pytest.mark.asyncio
+    async def test_verify(self):
+        pow_ = captcha.ProofOfWork(captcha.ProofOfWorkConfiguration(secret="s", difficulty=8))
+        challenge = pow_.issue()["challenge"]
+        solution = captcha.ProofOfWork.solve(challenge, 8)
+
+        assert await pow_.verify(challenge + ":" + solution)
+        # Challenges can only be used once
+        assert not await pow_.verify(challenge + ":" + solution)
+
+        assert pow_.get_health() == ({"issued": 1, "used": 1, "valid": 1, "invalid": 0, "expired": 0,
+                                      "replayed": 1}, True)
+
+    @pytest.mark.asyncio
+    async def test_verify_invalid(self):
+        pow_ = captcha.ProofOfWork(captcha.ProofOfWorkConfiguration(secret="s", difficulty=8))
+        challenge = pow_.issue()["challenge"]
+        solution = captcha.ProofOfWork.solve(challenge, 8)
+        while captcha.ProofOfWork.solved(challenge, solution + "x", 8):
+            solution += "x"
+
+        with pytest.raises(ValueError):
+            await pow_.verify(None)
+        assert not await pow_.verify("garbage")
+        assert not await pow_.verify(challenge + ":" + solution + "x")
+
+        # Another secret or a lower difficulty invalidates the signature
+        other = captcha.ProofOfWork(captcha.ProofOfWorkConfiguration(secret="t", difficulty=8))
+        assert not await other.verify(challenge + ":" + solution)
+        easier = challenge.replace(".8.", ".1.", 1)
+        assert not await pow_.verify(easier + ":" + captcha.ProofOfWork.solve(easier, 1))
+
+        assert pow_.get_health()[0]["invalid"] == 3
+
+    @pytest.mark.asyncio
+    async def test_verify_expired(self):
+        pow_ = captcha.ProofOfWork(captcha.ProofOfWorkConfiguration(secret="s", difficulty=1, ttl=1))
+        challenge = pow_.issue()["challenge"]
+        solution = captcha.ProofOfWork.solve(challenge, 1)
+
+        with mock.patch.object(captcha.time, 'time', return_value=captcha.time.time() + 5):
+            assert not await pow_.verify(challenge + ":" + solution)
+        assert pow_.get_health()[0]["expired"] == 1
+
+    @pytest.mark.asyncio
+    async def test_replay_shared(self, tmp_path):
+        cfg = captcha.ProofOfWorkConfiguration(secret="s", difficulty=1, path=str(tmp_path / "pow.db"))
+        first, second = captcha.ProofOfWork(cfg), captcha.ProofOfWork(cfg)
+        challenge = first.issue()["challenge"]
+        response = challenge + ":" + captcha.ProofOfWork.solve(challenge, 1)
+
+        assert await first.verify(response)
+        assert not await second.verify(response)
+        first.close()
+        second.close()
@@ -0,0 +1,67 @@
+""" Test the dedup module """
+from unittest import mock
+import pytest
+
+import os
+
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import form
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import dedup
+
+
+class TestDuplicateConfiguration:
+    def test_default_init(self):
+        cfg = dedup.DuplicateConfiguration()
+        assert cfg.ttl == 600
+        assert cfg.size == 10000
+        assert cfg.path is None
+        assert cfg.is_enabled()
+
+    @mock.patch.dict(os.environ, {
+        "DUPLICATE_TTL": "0",
+        "DUPLICATE_SIZE": "5",
+        "DUPLICATE_PATH": "store.sqlite"
+    }, clear=True)
+    def test_env(self):
+        cfg = dedup.DuplicateConfiguration.from_environment()
+        assert cfg.ttl == 0
+        assert cfg.size == 5
+        assert cfg.path == "store.sqlite"
+        assert not cfg.is_enabled()
+
+    def test_invalid_values(self):
+        with pytest.raises(ValueError):
+            dedup.DuplicateConfiguration(ttl=-1)
+        with pytest.raises(ValueError):
+            dedup.DuplicateConfiguration(size=0)
+        with pytest.raises(ValueError):
+            dedup.DuplicateIndex(dedup.DuplicateConfiguration(ttl=0))
+
+
+class TestDuplicateIndex:
+    def test_fingerprint(self):
+        cmt = form.Comment(slug="1", name="2", message="Hello  World\n", email="A@example.com")
+        same = form.Comment(slug="1", name="2", message=" hello world", email="a@example.com ")
+        assert dedup.DuplicateIndex.fingerprint(cmt) == dedup.DuplicateIndex.fingerprint(same)
+
+        for other in [form.Comment(slug="x", name="2", message="Hello World", email="a@example.com"),
+                      form.Comment(slug="1", name="x", message="Hello World", email="a@example.com"),
+                      form.Comment(slug="1", name="2", message="Hello World!", email="a@example.com"),
+                      form.Comment(slug="1", name="2", message="Hello World")]:
+            assert dedup.DuplicateIndex.fingerprint(cmt) != dedup.DuplicateIndex.fingerprint(other)
+
+    @pytest.mark.asyncio
+    async def test_run(self):
+        index = dedup.DuplicateIndex(dedup.DuplicateConfiguration())
+        cmt = form.Comment(slug="1", name="2", message="3")
+        again = form.Comment(slug="1", name="2", message="3")
+
+        async def process():
+            return {"status": 201, "body": {"cid": cmt.cid, "pr": 1}}
+
+        assert await index.run(cmt, process) == ({"status": 201, "body": {"cid": cmt.cid, "pr": 1}}, False)
+        assert await index.run(again, process) == ({"status": 201, "body": {"cid": cmt.cid, "pr": 1}}, True)
+        assert index.get_health()[0]["hits"] == 1
@@ -6,6 +6,7 @@ import tornado.testing
 
 import os
 import json
+import asyncio
 
 from urllib.parse import urlencode
 
@@ -14,6 +15,27 @@ from urllib.parse import urlencode
 import form
 # noinspection PyUnresolvedReferences
 # noinspection PyPackageRequirements
+import admission
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import timing
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import dedup
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import idempotency
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import throttle
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import spam
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import captcha
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
 from app import make_app
 
 
@@ -106,6 +128,21 @@ class TestFormConfiguration:
         with pytest.raises(ValueError):
             form.FormConfiguration.from_environment()
 
+    def test_valid_timing_option(self):
+        for opt in ["header", "body", "none"]:
+            with mock.patch.dict(os.environ, {
+                "FORM_TIMING": opt
+            }, clear=True):
+                cfg = form.FormConfiguration.from_environment()
+                assert cfg.timing_option == opt
+
+    @mock.patch.dict(os.environ, {
+        "FORM_TIMING": "foo"
+    }, clear=True)
+    def test_invalid_timing_option(self):
+        with pytest.raises(ValueError):
+            form.FormConfiguration.from_environment()
+
 
 class TestComment:
     def test_empty_init(self):
@@ -171,6 +208,89 @@ class TestComment:
         assert cmt.email is None
 
 
+    def test_dict_roundtrip(self):
+        cmt = form.Comment(slug="1", name="2", email="3", message="4", url="5")
+        with mock.patch.object(form.CID_GENERATOR, "next_id") as next_id:
+            restored = form.Comment.from_dict(json.loads(json.dumps(cmt.to_dict())))
+        # Restoring does not use up an ID
+        next_id.assert_not_called()
+
+        assert restored == cmt
+        assert restored.cid == cmt.cid
+        assert restored.date == cmt.date
+        assert restored.email == "3"
+        assert restored.spam is None
+
+    def test_flag_spam(self):
+        cmt = form.Comment(slug="1", name="2", message="4")
+        cmt.flag_spam("score 0.60 (3 links)")
+        restored = form.Comment.from_dict(json.loads(json.dumps(cmt.to_dict())))
+
+        assert restored.spam == "score 0.60 (3 links)"
+
+
+class TestCommentIdGenerator:
+    def test_unique_and_ordered(self):
+        gen = form.CommentIdGenerator(node=5)
+        ids = [gen.next_id() for _ in range(10000)]
+        assert ids == sorted(ids)
+        assert len(set(ids)) == len(ids)
+        assert all(cid < 2 ** 53 for cid in ids)
+        assert all((cid >> form.CommentIdGenerator.SEQUENCE_BITS) & form.CommentIdGenerator.MAX_NODE == 5
+                   for cid in ids)
+
+    def test_nodes_differ(self):
+        with mock.patch.object(form.CommentIdGenerator, '_now_ms', return_value=1000):
+            assert form.CommentIdGenerator(node=1).next_id() != form.CommentIdGenerator(node=2).next_id()
+
+    def test_sequence_overflow_and_clock_back(self):
+        gen = form.CommentIdGenerator(node=0)
+        with mock.patch.object(form.CommentIdGenerator, '_now_ms', return_value=1000):
+            ids = [gen.next_id() for _ in range(form.CommentIdGenerator.MAX_SEQUENCE + 2)]
+        with mock.patch.object(form.CommentIdGenerator, '_now_ms', return_value=500):
+            ids.append(gen.next_id())
+
+        assert ids == sorted(ids)
+        assert len(set(ids)) == len(ids)
+        assert ids[0] >> 13 == 1000
+        assert ids[-1] >> 13 == 1001
+
+    @mock.patch.dict(os.environ, {
+        "COMMENT_NODE_ID": "7"
+    }, clear=True)
+    def test_env_node(self):
+        assert form.CommentIdGenerator.default_node() == 7
+
+    def test_default_node(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            assert form.CommentIdGenerator.default_node() == 0
+        with mock.patch.dict(os.environ, {}, clear=True), \
+                mock.patch('tornado.process.task_id', return_value=3):
+            assert form.CommentIdGenerator.default_node() == 3
+        with mock.patch.dict(os.environ, {"COMMENT_NODE_ID": "7"}, clear=True), \
+                mock.patch('tornado.process.task_id', return_value=3):
+            assert form.CommentIdGenerator.default_node() == 10
+
+    def test_invalid_node(self):
+        with pytest.raises(ValueError):
+            form.CommentIdGenerator(node=64)
+        with pytest.raises(ValueError):
+            form.CommentIdGenerator(node=-1)
+        with mock.patch.dict(os.environ, {"COMMENT_NODE_ID": "100"}, clear=True):
+            with pytest.raises(ValueError):
+                form.CommentIdGenerator.default_node()
+
+    def test_workers(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            form.CommentIdGenerator.assert_workers(64)
+            with pytest.raises(ValueError):
+                form.CommentIdGenerator.assert_workers(65)
+        with mock.patch.dict(os.environ, {"COMMENT_NODE_ID": "60"}, clear=True):
+            form.CommentIdGenerator.assert_workers(4)
+            with pytest.raises(ValueError):
+                form.CommentIdGenerator.assert_workers(5)
+
+
 class CommentHandlerTestBase(tornado.testing.AsyncHTTPTestCase, ABC):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -289,6 +409,408 @@ class TestCommentHandler(CommentHandlerTestBase):
         assert response.headers['Access-Control-Allow-Origin'] == "*"
         assert response.headers['Access-Control-Allow-Methods'] == "POST, OPTIONS"
 
+    def test_unsupported_method(self):
+        in_flight = form.REQUESTS_IN_FLIGHT.value()
+        pending = len(form.PENDING_REQUESTS)
+        response = self.fetch('/v0/comment',
+                              method='PROPFIND',
+                              allow_nonstandard_methods=True)
+
+        assert response.code == 405
+        assert form.REQUESTS_IN_FLIGHT.value() == in_flight
+        # The shutdown does not wait for the rejected request
+        assert len(form.PENDING_REQUESTS) == pending
+
+
+class TestCommentHandlerQueue(CommentHandlerTestBase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._queued = list()
+        self._job_return = 1
+
+    def enqueue_cb(self, cmt: form.Comment):
+        self._queued.append(cmt)
+        return self._job_return
+
+    def get_app(self):
+        return make_app(cmt_cfg=form.FormConfiguration(),
+                        comment_cb=self.comment_cb,
+                        enqueue_cb=self.enqueue_cb)
+
+    def test_form_post_accepted(self):
+        body = urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "4"})
+
+        response = self.fetch('/v0/comment', method='POST', body=body)
+        assert response.code == 202
+        assert self._cmt is None
+        assert len(self._queued) == 1
+
+        body = json.loads(response.body.decode("utf-8"))
+        assert body["cid"] == self._queued[0].cid
+        assert body["job"] == 1
+        assert "pr" not in body
+
+    def test_form_post_queue_full(self):
+        self._job_return = None
+        body = urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "4"})
+
+        response = self.fetch('/v0/comment', method='POST', body=body)
+        assert response.code == 503
+        assert response.headers['Access-Control-Allow-Origin'] == "*"
+
+
+class TestCommentHandlerOverloaded(CommentHandlerTestBase):
+    async def comment_cb(self, cmt: form.Comment):
+        raise admission.Overloaded("1", 7)
+
+    def get_app(self):
+        return make_app(cmt_cfg=form.FormConfiguration(),
+                        comment_cb=self.comment_cb)
+
+    def test_form_post_overloaded(self):
+        body = urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "4"})
+
+        response = self.fetch('/v0/comment', method='POST', body=body)
+        assert response.code == 503
+        assert response.headers['Retry-After'] == "7"
+        assert response.headers['Access-Control-Allow-Origin'] == "*"
+
+
+class TestCommentHandlerTiming(CommentHandlerTestBase):
+    TIMING_OPTION = "header"
+
+    async def comment_cb(self, cmt: form.Comment):
+        timing.record("upload", 0.0123)
+        timing.record("upload", 0.001)
+        return 1
+
+    def get_app(self):
+        return make_app(cmt_cfg=form.FormConfiguration(timing_option=self.TIMING_OPTION),
+                        comment_cb=self.comment_cb)
+
+    def _post(self):
+        body = urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "4"})
+        response = self.fetch('/v0/comment', method='POST', body=body)
+        assert response.code == 201
+        return response
+
+
+class TestCommentHandlerTimingHeader(TestCommentHandlerTiming):
+    def test_timing_header(self):
+        response = self._post()
+
+        stages = response.headers["Server-Timing"].split(", ")
+        assert stages[0] == "upload;dur=13.3"
+        assert stages[1].startswith("total;dur=")
+        assert response.headers["Timing-Allow-Origin"] == "*"
+
+        assert "timing" not in json.loads(response.body.decode("utf-8"))
+
+
+class TestCommentHandlerTimingBody(TestCommentHandlerTiming):
+    TIMING_OPTION = "body"
+
+    def test_timing_body(self):
+        response = self._post()
+
+        assert "Server-Timing" in response.headers
+
+        body = json.loads(response.body.decode("utf-8"))
+        assert body["timing"]["upload"] == 13.3
+        assert "total" in body["timing"]
+
+
+class TestCommentHandlerTimingNone(TestCommentHandlerTiming):
+    TIMING_OPTION = "none"
+
+    def test_no_timing(self):
+        response = self._post()
+
+        assert "Server-Timing" not in response.headers
+        assert "timing" not in json.loads(response.body.decode("utf-8"))
+
+
+class TestCommentHandlerPrefetch(CommentHandlerTestBase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._captcha_valid = True
+        self._prefetched = None
+        self._prefetch_cancelled = False
+
+    async def comment_cb(self, cmt: form.Comment, prefetched=None):
+        self._cmt = cmt
+        self._prefetched = prefetched
+        return 1
+
+    async def prefetch_cb(self):
+        try:
+            await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            self._prefetch_cancelled = True
+            raise
+        return "head"
+
+    def get_app(self):
+        recaptcha = mock.Mock()
+
+        async def verify(_response):
+            await asyncio.sleep(0.01)
+            return self._captcha_valid
+
+        recaptcha.verify.side_effect = verify
+        return make_app(cmt_cfg=form.FormConfiguration(),
+                        comment_cb=self.comment_cb,
+                        challenge=recaptcha,
+                        prefetch_cb=self.prefetch_cb)
+
+    def test_prefetch(self):
+        body = urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "4", "g-recaptcha-response": "x"})
+
+        response = self.fetch('/v0/comment', method='POST', body=body)
+        assert response.code == 201
+        assert self._prefetched == "head"
+        assert not self._prefetch_cancelled
+
+    def test_prefetch_cancelled(self):
+        self._captcha_valid = False
+        body = urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "4", "g-recaptcha-response": "x"})
+
+        response = self.fetch('/v0/comment', method='POST', body=body)
+        assert response.code == 400
+        assert self._cmt is None
+        assert self._prefetch_cancelled
+
+
+class TestCommentHandlerPrefetchHeldBack(CommentHandlerTestBase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._prefetch_calls = 0
+        self._budget = (None, 0.0, 0.0)
+
+    async def prefetch_cb(self):
+        self._prefetch_calls += 1
+        # Waits like a call held back by the GitHub scheduler
+        await asyncio.sleep(3600)
+
+    def get_app(self):
+        recaptcha = mock.Mock()
+        recaptcha.verify.side_effect = lambda _response: asyncio.sleep(0, True)
+        gate = admission.AdmissionGate(admission.AdmissionConfiguration(), lambda: self._budget)
+        return make_app(cmt_cfg=form.FormConfiguration(),
+                        comment_cb=self.comment_cb,
+                        challenge=recaptcha,
+                        prefetch_cb=self.prefetch_cb,
+                        admission_gate=gate)
+
+    def test_held_back(self):
+        self._budget = (100, 3600.0, 0.0)
+        body = urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "4", "g-recaptcha-response": "x"})
+
+        # Shed right away, the prefetch is not even started
+        response = self.fetch('/v0/comment', method='POST', body=body)
+        assert response.code == 503
+        assert response.headers["Retry-After"] == "3600"
+        assert self._prefetch_calls == 0
+        assert self._cmt is None
+
+
+class TestCommentHandlerDuplicate(CommentHandlerTestBase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._calls = 0
+
+    async def comment_cb(self, cmt: form.Comment):
+        self._calls += 1
+        return self._calls
+
+    def get_app(self):
+        self._index = dedup.DuplicateIndex(dedup.DuplicateConfiguration())
+        return make_app(cmt_cfg=form.FormConfiguration(),
+                        comment_cb=self.comment_cb,
+                        duplicate_cb=self._index.run)
+
+    def test_duplicate(self):
+        body = urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "4"})
+
+        first = self.fetch('/v0/comment', method='POST', body=body)
+        second = self.fetch('/v0/comment', method='POST', body=body)
+        assert first.code == second.code == 201
+
+        first, second = [json.loads(response.body.decode("utf-8")) for response in (first, second)]
+        assert first == second
+        assert first["pr"] == 1
+        assert self._calls == 1
+
+        other = self.fetch('/v0/comment', method='POST',
+                           body=urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "5"}))
+        assert json.loads(other.body.decode("utf-8"))["pr"] == 2
+
+
+class TestCommentHandlerIdempotency(CommentHandlerTestBase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._calls = 0
+
+    async def comment_cb(self, cmt: form.Comment):
+        self._calls += 1
+        return self._calls
+
+    def get_app(self):
+        self._keys = idempotency.IdempotencyStore(idempotency.IdempotencyConfiguration())
+        self._recaptcha = mock.Mock()
+
+        async def verify(_response):
+            return True
+
+        self._recaptcha.verify.side_effect = verify
+        return make_app(cmt_cfg=form.FormConfiguration(),
+                        comment_cb=self.comment_cb,
+                        challenge=self._recaptcha,
+                        idempotency_cb=self._keys.run)
+
+    def test_header(self):
+        body = urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "4", "g-recaptcha-response": "x"})
+        headers = {"Idempotency-Key": "abc"}
+
+        first = self.fetch('/v0/comment', method='POST', body=body, headers=headers)
+        second = self.fetch('/v0/comment', method='POST', body=body, headers=headers)
+        assert first.code == second.code == 201
+        assert "Idempotent-Replayed" not in first.headers
+        assert second.headers["Idempotent-Replayed"] == "true"
+        assert json.loads(first.body.decode("utf-8")) == json.loads(second.body.decode("utf-8"))
+
+        # Neither reCAPTCHA nor the processing are repeated
+        assert self._calls == 1
+        assert self._recaptcha.verify.call_count == 1
+
+        # Without key the comment is processed again
+        third = self.fetch('/v0/comment', method='POST', body=body)
+        assert json.loads(third.body.decode("utf-8"))["pr"] == 2
+
+    def test_field(self):
+        body = urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "4", "g-recaptcha-response": "x",
+                          "idempotency_key": "def"})
+
+        self.fetch('/v0/comment', method='POST', body=body)
+        second = self.fetch('/v0/comment', method='POST', body=body)
+        assert second.code == 201
+        assert second.headers["Idempotent-Replayed"] == "true"
+        assert self._calls == 1
+
+    def test_other_comment(self):
+        headers = {"Idempotency-Key": "ghi"}
+        self.fetch('/v0/comment', method='POST', headers=headers,
+                   body=urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "4", "g-recaptcha-response": "x"}))
+        response = self.fetch('/v0/comment', method='POST', headers=headers,
+                              body=urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "5",
+                                              "g-recaptcha-response": "x"}))
+        assert response.code == 400
+
+    def test_options_allow_header(self):
+        response = self.fetch('/v0/comment', method='OPTIONS')
+        assert response.headers["Access-Control-Allow-Headers"] == "Idempotency-Key"
+
+
+class TestCommentHandlerRateLimit(CommentHandlerTestBase):
+    def get_app(self):
+        return make_app(cmt_cfg=form.FormConfiguration(),
+                        comment_cb=self.comment_cb,
+                        rate_limiter=throttle.RateLimiter(throttle.RateLimitConfiguration(ip_rate=1, ip_burst=1,
+                                                                                          proxies=1)))
+
+    def test_rate_limit(self):
+        body = urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "4"})
+
+        response = self.fetch('/v0/comment', method='POST', body=body, headers={"X-Forwarded-For": "1.2.3.4"})
+        assert response.code == 201
+
+        self._cmt = None
+        response = self.fetch('/v0/comment', method='POST', body=body, headers={"X-Forwarded-For": "1.2.3.4"})
+        assert response.code == 429
+        assert 0 < int(response.headers["Retry-After"]) <= 60
+        assert response.headers['Access-Control-Allow-Origin'] == "*"
+        assert self._cmt is None
+
+        response = self.fetch('/v0/comment', method='POST', body=body, headers={"X-Forwarded-For": "1.2.3.5"})
+        assert response.code == 201
+
+
+class TestCommentHandlerSpam(CommentHandlerTestBase):
+    def get_app(self):
+        return make_app(cmt_cfg=form.FormConfiguration(),
+                        comment_cb=self.comment_cb,
+                        spam_filter=spam.SpamFilter(spam.SpamConfiguration(max_links=2)))
+
+    def test_pass(self):
+        response = self.fetch('/v0/comment', method='POST',
+                              body=urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "No links"}))
+        assert response.code == 201
+        assert self._cmt.spam is None
+
+    def test_flag(self):
+        response = self.fetch('/v0/comment', method='POST',
+                              body=urlencode({"cmt_slug": "1", "cmt_name": "2",
+                                              "cmt_message": "See https://example.com"}))
+        assert response.code == 201
+        assert self._cmt.spam == "score 0.50 (1 links)"
+
+    def test_reject(self):
+        response = self.fetch('/v0/comment', method='POST',
+                              body=urlencode({"cmt_slug": "1", "cmt_name": "2",
+                                              "cmt_message": "https://a.example https://b.example"}))
+        assert response.code == 400
+        assert response.reason == "Comment has been rejected as spam!"
+        assert self._cmt is None
+
+
+class TestCommentHandlerProofOfWork(CommentHandlerTestBase):
+    def get_app(self):
+        self._pow = captcha.ProofOfWork(captcha.ProofOfWorkConfiguration(secret="s", difficulty=4))
+        return make_app(cmt_cfg=form.FormConfiguration(),
+                        comment_cb=self.comment_cb,
+                        challenge=self._pow)
+
+    def test_challenge(self):
+        response = self.fetch('/v0/challenge')
+        assert response.code == 200
+        assert response.headers["Cache-Control"] == "no-store"
+        assert response.headers["Access-Control-Allow-Origin"] == "*"
+
+        issued = json.loads(response.body)
+        pow_response = issued["challenge"] + ":" + captcha.ProofOfWork.solve(issued["challenge"],
+                                                                             issued["difficulty"])
+        body = urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "4", "pow-response": pow_response})
+
+        response = self.fetch('/v0/comment', method='POST', body=body)
+        assert response.code == 201
+        assert self._cmt is not None
+
+        self._cmt = None
+        response = self.fetch('/v0/comment', method='POST', body=body)
+        assert response.code == 400
+        assert response.reason == "Invalid proof-of-work response!"
+        assert self._cmt is None
+
+    def test_missing_response(self):
+        response = self.fetch('/v0/comment', method='POST',
+                              body=urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "4"}))
+        assert response.code == 400
+        assert self._cmt is None
+
+
+class TestChallengeHandlerNoIssue(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return make_app(cmt_cfg=form.FormConfiguration(),
+                        comment_cb=None,
+                        challenge=captcha.Recaptcha(captcha.RecaptchaConfiguration(secret="1")))
+
+    def test_no_challenge(self):
+        response = self.fetch('/v0/challenge')
+        assert response.code == 404
+
 
 class TestCommentHandlerSpecialOrigin(tornado.testing.AsyncHTTPTestCase):
     def get_app(self):
@@ -1,15 +1,18 @@
 """ Test the processor module """
+import asyncio
 import json
 from unittest import mock
 import pytest
 
 import os
 import io
+import time
 
 from tornado.concurrent import Future
 from tornado.httpclient import AsyncHTTPClient
 from tornado.httpclient import HTTPRequest
 from tornado.httpclient import HTTPResponse
+from tornado.httputil import HTTPHeaders
 
 # noinspection PyUnresolvedReferences
 # noinspection PyPackageRequirements
@@ -23,12 +26,12 @@ MINIMAL_ENVIRONMENT = {
     }
 
 
-def setup_fetch(fetch_mock, status_code, body=None):
+def setup_fetch(fetch_mock, status_code, body=None, headers=None):
     def side_effect(request, **_kwargs):
         if request is not HTTPRequest:
             request = HTTPRequest(request)
         buffer = io.BytesIO(body.encode())
-        response = HTTPResponse(request, status_code, None, buffer)
+        response = HTTPResponse(request, status_code, HTTPHeaders(headers or {}), buffer)
         future = Future()
         future.set_result(response)
         return future
@@ -49,11 +52,21 @@ class TestGithubConfiguration:
         # default values
         assert cfg.author == "comment2gh Bot"
         assert cfg.branch == "main"
+        assert cfg.engine == "contents"
+        assert cfg.head_ttl == 0
+        assert cfg.rate == 0
+        assert cfg.burst == 10
+        assert cfg.rate_retries == 3
 
     @mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT | {
         "GITHUB_AUTHOR": "5",
         "GITHUB_DEFAULT_BRANCH": "6",
-        "GITHUB_LABEL": "7"
+        "GITHUB_LABEL": "7",
+        "GITHUB_COMMIT_ENGINE": "gitdata",
+        "GITHUB_HEAD_TTL": "8.5",
+        "GITHUB_RATE": "0.5",
+        "GITHUB_BURST": "9",
+        "GITHUB_RATE_RETRIES": "10"
     }, clear=True)
     def test_full_config(self):
         cfg = github.GithubConfiguration.from_environment()
@@ -65,6 +78,39 @@ class TestGithubConfiguration:
         assert cfg.author == "5"
         assert cfg.branch == "6"
         assert cfg.label == "7"
+        assert cfg.engine == "gitdata"
+        assert cfg.head_ttl == 8.5
+        assert cfg.rate == 0.5
+        assert cfg.burst == 9
+        assert cfg.rate_retries == 10
+
+    @mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT | {
+        "GITHUB_COMMIT_ENGINE": "foo"
+    }, clear=True)
+    def test_invalid_engine(self):
+        with pytest.raises(ValueError):
+            github.GithubConfiguration.from_environment()
+
+    @mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT | {
+        "GITHUB_HEAD_TTL": "-1"
+    }, clear=True)
+    def test_invalid_head_ttl(self):
+        with pytest.raises(ValueError):
+            github.GithubConfiguration.from_environment()
+
+    def test_invalid_rate(self):
+        values = {
+            "user": "1",
+            "token": "2",
+            "repository": "3",
+            "email": "4"
+        }
+        with pytest.raises(ValueError):
+            github.GithubConfiguration(rate=-1, **values)
+        with pytest.raises(ValueError):
+            github.GithubConfiguration(burst=0, **values)
+        with pytest.raises(ValueError):
+            github.GithubConfiguration(rate_retries=-1, **values)
 
     def test_missing_values(self):
         values = {
@@ -102,6 +148,125 @@ class TestGithubConfiguration:
         assert hdr["Authorization"] == "Basic MToy"  # Don't be a basic M toy with your credentials!
 
 
+class TestGithubCredentials:
+    def test_token_pool(self):
+        cfg = github.GithubConfiguration(user="1", token="2, 3", repository="4", email="5")
+
+        assert len(cfg.credentials) == 2
+        assert cfg.create_auth_header() == {"Authorization": "Basic MToy"}
+        assert cfg.create_auth_header() == {"Authorization": "Basic MToz"}
+        assert cfg.create_auth_header() == {"Authorization": "Basic MToy"}
+
+        # Headers are built once
+        assert cfg.credentials[0].header() is cfg.credentials[0].header()
+        assert [c.name for c in cfg.credentials] == ["token-0", "token-1"]
+
+    def test_abstract(self):
+        with pytest.raises(TypeError):
+            github.GithubCredentials("1")
+
+    def test_app_config(self):
+        values = {
+            "user": "1",
+            "token": None,
+            "repository": "3",
+            "email": "4",
+            "app_id": "5"
+        }
+        with pytest.raises(ValueError):
+            github.GithubConfiguration(**values)
+        with pytest.raises(ValueError):
+            github.GithubConfiguration(app_installation="6", **values)
+
+        cfg = github.GithubConfiguration(app_installation="6", app_key_file="7", **values)
+        assert cfg.token is None
+
+    @staticmethod
+    def _create_app_cfg(tmp_path):
+        pytest.importorskip("jwt")
+        rsa = pytest.importorskip("cryptography.hazmat.primitives.asymmetric.rsa")
+        serialization = pytest.importorskip("cryptography.hazmat.primitives.serialization")
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        key_file = tmp_path / "app.pem"
+        key_file.write_bytes(key.private_bytes(serialization.Encoding.PEM,
+                                               serialization.PrivateFormat.PKCS8,
+                                               serialization.NoEncryption()))
+
+        return github.GithubConfiguration(user="1", token=None, repository="3", email="4",
+                                          app_id="5", app_installation="6", app_key_file=str(key_file)), key
+
+    def test_app_jwt(self, tmp_path):
+        import jwt
+
+        cfg, key = TestGithubCredentials._create_app_cfg(tmp_path)
+        assert len(cfg.credentials) == 1
+
+        token = cfg.credentials[0].app_token()
+        claims = jwt.decode(token, key.public_key(), algorithms=["RS256"])
+        assert claims["iss"] == "5"
+        assert claims["exp"] - claims["iat"] <= 600
+
+    @pytest.mark.asyncio
+    async def test_app_token(self, tmp_path):
+        cfg, _ = TestGithubCredentials._create_app_cfg(tmp_path)
+        credentials = cfg.credentials[0]
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 201, json.dumps({
+                "token": "7",
+                "expires_at": "2099-01-01T00:00:00Z"
+            }))
+            await credentials.prepare()
+            assert credentials.header() == {"Authorization": "Bearer 7"}
+
+            request = fetch_mock.call_args.args[0]
+            assert request.url == "https://api.github.com/app/installations/6/access_tokens"
+            assert request.headers["Authorization"].startswith("Bearer ")
+
+            # The token is cached
+            await credentials.prepare()
+            assert fetch_mock.call_count == 1
+
+            # Refreshed ahead of expiry
+            expiry = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 60))
+            setup_fetch(fetch_mock, 201, json.dumps({
+                "token": "8",
+                "expires_at": expiry
+            }))
+            credentials._expires = time.time() + 60
+            await credentials.prepare()
+            assert credentials.header() == {"Authorization": "Bearer 8"}
+            assert fetch_mock.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_app_token_failure(self, tmp_path):
+        cfg, _ = TestGithubCredentials._create_app_cfg(tmp_path)
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 500, "{}")
+            with pytest.raises(github.GithubAuthenticationError):
+                await github.GithubApiFunction(cfg, url="8", method="POST")._fetch()
+
+            # No unauthenticated call has been sent
+            assert fetch_mock.call_count == 1
+            assert "/app/" in fetch_mock.call_args.args[0].url
+
+    @pytest.mark.asyncio
+    async def test_app_fetch(self, tmp_path):
+        cfg, _ = TestGithubCredentials._create_app_cfg(tmp_path)
+
+        def side_effect(request, **_kwargs):
+            body = {"token": "7", "expires_at": "2099-01-01T00:00:00Z"} if "/app/" in request.url else {}
+            future = Future()
+            future.set_result(HTTPResponse(request, 201, None, io.BytesIO(json.dumps(body).encode())))
+            return future
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch', side_effect=side_effect) as fetch_mock:
+            await github.GithubApiFunction(cfg, url="8", method="POST")._fetch()
+            assert fetch_mock.call_args.args[0].headers["Authorization"] == "Bearer 7"
+
+
 class TestGithubApiFunction:
     def test_assert_none(self):
         with pytest.raises(ValueError):
@@ -179,6 +344,273 @@ class TestGithubApiFunction:
                     await f._fetch()
 
 
+class TestSingleFlight:
+    @pytest.mark.asyncio
+    async def test_coalesce(self):
+        sf = github.SingleFlight()
+        gate = asyncio.Event()
+        calls = list()
+
+        async def call():
+            calls.append(1)
+            await gate.wait()
+            return 42
+
+        tasks = [asyncio.ensure_future(sf.do("k", call)) for _ in range(5)]
+        await asyncio.sleep(0)
+        assert sf.stats() == {"in-flight": 1, "started": 1, "coalesced": 4}
+
+        gate.set()
+        assert await asyncio.gather(*tasks) == [42] * 5
+        assert len(calls) == 1
+        assert sf.stats()["in-flight"] == 0
+
+        # Finished calls are not shared
+        assert await sf.do("k", call) == 42
+        assert len(calls) == 2
+
+    @pytest.mark.asyncio
+    async def test_exception(self):
+        sf = github.SingleFlight()
+
+        async def call():
+            await asyncio.sleep(0)
+            raise ValueError("1")
+
+        results = await asyncio.gather(sf.do("k", call), sf.do("k", call), return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in results)
+
+    @pytest.mark.asyncio
+    async def test_cancel_follower(self):
+        sf = github.SingleFlight()
+        gate = asyncio.Event()
+
+        async def call():
+            await gate.wait()
+            return 42
+
+        leader = asyncio.ensure_future(sf.do("k", call))
+        follower = asyncio.ensure_future(sf.do("k", call))
+        await asyncio.sleep(0)
+        follower.cancel()
+        gate.set()
+        assert await leader == 42
+
+    @pytest.mark.asyncio
+    async def test_read_only_fetch(self):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 200, "{}")
+            coalesced = github.SINGLE_FLIGHT.coalesced
+
+            results = await asyncio.gather(*[github.GithubApiFunction(cfg, url="5")._fetch() for _ in range(3)])
+            assert results == [(200, {})] * 3
+            assert fetch_mock.call_count == 1
+            assert github.SINGLE_FLIGHT.coalesced == coalesced + 2
+
+            fetch_mock.reset_mock()
+            await asyncio.gather(*[github.GithubApiFunction(cfg, url="5", method="POST")._fetch() for _ in range(3)])
+            assert fetch_mock.call_count == 3
+
+    @pytest.mark.asyncio
+    async def test_read_only_fetch_token_pool(self):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT | {"GITHUB_TOKEN": "a,b,c"}, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 200, "{}")
+
+            # Each call gets the next token, the calls are coalesced nevertheless
+            await asyncio.gather(*[github.GithubApiFunction(cfg, url="5")._fetch() for _ in range(3)])
+            assert fetch_mock.call_count == 1
+
+
+class TestGithubBudgetKeys:
+    @pytest.mark.asyncio
+    async def test_keys(self):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+
+        assert github.GithubApiFunction(cfg, url="5")._budget_key() == "token-0/core"
+        assert github.GithubGraphQL(cfg, "query", {})._budget_key() == "token-0/graphql"
+
+    @pytest.mark.asyncio
+    async def test_graphql_single_flight(self):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+
+        class ReadOnlyQuery(github.GithubGraphQL):
+            def _is_read_only(self) -> bool:
+                return True
+
+        async def slow_fetch(request, **_kwargs):
+            await asyncio.sleep(0.01)
+            return HTTPResponse(request, 200, None, io.BytesIO(request.body))
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch', side_effect=slow_fetch) as fetch_mock:
+            results = await asyncio.gather(ReadOnlyQuery(cfg, "1", {})._fetch(),
+                                           ReadOnlyQuery(cfg, "1", {})._fetch(),
+                                           ReadOnlyQuery(cfg, "2", {})._fetch())
+
+        # Different queries to the same URL are not coalesced
+        assert fetch_mock.call_count == 2
+        assert github.CALL_SECONDS.count(call="ReadOnlyQuery", code=200) == 3
+        assert github.CALLS_IN_FLIGHT.value() == 0
+        assert [body["query"] for _, body in results] == ["1", "1", "2"]
+
+
+class TestGithubScheduler:
+    @pytest.mark.asyncio
+    async def test_budget(self):
+        scheduler = github.GithubScheduler()
+
+        assert not scheduler.update(200, HTTPHeaders({
+            "X-RateLimit-Limit": "5000",
+            "X-RateLimit-Remaining": "4999",
+            "X-RateLimit-Reset": "1700000000"
+        }))
+        stats = scheduler.stats()
+        assert stats["budgets"]["default"] == {
+            "limit": 5000,
+            "remaining": 4999,
+            "reset": 1700000000,
+            "blocked-for": 0
+        }
+        assert stats["queued"] == 0
+
+        await scheduler.acquire()
+
+    def test_exhausted(self):
+        scheduler = github.GithubScheduler()
+        reset = str(int(time.time()) + 100)
+
+        assert not scheduler.update(200, HTTPHeaders({
+            "X-RateLimit-Remaining": "0",
+            "X-RateLimit-Reset": reset
+        }))
+        assert 90 < scheduler.blocked_for() <= 101
+
+        remaining, blocked, reset_in = scheduler.budget()
+        assert remaining == 0
+        assert 90 < blocked <= 101
+        assert 90 < reset_in <= 100
+
+        assert scheduler.update(403, HTTPHeaders({
+            "X-RateLimit-Remaining": "0",
+            "X-RateLimit-Reset": reset
+        }))
+
+    @pytest.mark.asyncio
+    async def test_keys(self):
+        scheduler = github.GithubScheduler()
+        reset = str(int(time.time()) + 100)
+
+        assert not scheduler.update(200, HTTPHeaders({
+            "X-RateLimit-Remaining": "0",
+            "X-RateLimit-Reset": reset
+        }), key="token-0")
+        assert not scheduler.update(200, HTTPHeaders({
+            "X-RateLimit-Remaining": "4000",
+            "X-RateLimit-Reset": reset
+        }), key="token-1")
+
+        # An exhausted credential does not hold back the others
+        assert scheduler.blocked_for("token-0") > 90
+        assert scheduler.blocked_for("token-1") == 0
+        await asyncio.wait_for(scheduler.acquire("token-1"), 1)
+
+        remaining, blocked, _ = scheduler.budget()
+        assert remaining == 4000
+        assert blocked == 0
+        assert scheduler.stats()["budgets"]["token-0"]["remaining"] == 0
+        assert scheduler.stats()["budgets"]["token-1"]["remaining"] == 4000
+
+    def test_resources(self):
+        scheduler = github.GithubScheduler()
+        reset = str(int(time.time()) + 100)
+
+        for key, remaining in [("token-0/core", "10"), ("token-1/core", "5"), ("token-0/graphql", "5000")]:
+            scheduler.update(200, HTTPHeaders({
+                "X-RateLimit-Remaining": remaining,
+                "X-RateLimit-Reset": reset
+            }), key=key)
+
+        # Summed up over the credentials, but not over the resources
+        assert scheduler.budget(("core",))[0] == 15
+        assert scheduler.budget(("graphql",))[0] == 5000
+        assert scheduler.budget(("core", "graphql"))[0] == 15
+        assert scheduler.budget()[0] == 15
+        assert scheduler.budget(("unknown",)) == (None, 0.0, 0.0)
+
+        # Calls are held back if they are for any of the resources
+        scheduler.update(429, HTTPHeaders({"Retry-After": "30"}), key="token-0/graphql")
+        assert scheduler.budget(("core",))[1] == 0
+        assert 29 < scheduler.budget(("core", "graphql"))[1] <= 30
+
+    def test_retry_after(self):
+        scheduler = github.GithubScheduler()
+
+        assert scheduler.update(403, HTTPHeaders({
+            "Retry-After": "30"
+        }))
+        assert 29 < scheduler.blocked_for() <= 30
+
+    def test_secondary_limit(self):
+        scheduler = github.GithubScheduler()
+
+        assert scheduler.update(403, HTTPHeaders(), {"message": "You have exceeded a secondary rate limit."})
+        assert 59 < scheduler.blocked_for() <= 60
+
+        assert scheduler.update(429, HTTPHeaders())
+        assert 119 < scheduler.blocked_for() <= 120
+
+    def test_forbidden(self):
+        scheduler = github.GithubScheduler()
+
+        assert not scheduler.update(403, HTTPHeaders(), {"message": "Resource not accessible by integration"})
+        assert scheduler.blocked_for() == 0
+
+    @pytest.mark.asyncio
+    async def test_pacing(self):
+        scheduler = github.GithubScheduler(rate=100, burst=1)
+
+        start = time.monotonic()
+        for _ in range(3):
+            await scheduler.acquire()
+        assert time.monotonic() - start >= 0.015
+
+    @pytest.mark.asyncio
+    async def test_requeue(self):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+
+        responses = [
+            (429, {"Retry-After": "0"}),
+            (429, {"Retry-After": "0"}),
+            (201, {})
+        ]
+
+        def side_effect(request, **_kwargs):
+            code, headers = responses.pop(0)
+            future = Future()
+            future.set_result(HTTPResponse(request, code, HTTPHeaders(headers), io.BytesIO(b"{}")))
+            return future
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch', side_effect=side_effect) as fetch_mock:
+            code, _ = await github.GithubApiFunction(cfg, url="5", method="POST")._fetch()
+            assert code == 201
+            assert fetch_mock.call_count == 3
+
+            # Give up after the configured retries
+            responses = [(429, {"Retry-After": "0"})] * 5
+            retries = github.SCHEDULER.retries
+            code, _ = await github.GithubApiFunction(cfg, url="5", method="POST")._fetch()
+            assert code == 429
+            assert fetch_mock.call_count == 3 + retries + 1
+
+
 class TestGithubDefaultRef:
     def test_null_cfg(self):
         with pytest.raises(ValueError):
@@ -274,6 +706,90 @@ class TestGithubDefaultRef:
                 assert head is None
 
 
+class TestGithubHeadCache:
+    FOUND = json.dumps([{
+        "object": {
+            "sha": "123"
+        }
+    }])
+
+    @staticmethod
+    def _create_cfg(ttl):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT | {
+            "GITHUB_HEAD_TTL": str(ttl)
+        }, clear=True):
+            return github.GithubConfiguration.from_environment()
+
+    @pytest.mark.asyncio
+    async def test_etag_revalidation(self):
+        github.HEAD_CACHE.clear()
+        cfg = TestGithubHeadCache._create_cfg(0)
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 200, TestGithubHeadCache.FOUND, {"ETag": '"abc"'})
+            assert await github.GithubDefaultRef(cfg).default_head() == "123"
+            assert "If-None-Match" not in fetch_mock.call_args.args[0].headers
+
+            setup_fetch(fetch_mock, 304, "")
+            assert await github.GithubDefaultRef(cfg).default_head() == "123"
+            assert fetch_mock.call_args.args[0].headers["If-None-Match"] == '"abc"'
+            assert fetch_mock.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_ttl(self):
+        github.HEAD_CACHE.clear()
+        cfg = TestGithubHeadCache._create_cfg(60)
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 200, TestGithubHeadCache.FOUND, {"ETag": '"abc"'})
+            assert await github.GithubDefaultRef(cfg).default_head() == "123"
+            assert await github.GithubDefaultRef(cfg).default_head() == "123"
+            assert fetch_mock.call_count == 1
+
+            github.GithubDefaultRef.invalidate(cfg)
+            assert await github.GithubDefaultRef(cfg).default_head() == "123"
+            assert fetch_mock.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_error_invalidates(self):
+        github.HEAD_CACHE.clear()
+        cfg = TestGithubHeadCache._create_cfg(0)
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 200, TestGithubHeadCache.FOUND, {"ETag": '"abc"'})
+            assert await github.GithubDefaultRef(cfg).default_head() == "123"
+
+            setup_fetch(fetch_mock, 404, "{}")
+            assert await github.GithubDefaultRef(cfg).default_head() is None
+
+            setup_fetch(fetch_mock, 304, "")
+            assert await github.GithubDefaultRef(cfg).default_head() is None
+            assert "If-None-Match" not in fetch_mock.call_args.args[0].headers
+
+
+class TestGithubGetBranch:
+    @pytest.mark.asyncio
+    async def test_head(self):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+            b = github.GithubGetBranch(cfg, branch="7")
+
+        assert b._request().url == "https://api.github.com/repos/1/3/git/ref/heads/7"
+        assert b._request().method == "GET"
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 200, json.dumps({"object": {"sha": "8"}}))
+            assert await b.head() == "8"
+            assert github.last_status() == 200
+
+            setup_fetch(fetch_mock, 404, "{}")
+            assert await b.head() is None
+            assert github.last_status() == 404
+
+            setup_fetch(fetch_mock, 200, "{}")
+            assert await b.head() is None
+
+
 class TestGithubCreateBranch:
     ARGS = {
         "cfg": None,
@@ -312,6 +828,143 @@ class TestGithubCreateBranch:
                 assert not success
 
 
+class TestGithubCommitTree:
+    ARGS = {
+        "cfg": None,
+        "sha": "7"
+    }
+
+    def test_null_cfg(self):
+        with pytest.raises(ValueError):
+            github.GithubCommitTree(**TestGithubCommitTree.ARGS)
+
+    @mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True)
+    def test_request(self):
+        cfg = github.GithubConfiguration.from_environment()
+        ct = github.GithubCommitTree(**TestGithubCommitTree.ARGS | {"cfg": cfg})
+
+        r = ct._request()
+
+        assert r.url == "https://api.github.com/repos/1/3/git/commits/7"
+        assert r.method == "GET"
+        assert r.body is None
+
+    @pytest.mark.asyncio
+    async def test_fetch(self):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+            ct = github.GithubCommitTree(**TestGithubCommitTree.ARGS | {"cfg": cfg})
+
+            with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+                setup_fetch(fetch_mock, 200, json.dumps({
+                    "sha": "7",
+                    "tree": {
+                        "sha": "8"
+                    }
+                }))
+                assert await ct.tree_sha() == "8"
+
+                setup_fetch(fetch_mock, 200, "{}")
+                assert await ct.tree_sha() is None
+
+                setup_fetch(fetch_mock, 404, "{}")
+                assert await ct.tree_sha() is None
+
+
+class TestGithubCreateTree:
+    ARGS = {
+        "cfg": None,
+        "base_tree": "7",
+        "files": {
+            "8/a.yml": "9"
+        }
+    }
+
+    def test_null_cfg(self):
+        with pytest.raises(ValueError):
+            github.GithubCreateTree(**TestGithubCreateTree.ARGS)
+
+    @mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True)
+    def test_no_files(self):
+        cfg = github.GithubConfiguration.from_environment()
+        with pytest.raises(ValueError):
+            github.GithubCreateTree(**TestGithubCreateTree.ARGS | {"cfg": cfg, "files": {}})
+
+    @mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True)
+    def test_request(self):
+        cfg = github.GithubConfiguration.from_environment()
+        t = github.GithubCreateTree(**TestGithubCreateTree.ARGS | {"cfg": cfg})
+
+        r = t._request()
+
+        assert r.url == "https://api.github.com/repos/1/3/git/trees"
+        assert r.method == "POST"
+        assert r.body == \
+               b'{"base_tree": "7", "tree": [{"path": "8/a.yml", "mode": "100644", "type": "blob", "content": "9"}]}'
+
+    @pytest.mark.asyncio
+    async def test_fetch(self):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+            t = github.GithubCreateTree(**TestGithubCreateTree.ARGS | {"cfg": cfg})
+
+            with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+                setup_fetch(fetch_mock, 201, json.dumps({
+                    "sha": "10"
+                }))
+                assert await t.create() == "10"
+
+                setup_fetch(fetch_mock, 422, "{}")
+                assert await t.create() is None
+
+
+class TestGithubCreateCommit:
+    ARGS = {
+        "cfg": None,
+        "message": "7",
+        "tree": "8",
+        "parent": "9",
+        "committer_name": "10",
+        "committer_email": "11"
+    }
+
+    def test_null_cfg(self):
+        with pytest.raises(ValueError):
+            github.GithubCreateCommit(**TestGithubCreateCommit.ARGS)
+
+    @mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True)
+    def test_request(self):
+        cfg = github.GithubConfiguration.from_environment()
+        c = github.GithubCreateCommit(**TestGithubCreateCommit.ARGS | {"cfg": cfg})
+
+        r = c._request()
+
+        assert r.url == "https://api.github.com/repos/1/3/git/commits"
+        assert r.method == "POST"
+        assert json.loads(r.body) == {
+            "message": "7",
+            "tree": "8",
+            "parents": ["9"],
+            "author": {"name": "10", "email": "11"},
+            "committer": {"name": "10", "email": "11"}
+        }
+
+    @pytest.mark.asyncio
+    async def test_fetch(self):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+            c = github.GithubCreateCommit(**TestGithubCreateCommit.ARGS | {"cfg": cfg})
+
+            with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+                setup_fetch(fetch_mock, 201, json.dumps({
+                    "sha": "12"
+                }))
+                assert await c.create() == "12"
+
+                setup_fetch(fetch_mock, 422, "{}")
+                assert await c.create() is None
+
+
 class TestGithubUpload:
     ARGS = {
         "cfg": None,
@@ -355,6 +1008,59 @@ class TestGithubUpload:
                 assert not success
 
 
+class TestGithubGetContent:
+    @pytest.mark.asyncio
+    async def test_sha(self):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+            c = github.GithubGetContent(cfg, branch="7", path="a/b.yml")
+
+        assert c._request().url == "https://api.github.com/repos/1/3/contents/a/b.yml?ref=7"
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 200, json.dumps({"sha": "8"}))
+            assert await c.sha() == "8"
+
+            setup_fetch(fetch_mock, 404, "{}")
+            assert await c.sha() is None
+
+            setup_fetch(fetch_mock, 200, "[]")
+            assert await c.sha() is None
+
+
+class TestGithubFindPR:
+    @pytest.mark.asyncio
+    async def test_find(self):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+            f = github.GithubFindPR(cfg, head="7")
+
+        assert f._request().url == "https://api.github.com/repos/1/3/pulls?head=1%3A7&state=open"
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 200, json.dumps([{"number": 8, "node_id": "P"}]))
+            assert await f.find() == (8, "P")
+
+            setup_fetch(fetch_mock, 200, "[]")
+            assert await f.find() is None
+
+            setup_fetch(fetch_mock, 200, json.dumps([{}]))
+            assert await f.find() is None
+
+            setup_fetch(fetch_mock, 500, "{}")
+            assert await f.find() is None
+            assert github.is_transient(github.last_status())
+
+
+def test_is_transient():
+    assert github.is_transient(None)
+    assert github.is_transient(429)
+    assert github.is_transient(502)
+    assert not github.is_transient(404)
+    assert not github.is_transient(422)
+    assert not github.is_transient(201)
+
+
 class TestGithubPR:
     ARGS = {
         "cfg": None,
@@ -462,3 +1168,137 @@ class TestGithubLabel:
 
                 setup_fetch(fetch_mock, 422, "{}")
                 assert not await lab.add()
+
+
+class TestGithubGraphQL:
+    @mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True)
+    def test_request(self):
+        cfg = github.GithubConfiguration.from_environment()
+        q = github.GithubGraphQL(cfg, query="7", variables={"8": "9"})
+
+        r = q._request()
+
+        assert r.url == "https://api.github.com/graphql"
+        assert r.method == "POST"
+        assert r.body == b'{"query": "7", "variables": {"8": "9"}}'
+
+    @pytest.mark.asyncio
+    async def test_execute(self):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+            q = github.GithubGraphQL(cfg, query="7", variables={})
+
+            with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+                setup_fetch(fetch_mock, 200, json.dumps({"data": {"8": 9}}))
+                assert await q._execute() == {"8": 9}
+
+                setup_fetch(fetch_mock, 200, json.dumps({"data": None, "errors": [{"message": "10"}]}))
+                assert await q._execute() is None
+
+                setup_fetch(fetch_mock, 401, "{}")
+                assert await q._execute() is None
+
+
+class TestGithubGraphQLRepository:
+    @mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT | {
+        "GITHUB_LABEL": "5"
+    }, clear=True)
+    def test_request(self):
+        cfg = github.GithubConfiguration.from_environment()
+        r = github.GithubGraphQLRepository(cfg)._request()
+
+        assert json.loads(r.body)["variables"] == {"owner": "1", "name": "3", "label": "5", "withLabel": True}
+
+    @pytest.mark.asyncio
+    async def test_ids(self):
+        github.GithubGraphQLRepository._ids.clear()
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 200, json.dumps({"data": {"repository": {"id": "R"}}}))
+            assert await github.GithubGraphQLRepository(cfg).ids() == ("R", None)
+            assert await github.GithubGraphQLRepository(cfg).ids() == ("R", None)
+            assert fetch_mock.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_weird_result(self):
+        github.GithubGraphQLRepository._ids.clear()
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 200, json.dumps({"data": {"repository": None}}))
+            assert await github.GithubGraphQLRepository(cfg).ids() is None
+
+
+class TestGithubGraphQLCommitPR:
+    ARGS = {
+        "cfg": None,
+        "repository_id": "R",
+        "sha": "7",
+        "branch": "8",
+        "files": {"9/a.yml": "10"},
+        "message": "11",
+        "title": "12",
+        "base": "13",
+        "body": "14"
+    }
+
+    def test_null_cfg(self):
+        with pytest.raises(ValueError):
+            github.GithubGraphQLCommitPR(**TestGithubGraphQLCommitPR.ARGS)
+
+    @mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True)
+    def test_request(self):
+        cfg = github.GithubConfiguration.from_environment()
+        r = github.GithubGraphQLCommitPR(**TestGithubGraphQLCommitPR.ARGS | {"cfg": cfg})._request()
+
+        variables = json.loads(r.body)["variables"]
+        assert variables["ref"] == {"repositoryId": "R", "name": "refs/heads/8", "oid": "7"}
+        assert variables["commit"] == {
+            "branch": {"repositoryNameWithOwner": "1/3", "branchName": "8"},
+            "message": {"headline": "11"},
+            "fileChanges": {"additions": [{"path": "9/a.yml", "contents": "MTA="}]},
+            "expectedHeadOid": "7"
+        }
+        assert variables["pr"] == {
+            "repositoryId": "R",
+            "baseRefName": "13",
+            "headRefName": "8",
+            "title": "12",
+            "body": "14",
+            "maintainerCanModify": True
+        }
+
+    @pytest.mark.asyncio
+    async def test_create(self):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+            c = github.GithubGraphQLCommitPR(**TestGithubGraphQLCommitPR.ARGS | {"cfg": cfg})
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 200, json.dumps({
+                "data": {"createPullRequest": {"pullRequest": {"id": "P", "number": 15}}}
+            }))
+            assert await c.create() == (15, "P")
+
+            setup_fetch(fetch_mock, 200, json.dumps({"data": {"createPullRequest": None}}))
+            assert await c.create() is None
+
+
+class TestGithubGraphQLLabel:
+    @pytest.mark.asyncio
+    async def test_add(self):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+            lab = github.GithubGraphQLLabel(cfg, labelable_id="P", label_id="L")
+
+        assert json.loads(lab._request().body)["variables"] == {"input": {"labelableId": "P", "labelIds": ["L"]}}
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 200, json.dumps({"data": {"addLabelsToLabelable": {}}}))
+            assert await lab.add()
+
+            setup_fetch(fetch_mock, 200, json.dumps({"errors": [{"message": "1"}]}))
+            assert not await lab.add()
@@ -0,0 +1,77 @@
+""" Test the idempotency module """
+from unittest import mock
+import pytest
+
+import os
+
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import form
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import idempotency
+
+
+class TestIdempotencyConfiguration:
+    def test_default_init(self):
+        cfg = idempotency.IdempotencyConfiguration()
+        assert cfg.ttl == 86400
+        assert cfg.size == 10000
+        assert cfg.path is None
+        assert cfg.is_enabled()
+
+    @mock.patch.dict(os.environ, {
+        "IDEMPOTENCY_TTL": "0",
+        "IDEMPOTENCY_SIZE": "5",
+        "IDEMPOTENCY_PATH": "store.sqlite"
+    }, clear=True)
+    def test_env(self):
+        cfg = idempotency.IdempotencyConfiguration.from_environment()
+        assert cfg.ttl == 0
+        assert cfg.size == 5
+        assert cfg.path == "store.sqlite"
+        assert not cfg.is_enabled()
+
+    def test_invalid_values(self):
+        with pytest.raises(ValueError):
+            idempotency.IdempotencyConfiguration(ttl=-1)
+        with pytest.raises(ValueError):
+            idempotency.IdempotencyConfiguration(size=0)
+        with pytest.raises(ValueError):
+            idempotency.IdempotencyStore(idempotency.IdempotencyConfiguration(ttl=0))
+
+
+class TestIdempotencyStore:
+    @pytest.mark.asyncio
+    async def test_run(self):
+        keys = idempotency.IdempotencyStore(idempotency.IdempotencyConfiguration())
+        cmt = form.Comment(slug="1", name="2", message="3")
+        calls = list()
+
+        async def process():
+            calls.append(True)
+            return {"status": 201, "body": {"cid": cmt.cid, "pr": len(calls)}}
+
+        first = await keys.run("a", cmt, process)
+        assert first == ({"status": 201, "body": {"cid": cmt.cid, "pr": 1}}, False)
+        assert await keys.run("a", form.Comment(slug="1", name="2", message="3"), process) == (first[0], True)
+        assert len(calls) == 1
+
+        # Another comment with the same key
+        with pytest.raises(ValueError):
+            await keys.run("a", form.Comment(slug="1", name="2", message="4"), process)
+
+        # Another key for the same comment
+        assert (await keys.run("b", cmt, process))[0]["body"]["pr"] == 2
+
+    @pytest.mark.asyncio
+    async def test_invalid_key(self):
+        keys = idempotency.IdempotencyStore(idempotency.IdempotencyConfiguration())
+        cmt = form.Comment(slug="1", name="2", message="3")
+
+        async def process():
+            return {"status": 201, "body": {}}
+
+        for key in ["a" * 256, "a\nb"]:
+            with pytest.raises(ValueError):
+                await keys.run(key, cmt, process)
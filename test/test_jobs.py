@@ -0,0 +1,290 @@
+""" Test the jobs module """
+import asyncio
+from unittest import mock
+import pytest
+
+import os
+
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import form
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import jobs
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import admission
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import store
+
+
+def create_cmt(name="2"):
+    return form.Comment(slug="1", name=name, message="3")
+
+
+class TestJobQueueConfiguration:
+    def test_default_init(self):
+        cfg = jobs.JobQueueConfiguration()
+        assert cfg.path is None
+        assert cfg.workers == 2
+        assert cfg.retries == 5
+        assert cfg.retry_delay == 30
+        assert cfg.max_depth == 1000
+        assert not cfg.is_enabled()
+
+    @mock.patch.dict(os.environ, {
+        "JOB_QUEUE_PATH": "jobs.sqlite",
+        "JOB_WORKERS": "4",
+        "JOB_RETRIES": "1",
+        "JOB_RETRY_DELAY": "0.5",
+        "JOB_QUEUE_MAX": "10",
+        "JOB_LEASE": "5"
+    }, clear=True)
+    def test_env(self):
+        cfg = jobs.JobQueueConfiguration.from_environment()
+        assert cfg.path == "jobs.sqlite"
+        assert cfg.workers == 4
+        assert cfg.retries == 1
+        assert cfg.retry_delay == 0.5
+        assert cfg.max_depth == 10
+        assert cfg.lease == 5
+        assert cfg.is_enabled()
+
+    def test_invalid_values(self):
+        with pytest.raises(ValueError):
+            jobs.JobQueueConfiguration(workers=0)
+        with pytest.raises(ValueError):
+            jobs.JobQueueConfiguration(retries=-1)
+        with pytest.raises(ValueError):
+            jobs.JobQueueConfiguration(retry_delay=-1)
+        with pytest.raises(ValueError):
+            jobs.JobQueueConfiguration(max_depth=0)
+        with pytest.raises(ValueError):
+            jobs.JobQueueConfiguration(lease=0)
+
+
+class TestJobQueue:
+    @staticmethod
+    def _create_cfg(tmp_path, **kwargs):
+        return jobs.JobQueueConfiguration(path=str(tmp_path / "jobs.sqlite"), **kwargs)
+
+    def test_null_args(self, tmp_path):
+        with pytest.raises(ValueError):
+            jobs.JobQueue(None, lambda cmt: None)
+        with pytest.raises(ValueError):
+            jobs.JobQueue(jobs.JobQueueConfiguration(), lambda cmt: None)
+        with pytest.raises(ValueError):
+            jobs.JobQueue(TestJobQueue._create_cfg(tmp_path), None)
+
+    @pytest.mark.asyncio
+    async def test_process(self, tmp_path):
+        processed = list()
+
+        async def cb(cmt):
+            processed.append(cmt)
+            return 7
+
+        queue = jobs.JobQueue(TestJobQueue._create_cfg(tmp_path), cb)
+        cmts = [create_cmt(str(i)) for i in range(3)]
+        for cmt in cmts:
+            assert queue.submit(cmt) is not None
+        assert queue.depth() == 3
+
+        queue.start()
+        while queue.depth():
+            await asyncio.sleep(0.01)
+        queue.stop()
+        await queue.join()
+
+        assert sorted(c.cid for c in processed) == sorted(c.cid for c in cmts)
+        assert processed[0].date == cmts[0].date
+        health, healthy = queue.get_health()
+        assert healthy
+        assert health["done"] == 3
+        assert health["queued"] == 0
+        queue.close()
+
+    @pytest.mark.asyncio
+    async def test_retry_and_fail(self, tmp_path):
+        attempts = list()
+
+        async def cb(cmt):
+            attempts.append(cmt.cid)
+            if len(attempts) == 1:
+                raise OSError("1")
+            return None
+
+        queue = jobs.JobQueue(TestJobQueue._create_cfg(tmp_path, retries=2, retry_delay=0.01), cb)
+        queue.start()
+        queue.submit(create_cmt())
+        while queue.depth():
+            await asyncio.sleep(0.01)
+        queue.stop()
+        await queue.join()
+
+        assert len(attempts) == 3
+        health, _ = queue.get_health()
+        assert health["failed"] == 1
+        assert health["done"] == 0
+        queue.close()
+
+    @pytest.mark.asyncio
+    async def test_overloaded(self, tmp_path):
+        attempts = list()
+
+        async def cb(cmt):
+            attempts.append(cmt.cid)
+            if len(attempts) == 1:
+                raise admission.Overloaded("1", 0)
+            return 7
+
+        queue = jobs.JobQueue(TestJobQueue._create_cfg(tmp_path, retries=0), cb)
+        queue.start()
+        queue.submit(create_cmt())
+        while queue.depth():
+            await asyncio.sleep(0.01)
+        queue.stop()
+        await queue.join()
+
+        # The shed attempt does not count against the retries
+        assert len(attempts) == 2
+        health, _ = queue.get_health()
+        assert health["done"] == 1
+        assert health["failed"] == 0
+        queue.close()
+
+    @pytest.mark.asyncio
+    async def test_resume(self, tmp_path):
+        cfg = TestJobQueue._create_cfg(tmp_path, lease=0.05)
+        cmt = create_cmt()
+
+        # Job is claimed, but the service crashes before it is done
+        queue = jobs.JobQueue(cfg, lambda c: None)
+        queue.submit(cmt)
+        assert queue._claim() is not None
+        queue.close()
+
+        # The job is resumed once its lease has expired
+        assert jobs.JobQueue(cfg, lambda c: None).get_health()[0]["running"] == 1
+        await asyncio.sleep(0.06)
+
+        processed = list()
+
+        async def cb(c):
+            processed.append(c)
+            return 7
+
+        queue = jobs.JobQueue(cfg, cb)
+        assert queue.get_health()[0]["queued"] == 1
+        queue.start()
+        while queue.depth():
+            await asyncio.sleep(0.01)
+        queue.stop()
+        await queue.join()
+
+        assert [c.cid for c in processed] == [cmt.cid]
+        queue.close()
+
+    @pytest.mark.asyncio
+    async def test_shared_database(self, tmp_path):
+        cfg = TestJobQueue._create_cfg(tmp_path, workers=1, lease=0.06)
+        started = asyncio.Event()
+        finish = asyncio.Event()
+        processed = list()
+
+        async def cb(c):
+            started.set()
+            await finish.wait()
+            processed.append(c)
+            return 7
+
+        first = jobs.JobQueue(cfg, cb)
+        first.submit(create_cmt())
+        first.start()
+        await started.wait()
+
+        # Another worker starting on the same database leaves the running job alone,
+        # also after the lease time, as the first queue renews the lease
+        second = jobs.JobQueue(cfg, cb)
+        assert second.get_health()[0]["running"] == 1
+        second.start()
+        await asyncio.sleep(0.15)
+        assert second._claim() is None
+
+        finish.set()
+        assert await first.drain(1)
+        assert await second.drain(1)
+        assert len(processed) == 1
+        assert first.depth() == 0
+        first.close()
+        second.close()
+
+    def test_earlier_version(self, tmp_path):
+        path = str(tmp_path / "jobs.sqlite")
+        db = store.connect(path)
+        db.execute("""CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, cid INTEGER NOT NULL,
+                      payload TEXT NOT NULL, state TEXT NOT NULL DEFAULT 'queued',
+                      attempts INTEGER NOT NULL DEFAULT 0, next_run REAL NOT NULL, created REAL NOT NULL)""")
+        db.execute("INSERT INTO jobs (cid, payload, state, next_run, created) VALUES (1, '{}', 'running', 0, 0)")
+        db.close()
+
+        # The running job of the earlier version is resumed
+        queue = jobs.JobQueue(jobs.JobQueueConfiguration(path=path), lambda c: None)
+        assert queue.get_health()[0]["queued"] == 1
+        queue.close()
+
+    @pytest.mark.asyncio
+    async def test_drain(self, tmp_path):
+        cfg = TestJobQueue._create_cfg(tmp_path, workers=1)
+        started = asyncio.Event()
+
+        async def cb(_cmt):
+            started.set()
+            await asyncio.sleep(0.05)
+            return 7
+
+        queue = jobs.JobQueue(cfg, cb)
+        queue.submit(create_cmt())
+        queue.submit(create_cmt())
+        queue.start()
+        await started.wait()
+
+        # The current job is finished, the other one stays queued
+        assert await queue.drain(1)
+        assert queue.get_health()[0]["done"] == 1
+        assert queue.depth() == 1
+        queue.close()
+
+    @pytest.mark.asyncio
+    async def test_drain_timeout(self, tmp_path):
+        cfg = TestJobQueue._create_cfg(tmp_path, workers=1)
+        started = asyncio.Event()
+
+        async def cb(_cmt):
+            started.set()
+            await asyncio.sleep(10)
+            return 7
+
+        queue = jobs.JobQueue(cfg, cb)
+        queue.submit(create_cmt())
+        queue.start()
+        await started.wait()
+
+        assert not await queue.drain(0.01)
+        queue.close()
+
+        # The cancelled job is resumed on the next start
+        queue = jobs.JobQueue(cfg, cb)
+        assert queue.get_health()[0]["queued"] == 1
+        queue.close()
+
+    def test_full(self, tmp_path):
+        queue = jobs.JobQueue(TestJobQueue._create_cfg(tmp_path, max_depth=1), lambda c: None)
+
+        assert queue.submit(create_cmt()) is not None
+        assert queue.submit(create_cmt()) is None
+
+        _, healthy = queue.get_health()
+        assert not healthy
+        queue.close()
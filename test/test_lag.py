@@ -0,0 +1,118 @@
+""" Test the lag module """
+from unittest import mock
+import pytest
+
+import asyncio
+import logging
+import os
+import time
+
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import lag
+
+
+class TestLagConfiguration:
+    def test_default_init(self):
+        cfg = lag.LagConfiguration()
+        assert cfg.is_enabled()
+        assert cfg.interval == 0.5
+        assert cfg.threshold == 0.25
+        assert cfg.window == 1000
+
+    @mock.patch.dict(os.environ, {
+        "LAG_INTERVAL": "0",
+        "LAG_THRESHOLD": "0.1",
+        "LAG_WINDOW": "10"
+    }, clear=True)
+    def test_env(self):
+        cfg = lag.LagConfiguration.from_environment()
+        assert not cfg.is_enabled()
+        assert cfg.threshold == 0.1
+        assert cfg.window == 10
+
+        with pytest.raises(ValueError):
+            lag.LagMonitor(cfg)
+
+    def test_invalid_values(self):
+        with pytest.raises(ValueError):
+            lag.LagConfiguration(interval=-1)
+        with pytest.raises(ValueError):
+            lag.LagConfiguration(threshold=0)
+        with pytest.raises(ValueError):
+            lag.LagConfiguration(window=0)
+
+
+def test_percentile():
+    assert lag.percentile([], 0.5) == 0.0
+    ordered = [float(i) for i in range(1, 101)]
+    assert lag.percentile(ordered, 0.5) == 50.0
+    assert lag.percentile(ordered, 0.99) == 99.0
+    assert lag.percentile(ordered, 0.0) == 1.0
+    assert lag.percentile([3.0], 0.9) == 3.0
+
+
+class TestLagMonitor:
+    @pytest.mark.asyncio
+    async def test_probe(self):
+        monitor = lag.LagMonitor(lag.LagConfiguration(interval=0.01, threshold=1, window=5))
+        monitor.start()
+        try:
+            await asyncio.sleep(0.1)
+        finally:
+            monitor.stop()
+
+        health, healthy = monitor.get_health()
+        assert healthy
+        assert health["loop"] == "asyncio"
+        assert health["probes"] >= 5
+        assert health["p50"] <= health["p90"] <= health["p99"] <= health["max"]
+        assert health["stalls"] == 0
+        assert len(monitor._samples) == 5
+
+    def test_percentiles(self):
+        monitor = lag.LagMonitor(lag.LagConfiguration(window=100))
+        for ms in range(1, 201):
+            monitor._record(ms / 1000)
+
+        health, _ = monitor.get_health()
+        # Only the last 100 probes count for the percentiles, the maximum is overall
+        assert health["probes"] == 200
+        assert health["p50"] == 150.0
+        assert health["p99"] == 199.0
+        assert health["max"] == 200.0
+
+    @pytest.mark.asyncio
+    async def test_stall(self, caplog):
+        monitor = lag.LagMonitor(lag.LagConfiguration(interval=0.01, threshold=0.05))
+        monitor.start()
+        await asyncio.sleep(0.02)
+
+        def block_the_loop():
+            time.sleep(0.3)
+
+        stalls = lag.STALLS.value()
+        try:
+            with caplog.at_level(logging.WARNING, logger="lag"):
+                block_the_loop()
+                await asyncio.sleep(0.02)
+        finally:
+            monitor.stop()
+
+        health, _ = monitor.get_health()
+        # Reported once while blocked, with the blocking function on the stack
+        assert health["stalls"] == 1
+        assert lag.STALLS.value() == stalls + 1
+        assert health["max"] >= 250
+        assert any("block_the_loop" in record.getMessage() for record in caplog.records)
+
+    @pytest.mark.asyncio
+    async def test_stop(self):
+        monitor = lag.LagMonitor(lag.LagConfiguration(interval=0.01, threshold=0.01))
+        monitor.start()
+        monitor.stop()
+        monitor.stop()
+        # The watchdog ends and does not report the stopped probe
+        monitor._watchdog.join(1)
+        assert not monitor._watchdog.is_alive()
+        assert monitor.get_health()[0]["stalls"] == 0
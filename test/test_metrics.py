@@ -0,0 +1,106 @@
+""" Test the metrics module """
+import pytest
+import tornado.testing
+
+from urllib.parse import urlencode
+
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import metrics
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import form
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+from app import make_app
+
+
+class TestMetrics:
+    def test_counter(self):
+        registry = metrics.MetricsRegistry()
+        counter = registry.counter("c_total", "Counter", ("code",))
+        counter.inc(code=200)
+        counter.inc(2, code=200)
+        counter.inc(code=500)
+
+        assert counter.value(code=200) == 3
+        assert registry.render() == """\
+# HELP c_total Counter
+# TYPE c_total counter
+c_total{code="200"} 3
+c_total{code="500"} 1
+"""
+
+    def test_labels(self):
+        counter = metrics.Counter("c_total", "Counter", ("code",))
+        with pytest.raises(ValueError):
+            counter.inc()
+
+        # Label values are escaped
+        counter.inc(code='a"b')
+        assert counter.samples() == ['c_total{code="a\\"b"} 1']
+
+    def test_gauge(self):
+        registry = metrics.MetricsRegistry()
+        gauge = registry.gauge("g", "Gauge")
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        assert gauge.value() == 1
+
+        registry.gauge("cb", "Callback", callback=lambda: 2.5)
+        assert "cb 2.5" in registry.render().splitlines()
+
+        with pytest.raises(ValueError):
+            metrics.Gauge("x", "x", ("a",), callback=lambda: 1)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("h_seconds", "Histogram", ("call",), buckets=(0.1, 1))
+        histogram.observe(0.05, call="a")
+        histogram.observe(0.1, call="a")
+        histogram.observe(5, call="a")
+
+        assert histogram.count(call="a") == 3
+        assert histogram.count(call="b") == 0
+        assert histogram.samples() == [
+            'h_seconds_bucket{call="a",le="0.1"} 2',
+            'h_seconds_bucket{call="a",le="1"} 2',
+            'h_seconds_bucket{call="a",le="+Inf"} 3',
+            'h_seconds_sum{call="a"} 5.15',
+            'h_seconds_count{call="a"} 3'
+        ]
+
+        with pytest.raises(ValueError):
+            metrics.Histogram("h", "h", buckets=(1, 0.1))
+
+    def test_register_twice(self):
+        registry = metrics.MetricsRegistry()
+        counter = registry.counter("c_total", "Counter")
+        assert registry.counter("c_total", "Counter") is counter
+
+        with pytest.raises(ValueError):
+            registry.histogram("c_total", "Counter")
+
+
+class TestMetricsHandler(tornado.testing.AsyncHTTPTestCase):
+    async def comment_cb(self, _cmt):
+        return 1
+
+    def get_app(self):
+        return make_app(cmt_cfg=form.FormConfiguration(),
+                        comment_cb=self.comment_cb)
+
+    def test_metrics(self):
+        before = form.REQUEST_SECONDS.count(method="POST", code=201)
+
+        body = urlencode({"cmt_slug": "1", "cmt_name": "2", "cmt_message": "4"})
+        assert self.fetch('/v0/comment', method='POST', body=body).code == 201
+
+        response = self.fetch('/v1/metrics')
+        assert response.code == 200
+        assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+
+        text = response.body.decode("utf-8")
+        assert "# TYPE comment2gh_comment_request_seconds histogram" in text
+        assert form.REQUEST_SECONDS.count(method="POST", code=201) == before + 1
+        assert form.REQUESTS_IN_FLIGHT.value() == 0
@@ -0,0 +1,140 @@
+""" Test the outbound module """
+import asyncio
+from unittest import mock
+import pytest
+
+import os
+import io
+
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpclient import HTTPRequest
+from tornado.httpclient import HTTPResponse
+from tornado.simple_httpclient import HTTPTimeoutError
+
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import outbound
+
+
+def setup_fetch(fetch_mock, status_code, body="", request_time=None):
+    def side_effect(request, **_kwargs):
+        buffer = io.BytesIO(body.encode())
+        response = HTTPResponse(request, status_code, None, buffer, request_time=request_time)
+        future = Future()
+        future.set_result(response)
+        return future
+
+    fetch_mock.side_effect = side_effect
+
+
+class TestOutboundConfiguration:
+    @staticmethod
+    def _assert_default_values(cfg):
+        assert cfg.backend == "simple"
+        assert cfg.max_clients == 10
+        assert cfg.max_per_host == 0
+        assert cfg.connect_timeout == 10
+        assert cfg.request_timeout == 30
+
+    def test_default_init(self):
+        TestOutboundConfiguration._assert_default_values(outbound.OutboundConfiguration())
+
+    @mock.patch.dict(os.environ, {}, clear=True)
+    def test_empty_env(self):
+        TestOutboundConfiguration._assert_default_values(outbound.OutboundConfiguration.from_environment())
+
+    @mock.patch.dict(os.environ, {
+        "HTTP_BACKEND": "curl",
+        "HTTP_MAX_CLIENTS": "1",
+        "HTTP_MAX_PER_HOST": "2",
+        "HTTP_CONNECT_TIMEOUT": "3",
+        "HTTP_REQUEST_TIMEOUT": "4.5"
+    }, clear=True)
+    def test_env(self):
+        cfg = outbound.OutboundConfiguration.from_environment()
+        assert cfg.backend == "curl"
+        assert cfg.max_clients == 1
+        assert cfg.max_per_host == 2
+        assert cfg.connect_timeout == 3
+        assert cfg.request_timeout == 4.5
+
+    def test_invalid_values(self):
+        with pytest.raises(ValueError):
+            outbound.OutboundConfiguration(backend="foo")
+        with pytest.raises(ValueError):
+            outbound.OutboundConfiguration(max_clients=0)
+        with pytest.raises(ValueError):
+            outbound.OutboundConfiguration(max_per_host=-1)
+        with pytest.raises(ValueError):
+            outbound.OutboundConfiguration(connect_timeout=0)
+        with pytest.raises(ValueError):
+            outbound.OutboundConfiguration(request_timeout=0)
+
+    def test_client_impl(self):
+        assert outbound.OutboundConfiguration().client_impl() is None
+
+        with mock.patch.dict("sys.modules", {"pycurl": None}):
+            with pytest.raises(ValueError):
+                outbound.OutboundConfiguration(backend="curl").client_impl()
+
+
+class TestOutboundClient:
+    def test_null_cfg(self):
+        with pytest.raises(ValueError):
+            outbound.OutboundClient(None)
+
+    def test_default_client(self):
+        assert outbound.client() is outbound.client()
+
+    @pytest.mark.asyncio
+    async def test_fetch_timing(self):
+        client = outbound.OutboundClient(outbound.OutboundConfiguration())
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_fetch(fetch_mock, 200, "1", request_time=0.5)
+            response = await client.fetch(HTTPRequest("http://localhost/"))
+            assert response.body == b"1"
+
+        health, healthy = client.get_health()
+        assert healthy
+        assert health["requests"] == 1
+        assert health["in-flight"] == 0
+        assert health["network-ms-avg"] == 500.0
+        # Only the bookkeeping around the mocked call counts as queue time
+        assert health["queue-ms-avg"] < 50.0
+
+    @pytest.mark.asyncio
+    async def test_fetch_error(self):
+        client = outbound.OutboundClient(outbound.OutboundConfiguration())
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch', side_effect=HTTPTimeoutError("Timeout")):
+            with pytest.raises(HTTPTimeoutError):
+                await client.fetch(HTTPRequest("http://localhost/"))
+
+        health, _ = client.get_health()
+        assert health["requests"] == 1
+        assert health["in-flight"] == 0
+
+    @pytest.mark.asyncio
+    async def test_host_limit(self):
+        client = outbound.OutboundClient(outbound.OutboundConfiguration(max_per_host=2))
+        running = list()
+        peak = list()
+
+        async def slow_fetch(request, **_kwargs):
+            running.append(request.url)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(request.url)
+            return HTTPResponse(request, 200, None, io.BytesIO(b""))
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch', side_effect=slow_fetch):
+            await asyncio.gather(*[client.fetch(HTTPRequest("http://a/%i" % i)) for i in range(5)],
+                                 client.fetch(HTTPRequest("http://b/")))
+
+        # Three requests in flight at most: two for host a, one for host b
+        assert max(peak) <= 3
+        health, _ = client.get_health()
+        assert health["requests"] == 6
+        assert health["queue-ms-max"] > 0
@@ -4,6 +4,14 @@ import pytest
 from unittest import mock
 
 import os
+import io
+import json
+import asyncio
+
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpclient import HTTPResponse
+from tornado.simple_httpclient import HTTPTimeoutError
 
 # noinspection PyUnresolvedReferences
 # noinspection PyPackageRequirements
@@ -14,6 +22,12 @@ import processor
 # noinspection PyUnresolvedReferences
 # noinspection PyPackageRequirements
 import github
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import timing
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import admission
 
 
 class TestCommentFormatter:
@@ -116,6 +130,216 @@ multiline
 message.
 """
 
+    def test_spam_comment(self):
+        cmt = form.Comment(slug="1", name="2", message="3")
+        cmt.flag_spam("score 0.60 (3 links)")
+        formatter = processor.CommentFormatter(cmt)
+
+        assert formatter.pr_body().startswith("""\
+Please consider this blog comment.
+
+**Possible spam:** score 0.60 (3 links)
+
+## Meta Data
+""")
+        assert "spam" not in formatter.file_content()
+
+
+class TestProcessorConfiguration:
+    def test_default_init(self):
+        cfg = processor.ProcessorConfiguration()
+        assert cfg.digest_window == 0
+        assert cfg.digest_size == 20
+        assert not cfg.is_digest_enabled()
+        assert cfg.retries == 3
+        assert cfg.backoff == 0.5
+        assert cfg.backoff_max == 8
+
+    @mock.patch.dict(os.environ, {
+        "DIGEST_WINDOW": "1.5",
+        "DIGEST_SIZE": "2",
+        "PIPELINE_RETRIES": "5",
+        "PIPELINE_BACKOFF": "0.1",
+        "PIPELINE_BACKOFF_MAX": "2"
+    }, clear=True)
+    def test_env(self):
+        cfg = processor.ProcessorConfiguration.from_environment()
+        assert cfg.digest_window == 1.5
+        assert cfg.digest_size == 2
+        assert cfg.is_digest_enabled()
+        assert cfg.retries == 5
+        assert cfg.backoff == 0.1
+        assert cfg.backoff_max == 2
+
+    def test_invalid_values(self):
+        with pytest.raises(ValueError):
+            processor.ProcessorConfiguration(digest_window=-1)
+        with pytest.raises(ValueError):
+            processor.ProcessorConfiguration(digest_size=0)
+        with pytest.raises(ValueError):
+            processor.ProcessorConfiguration(retries=-1)
+        with pytest.raises(ValueError):
+            processor.ProcessorConfiguration(backoff=-1)
+        with pytest.raises(ValueError):
+            processor.ProcessorConfiguration(backoff=2, backoff_max=1)
+
+    def test_post_commit_values(self):
+        with pytest.raises(ValueError):
+            processor.ProcessorConfiguration(post_commit_max=0)
+        with pytest.raises(ValueError):
+            processor.ProcessorConfiguration(post_commit_retries=-1)
+        with pytest.raises(ValueError):
+            processor.ProcessorConfiguration(post_commit_backoff=2, post_commit_backoff_max=1)
+        with pytest.raises(ValueError):
+            processor.ProcessorConfiguration(post_commit_drain=-1)
+
+    def test_backoff_delay(self):
+        cfg = processor.ProcessorConfiguration(backoff=1, backoff_max=3)
+        for _ in range(20):
+            assert 0 <= cfg.backoff_delay(1) <= 1
+            assert 0 <= cfg.backoff_delay(5) <= 3
+
+
+class TestPostCommitRunner:
+    @pytest.mark.asyncio
+    async def test_bounded(self):
+        runner = processor.PostCommitRunner(processor.ProcessorConfiguration(post_commit_max=1))
+        release = asyncio.Event()
+
+        async def task():
+            await release.wait()
+            return True
+
+        assert runner.submit("1", task)
+        assert not runner.submit("2", task)
+        release.set()
+        assert await runner.drain()
+        assert runner.get_health() == {"in-flight": 0, "done": 1, "failed": 0, "dropped": 1}
+
+    @pytest.mark.asyncio
+    async def test_drain_timeout(self):
+        runner = processor.PostCommitRunner(processor.ProcessorConfiguration())
+        cancelled = list()
+
+        async def task():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        runner.submit("1", task)
+        assert not await runner.drain(0.01)
+        assert cancelled
+        assert runner.get_health()["in-flight"] == 0
+
+    @pytest.mark.asyncio
+    async def test_permanent_failure(self):
+        runner = processor.PostCommitRunner(processor.ProcessorConfiguration())
+        calls = list()
+
+        async def task():
+            calls.append(True)
+            github._LAST_STATUS.set(404)
+            return False
+
+        runner.submit("1", task)
+        assert await runner.drain()
+        # Not retried
+        assert len(calls) == 1
+        assert runner.get_health()["failed"] == 1
+
+
+class TestDigestFormatter:
+    def test_empty(self):
+        with pytest.raises(ValueError):
+            processor.DigestFormatter([])
+
+    def test_comments(self):
+        cmts = [form.Comment(slug="1", name="2", message="3"),
+                form.Comment(slug="4", name="5", message="6")]
+        formatter = processor.DigestFormatter(cmts)
+
+        assert formatter.branch_name() == "comments-" + str(cmts[0].cid)
+        assert formatter.files() == processor.CommentFormatter(cmts[0]).files() | \
+               processor.CommentFormatter(cmts[1]).files()
+        assert formatter.commit_message() == "Comments %s, %s" % (cmts[0].cid, cmts[1].cid)
+        assert formatter.pr_title() == "Blog Comments %s (2)" % cmts[0].cid
+
+        body = formatter.pr_body()
+        assert body.startswith("Please consider these 2 blog comments.\n\n# Comment %s\n\n## Meta Data" % cmts[0].cid)
+        assert "\n\n# Comment %s\n\n## Meta Data\n\nSlug: 4\n" % cmts[1].cid in body
+        assert body.endswith("## Message\n\n6")
+
+
+class TestCommentDigest:
+    @pytest.mark.asyncio
+    async def test_size(self):
+        batches = list()
+
+        async def batch_cb(cmts):
+            batches.append(cmts)
+            return len(batches)
+
+        digest = processor.CommentDigest(window=60, size=2, batch_cb=batch_cb)
+        cmts = [form.Comment(slug="1", name="2", message=str(i)) for i in range(3)]
+
+        results = await asyncio.gather(digest.submit(cmts[0]), digest.submit(cmts[1]))
+        assert results == [1, 1]
+        assert batches == [cmts[0:2]]
+
+        # A single comment waits for the window or an explicit flush
+        task = asyncio.ensure_future(digest.submit(cmts[2]))
+        await asyncio.sleep(0)
+        assert not task.done()
+        digest.flush()
+        assert await task == 2
+
+    @pytest.mark.asyncio
+    async def test_window(self):
+        async def batch_cb(cmts):
+            return len(cmts)
+
+        digest = processor.CommentDigest(window=0.01, size=10, batch_cb=batch_cb)
+        cmts = [form.Comment(slug="1", name="2", message=str(i)) for i in range(3)]
+
+        results = await asyncio.gather(*[digest.submit(cmt) for cmt in cmts])
+        assert results == [3, 3, 3]
+
+    @pytest.mark.asyncio
+    async def test_failure(self):
+        async def batch_cb(_cmts):
+            raise ValueError("1")
+
+        digest = processor.CommentDigest(window=0.01, size=1, batch_cb=batch_cb)
+        with pytest.raises(ValueError):
+            await digest.submit(form.Comment(slug="1", name="2", message="3"))
+
+    @pytest.mark.asyncio
+    async def test_gated(self):
+        with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT, clear=True):
+            cfg = github.GithubConfiguration.from_environment()
+        proc = processor.CommentProcessor(cfg, processor.ProcessorConfiguration(digest_window=0.05, digest_size=20))
+        assert proc.is_digest_enabled()
+        assert proc.resources() == ("core",)
+
+        batches = list()
+
+        async def digest_to_github_pr(cmts):
+            batches.append(cmts)
+            return 7
+
+        gate = admission.AdmissionGate(admission.AdmissionConfiguration(concurrency=1, queue=0))
+        with mock.patch.object(proc, "digest_to_github_pr", side_effect=digest_to_github_pr):
+            proc.gate_digests(gate.wrap)
+
+            # More comments than the gate admits at once end up in one digest
+            cmts = [form.Comment(slug="1", name="2", message=str(i)) for i in range(3)]
+            assert await asyncio.gather(*[proc.comment_to_github_pr(cmt) for cmt in cmts]) == [7, 7, 7]
+
+        assert batches == [cmts]
+        assert gate.get_health()[0]["admitted"] == 1
+
 
 MINIMAL_ENVIRONMENT = {
         "GITHUB_USER": "1",
@@ -125,6 +349,28 @@ MINIMAL_ENVIRONMENT = {
     }
 
 
+def setup_routes(fetch_mock, routes):
+    """Answer each request by (method, URL suffix) and record the calls"""
+    calls = list()
+
+    def side_effect(request, **_kwargs):
+        calls.append((request.method, request.url))
+        for (method, suffix), answer in routes.items():
+            if request.method == method and request.url.endswith(suffix):
+                status_code, body = answer(request) if callable(answer) else answer
+                break
+        else:
+            status_code, body = 404, {}
+        buffer = io.BytesIO(json.dumps(body).encode())
+        response = HTTPResponse(request, status_code, None, buffer)
+        future = Future()
+        future.set_result(response)
+        return future
+
+    fetch_mock.side_effect = side_effect
+    return calls
+
+
 def setup_call_0arg(call_mock, result):
     def side_effect(**_kwargs):
         return result
@@ -141,10 +387,10 @@ def setup_call_1arg(call_mock, result):
 
 class TestCommentProcessor:
     @staticmethod
-    def _create_cfg():
+    def _create_cfg(env=None):
         with mock.patch.dict(os.environ, MINIMAL_ENVIRONMENT | {
             "GITHUB_LABEL": "5"
-        }, clear=True):
+        } | (env or {}), clear=True):
             return github.GithubConfiguration.from_environment()
 
     @staticmethod
@@ -213,6 +459,10 @@ class TestCommentProcessor:
                         proc = processor.CommentProcessor(cfg)
                         issue = await proc.comment_to_github_pr(cmt)
                         assert issue == "1"
+                        # The label is added after the PR has been returned
+                        assert await proc.post_commit.drain()
+                        assert label_mock.called
+                        assert proc.get_health()[0]["post-commit"]["done"] == 1
 
     @pytest.mark.asyncio
     async def test_with_label_fail(self):
@@ -226,6 +476,297 @@ class TestCommentProcessor:
                     setup_call_1arg(pr_mock, "1")
                     with mock.patch.object(github.GithubLabel, 'add') as label_mock:
                         setup_call_0arg(label_mock, False)
-                        proc = processor.CommentProcessor(cfg)
+                        proc = processor.CommentProcessor(cfg, processor.ProcessorConfiguration(
+                            post_commit_backoff=0.001, post_commit_backoff_max=0.001))
                         issue = await proc.comment_to_github_pr(cmt)
                         assert issue == "1"
+                        assert await proc.post_commit.drain()
+                        assert proc.get_health()[0]["post-commit"]["failed"] == 1
+
+    @pytest.mark.asyncio
+    async def test_gitdata_engine(self):
+        cfg = TestCommentProcessor._create_cfg({"GITHUB_COMMIT_ENGINE": "gitdata"})
+        cmt = TestCommentProcessor._create_cmt()
+        with mock.patch.object(processor.CommentProcessor, '_commit_tree') as tree_mock, \
+                mock.patch.object(processor.CommentProcessor, '_create_branch') as branch_mock, \
+                mock.patch.object(processor.CommentProcessor, '_create_pr') as pr_mock, \
+                mock.patch.object(github.GithubLabel, 'add') as label_mock:
+            setup_call_1arg(tree_mock, True)
+            setup_call_1arg(pr_mock, "1")
+            setup_call_0arg(label_mock, True)
+            proc = processor.CommentProcessor(cfg)
+            issue = await proc.comment_to_github_pr(cmt)
+            assert issue == "1"
+            assert tree_mock.called
+            assert not branch_mock.called
+
+    @pytest.mark.asyncio
+    async def test_gitdata_engine_no_commit(self):
+        cfg = TestCommentProcessor._create_cfg({"GITHUB_COMMIT_ENGINE": "gitdata"})
+        cmt = TestCommentProcessor._create_cmt()
+        with mock.patch.object(processor.CommentProcessor, '_commit_tree') as tree_mock, \
+                mock.patch.object(processor.CommentProcessor, '_create_pr') as pr_mock:
+            setup_call_1arg(tree_mock, False)
+            proc = processor.CommentProcessor(cfg)
+            assert await proc.comment_to_github_pr(cmt) is None
+            assert not pr_mock.called
+
+    @pytest.mark.asyncio
+    async def test_commit_tree(self):
+        cfg = TestCommentProcessor._create_cfg({"GITHUB_COMMIT_ENGINE": "gitdata"})
+        cmt = TestCommentProcessor._create_cmt()
+        formatter = processor.CommentFormatter(cmt)
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            calls = setup_routes(fetch_mock, {
+                ("GET", "/git/matching-refs/heads/main"): (200, [{"object": {"sha": "a"}}]),
+                ("GET", "/git/commits/a"): (200, {"sha": "a", "tree": {"sha": "b"}}),
+                ("POST", "/git/trees"): (201, {"sha": "c"}),
+                ("POST", "/git/commits"): (201, {"sha": "d"}),
+                ("POST", "/git/refs"): (201, {})
+            })
+            proc = processor.CommentProcessor(cfg)
+            assert await proc._commit_tree(formatter)
+
+            assert [c[0] for c in calls] == ["GET", "GET", "POST", "POST", "POST"]
+            branch = json.loads(fetch_mock.call_args.args[0].body)
+            assert branch == {"ref": "refs/heads/" + formatter.branch_name(), "sha": "d"}
+
+            calls = setup_routes(fetch_mock, {
+                ("GET", "/git/matching-refs/heads/main"): (200, [{"object": {"sha": "a"}}]),
+                ("GET", "/git/commits/a"): (200, {"sha": "a", "tree": {"sha": "b"}}),
+                ("POST", "/git/trees"): (422, {})
+            })
+            assert not await proc._commit_tree(formatter)
+            # The head is looked up again, but has not changed, then the branch is probed for an earlier attempt
+            assert len(calls) == 5
+            assert calls[-1][1].endswith("/git/ref/heads/" + formatter.branch_name())
+
+    @pytest.mark.asyncio
+    async def test_prefetch(self):
+        cfg = TestCommentProcessor._create_cfg({"GITHUB_COMMIT_ENGINE": "gitdata"})
+        cmt = TestCommentProcessor._create_cmt()
+        github.HEAD_CACHE.clear()
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            calls = setup_routes(fetch_mock, {
+                ("GET", "/git/matching-refs/heads/main"): (200, [{"object": {"sha": "a"}}]),
+                ("GET", "/git/commits/a"): (200, {"sha": "a", "tree": {"sha": "b"}})
+            })
+            proc = processor.CommentProcessor(cfg)
+            prefetched = await proc.prefetch()
+            assert prefetched == processor.Prefetch(head="a", tree="b")
+            # Only reads
+            assert [c[0] for c in calls] == ["GET", "GET"]
+
+            calls = setup_routes(fetch_mock, {
+                ("POST", "/git/trees"): (201, {"sha": "c"}),
+                ("POST", "/git/commits"): (201, {"sha": "d"}),
+                ("POST", "/git/refs"): (201, {}),
+                ("POST", "/pulls"): (201, {"number": 7})
+            })
+            with mock.patch.object(github.GithubLabel, 'add') as label_mock:
+                setup_call_0arg(label_mock, True)
+                assert await proc.comment_to_github_pr(cmt, prefetched=prefetched) == 7
+            # The pipeline starts with the mutations
+            assert [c[0] for c in calls] == ["POST", "POST", "POST", "POST"]
+
+    @pytest.mark.asyncio
+    async def test_prefetch_failed(self):
+        cfg = TestCommentProcessor._create_cfg()
+        github.HEAD_CACHE.clear()
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            fetch_mock.side_effect = OSError("unreachable")
+            proc = processor.CommentProcessor(cfg)
+            assert await proc.prefetch() == processor.Prefetch()
+
+    @pytest.mark.asyncio
+    async def test_resume(self):
+        cfg = TestCommentProcessor._create_cfg()
+        cmt = TestCommentProcessor._create_cmt()
+        formatter = processor.CommentFormatter(cmt)
+        github.HEAD_CACHE.clear()
+
+        # An earlier attempt left branch, file and PR behind
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_routes(fetch_mock, {
+                ("GET", "/git/matching-refs/heads/main"): (200, [{"object": {"sha": "a"}}]),
+                ("POST", "/git/refs"): (422, {"message": "Reference already exists"}),
+                ("GET", "/git/ref/heads/" + formatter.branch_name()): (200, {"object": {"sha": "b"}}),
+                ("PUT", formatter.commit_path()): (422, {}),
+                ("GET", formatter.commit_path() + "?ref=" + formatter.branch_name()): (200, {"sha": "c"}),
+                ("POST", "/pulls"): (422, {}),
+                ("GET", "/pulls?head=1%3A" + formatter.branch_name() + "&state=open"):
+                    (200, [{"number": 7, "node_id": "P"}]),
+                ("POST", "/issues/7/labels"): (200, {})
+            })
+            proc = processor.CommentProcessor(cfg)
+            assert await proc.comment_to_github_pr(cmt) == 7
+
+        health, healthy = proc.get_health()
+        assert healthy
+        assert health["resumed"] == {"branch": 1, "upload": 1, "pr": 1}
+        assert health["retries"] == {}
+
+    @pytest.mark.asyncio
+    async def test_transient_retry(self):
+        cfg = TestCommentProcessor._create_cfg()
+        cmt = TestCommentProcessor._create_cmt()
+        github.HEAD_CACHE.clear()
+        pulls = [(502, {}), (201, {"number": 7})]
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            calls = setup_routes(fetch_mock, {
+                ("GET", "/git/matching-refs/heads/main"): (200, [{"object": {"sha": "a"}}]),
+                ("POST", "/git/refs"): (201, {}),
+                ("PUT", ".yml"): (201, {}),
+                ("POST", "/pulls"): lambda _request: pulls.pop(0),
+                ("GET", "&state=open"): (200, []),
+                ("POST", "/issues/7/labels"): (500, {})
+            })
+            proc = processor.CommentProcessor(cfg, processor.ProcessorConfiguration(retries=2, backoff=0.001,
+                                                                                    backoff_max=0.001,
+                                                                                    post_commit_retries=2,
+                                                                                    post_commit_backoff=0.001,
+                                                                                    post_commit_backoff_max=0.001))
+            timings = timing.start()
+            assert await proc.comment_to_github_pr(cmt) == 7
+            # The label is not part of the response time
+            assert "pr" in timings and "label" not in timings
+            assert await proc.post_commit.drain()
+
+        health, _ = proc.get_health()
+        assert health["retries"] == {"pr": 1}
+        assert health["resumed"] == {}
+        assert health["post-commit"] == {"in-flight": 0, "done": 0, "failed": 1, "dropped": 0}
+        assert len([c for c in calls if c[1].endswith("/labels")]) == 3
+
+    @pytest.mark.asyncio
+    async def test_transient_branch_retry(self):
+        cfg = TestCommentProcessor._create_cfg()
+        formatter = processor.CommentFormatter(TestCommentProcessor._create_cmt())
+        github.HEAD_CACHE.clear()
+        refs = [(502, {}), (201, {})]
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            setup_routes(fetch_mock, {
+                ("GET", "/git/matching-refs/heads/main"): (200, [{"object": {"sha": "a"}}]),
+                ("POST", "/git/refs"): lambda _request: refs.pop(0)
+            })
+            proc = processor.CommentProcessor(cfg, processor.ProcessorConfiguration(backoff=0.001, backoff_max=0.001))
+            # The 502 of the branch creation decides on the retry, not the head lookup after it
+            assert await proc._create_branch(formatter)
+
+        assert proc.get_health()[0]["retries"] == {"branch": 1}
+
+    @pytest.mark.asyncio
+    async def test_timeout_retry(self):
+        cfg = TestCommentProcessor._create_cfg()
+        cmt = TestCommentProcessor._create_cmt()
+        github.HEAD_CACHE.clear()
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            fetch_mock.side_effect = HTTPTimeoutError("Timeout")
+            proc = processor.CommentProcessor(cfg, processor.ProcessorConfiguration(retries=2, backoff=0.001,
+                                                                                    backoff_max=0.001))
+            assert await proc.comment_to_github_pr(cmt) is None
+
+        assert proc.get_health()[0]["retries"] == {"branch": 2}
+
+    @pytest.mark.asyncio
+    async def test_stale_head_retry(self):
+        cfg = TestCommentProcessor._create_cfg()
+        proc = processor.CommentProcessor(cfg)
+        github.HEAD_CACHE.clear()
+
+        heads = list()
+
+        async def action(head):
+            heads.append(head)
+            # Permanent failure of the GitHub call
+            github._LAST_STATUS.set(422)
+            return False
+
+        with mock.patch.object(github.GithubDefaultRef, 'default_head') as head_mock:
+            # Same head on revalidation: no retry
+            head_mock.side_effect = ["a", "a"]
+            assert not await proc._on_default_head(action)
+            assert heads == ["a"]
+
+            # Moved head on revalidation: retry once
+            heads.clear()
+            head_mock.side_effect = ["a", "b"]
+            assert not await proc._on_default_head(action)
+            assert heads == ["a", "b"]
+
+            # No head at all: no action
+            heads.clear()
+            head_mock.side_effect = [None]
+            assert not await proc._on_default_head(action)
+            assert heads == []
+
+    @pytest.mark.asyncio
+    async def test_digest(self):
+        cfg = TestCommentProcessor._create_cfg()
+        cmts = [TestCommentProcessor._create_cmt() for _ in range(2)]
+        github.HEAD_CACHE.clear()
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            calls = setup_routes(fetch_mock, {
+                ("GET", "/git/matching-refs/heads/main"): (200, [{"object": {"sha": "a"}}]),
+                ("GET", "/git/commits/a"): (200, {"sha": "a", "tree": {"sha": "b"}}),
+                ("POST", "/git/trees"): (201, {"sha": "c"}),
+                ("POST", "/git/commits"): (201, {"sha": "d"}),
+                ("POST", "/git/refs"): (201, {}),
+                ("POST", "/pulls"): (201, {"number": 7}),
+                ("POST", "/issues/7/labels"): (200, {})
+            })
+            proc = processor.CommentProcessor(cfg, processor.ProcessorConfiguration(digest_window=60, digest_size=2))
+            issues = await asyncio.gather(*[proc.comment_to_github_pr(cmt) for cmt in cmts])
+            assert issues == [7, 7]
+
+            # One commit with both files and one PR for both comments
+            assert len(calls) == 7
+            tree = json.loads(fetch_mock.call_args_list[2].args[0].body)
+            assert len(tree["tree"]) == 2
+
+    @pytest.mark.asyncio
+    async def test_graphql_engine(self):
+        cfg = TestCommentProcessor._create_cfg({"GITHUB_COMMIT_ENGINE": "graphql"})
+        cmt = TestCommentProcessor._create_cmt()
+        github.HEAD_CACHE.clear()
+        github.GithubGraphQLRepository._ids.clear()
+
+        def graphql(request):
+            query = json.loads(request.body)["query"]
+            if "createPullRequest" in query:
+                return 200, {"data": {"createPullRequest": {"pullRequest": {"id": "P", "number": 7}}}}
+            if "repository(" in query:
+                return 200, {"data": {"repository": {"id": "R", "label": {"id": "L"}}}}
+            return 200, {"data": {"addLabelsToLabelable": {"clientMutationId": None}}}
+
+        with mock.patch.object(AsyncHTTPClient, 'fetch') as fetch_mock:
+            calls = setup_routes(fetch_mock, {
+                ("GET", "/git/matching-refs/heads/main"): (200, [{"object": {"sha": "a"}}]),
+                ("POST", "/graphql"): graphql
+            })
+            proc = processor.CommentProcessor(cfg)
+            assert await proc.comment_to_github_pr(cmt) == 7
+            assert await proc.post_commit.drain()
+            assert len(calls) == 4
+
+            label = json.loads(fetch_mock.call_args.args[0].body)
+            assert label["variables"]["input"] == {"labelableId": "P", "labelIds": ["L"]}
+
+            # The repository IDs are cached
+            calls.clear()
+            assert await proc.comment_to_github_pr(cmt) == 7
+            assert await proc.post_commit.drain()
+            assert len(calls) == 3
+
+            calls = setup_routes(fetch_mock, {
+                ("GET", "/git/matching-refs/heads/main"): (200, [{"object": {"sha": "a"}}]),
+                ("POST", "/graphql"): (200, {"errors": [{"message": "1"}]})
+            })
+            assert await proc.comment_to_github_pr(cmt) is None
@@ -0,0 +1,163 @@
+""" Test the service module """
+from unittest import mock
+import pytest
+import tornado.web
+
+import asyncio
+import os
+import signal
+
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import service
+
+
+class TestWorkerConfiguration:
+    @mock.patch.dict(os.environ, {
+        "SERVICE_WORKERS": "4",
+        "SERVICE_MAX_RESTARTS": "10"
+    }, clear=True)
+    def test_full_config(self):
+        cfg = service.WorkerConfiguration.from_environment()
+
+        assert cfg.is_enabled()
+        assert cfg.count() == 4
+        assert cfg.max_restarts == 10
+
+    @mock.patch.dict(os.environ, {
+    }, clear=True)
+    def test_empty_config(self):
+        cfg = service.WorkerConfiguration.from_environment()
+
+        assert not cfg.is_enabled()
+        assert cfg.count() == 1
+        assert service.fork_workers(cfg) is None
+
+    def test_per_cpu(self):
+        with mock.patch('tornado.process.cpu_count', return_value=3):
+            assert service.WorkerConfiguration(workers=0).count() == 3
+
+    def test_invalid_values(self):
+        with pytest.raises(ValueError):
+            service.WorkerConfiguration(workers=-1)
+        with pytest.raises(ValueError):
+            service.WorkerConfiguration(max_restarts=-1)
+
+
+class TestInFlight:
+    @pytest.mark.asyncio
+    async def test_wait(self):
+        in_flight = service.InFlight()
+        assert await in_flight.wait(0)
+
+        in_flight.enter()
+        in_flight.enter()
+        assert len(in_flight) == 2
+        assert not await in_flight.wait(0.01)
+
+        waiting = asyncio.ensure_future(in_flight.wait(1))
+        await asyncio.sleep(0)
+        in_flight.exit()
+        await asyncio.sleep(0)
+        assert not waiting.done()
+
+        in_flight.exit()
+        assert await waiting
+        assert len(in_flight) == 0
+
+
+class TestTerminationGuard:
+    @pytest.fixture(autouse=True)
+    def restore_sigterm(self):
+        handler = signal.getsignal(signal.SIGTERM)
+        yield
+        signal.signal(signal.SIGTERM, handler)
+
+    def test_invalid_deadline(self):
+        with pytest.raises(ValueError):
+            service.TerminationGuard(deadline=-1)
+
+    def test_signal(self):
+        ioloop = mock.Mock()
+        guard = service.TerminationGuard(ioloop)
+        assert guard.get_health() == ({"draining": False}, True)
+
+        os.kill(os.getpid(), signal.SIGTERM)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+        assert guard.is_terminated()
+        assert not guard.is_drained()
+        assert guard.get_health() == ({"draining": True}, False)
+        # The shutdown is scheduled right away, only once
+        ioloop.add_callback.assert_called_once_with(guard._shutdown)
+
+    @pytest.mark.asyncio
+    async def test_shutdown(self):
+        ioloop = mock.Mock()
+        guard = service.TerminationGuard(ioloop, deadline=0.1)
+        calls = list()
+
+        async def slow(remaining):
+            calls.append(("slow", remaining))
+            await asyncio.sleep(0.05)
+            return False
+
+        async def failing(remaining):
+            calls.append(("failing", remaining))
+            raise OSError("1")
+
+        async def last(remaining):
+            calls.append(("last", remaining))
+
+        guard.add_termination_handler(lambda: calls.append(("stop", None)))
+        guard.add_drain_handler(slow)
+        guard.add_drain_handler(failing)
+        guard.add_drain_handler(last)
+
+        guard.terminate()
+        await guard._shutdown()
+
+        assert [name for name, _ in calls] == ["stop", "slow", "failing", "last"]
+        assert calls[1][1] == pytest.approx(0.1, abs=0.01)
+        # Each drain gets the time left until the deadline
+        assert calls[2][1] == pytest.approx(0.05, abs=0.03)
+        assert guard.is_drained()
+        ioloop.stop.assert_called_once()
+
+
+class TestServiceEndpoint:
+    @pytest.mark.asyncio
+    async def test_stop(self):
+        endpoint = service.ServiceEndpoint(listen_port=0)
+        endpoint.setup(tornado.web.Application())
+
+        server = endpoint._server
+        assert server is not None
+        with mock.patch.object(server, 'stop', wraps=server.stop) as stop:
+            endpoint.stop()
+            stop.assert_called_once()
+
+
+class TestLoopConfiguration:
+    @mock.patch.dict(os.environ, {
+    }, clear=True)
+    def test_default(self):
+        cfg = service.LoopConfiguration.from_environment()
+        assert cfg.loop == "asyncio"
+        assert cfg.policy() is None
+
+    def test_invalid_values(self):
+        with pytest.raises(ValueError):
+            service.LoopConfiguration(loop="trio")
+
+    def test_uvloop_missing(self):
+        with mock.patch.dict('sys.modules', {'uvloop': None}):
+            with pytest.raises(ValueError):
+                service.LoopConfiguration(loop="uvloop").policy()
+
+    def test_uvloop(self):
+        uvloop = mock.MagicMock()
+        with mock.patch.dict('sys.modules', {'uvloop': uvloop}), \
+                mock.patch('asyncio.set_event_loop_policy') as set_policy:
+            service.platform_setup(service.LoopConfiguration(loop="uvloop"))
+        set_policy.assert_called_once_with(uvloop.EventLoopPolicy.return_value)
@@ -0,0 +1,143 @@
+""" Test the spam module """
+import pytest
+
+import json
+
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import spam
+
+
+class TestTokenize:
+    def test_tokens(self):
+        assert spam.tokenize("Buy CHEAP pills at spam.com, it's well-known!") == \
+               ["buy", "cheap", "pills", "at", "spam.com", "it's", "well-known"]
+
+
+class TestSpamConfiguration:
+    def test_default(self):
+        # Not enabled without any configuration
+        assert not spam.SpamConfiguration().is_enabled()
+
+    def test_empty_environment(self, monkeypatch):
+        for name in ["SPAM_BLOCKLIST", "SPAM_MODEL", "SPAM_MAX_LINKS"]:
+            monkeypatch.delenv(name, raising=False)
+        assert not spam.SpamConfiguration.from_environment().is_enabled()
+
+    def test_enabled(self):
+        assert spam.SpamConfiguration(max_links=5).is_enabled()
+        assert spam.SpamConfiguration(blocklist="blocklist.txt").is_enabled()
+
+    def test_invalid_values(self):
+        with pytest.raises(ValueError):
+            spam.SpamConfiguration(max_links=-1)
+        with pytest.raises(ValueError):
+            spam.SpamConfiguration(flag=0)
+        with pytest.raises(ValueError):
+            spam.SpamConfiguration(flag=0.9, reject=0.5)
+
+    def test_environment(self, monkeypatch):
+        monkeypatch.setenv("SPAM_BLOCKLIST", "blocklist.txt")
+        monkeypatch.setenv("SPAM_MAX_LINKS", "3")
+        monkeypatch.setenv("SPAM_REJECT", "0.8")
+
+        cfg = spam.SpamConfiguration.from_environment()
+        assert cfg.blocklist == "blocklist.txt"
+        assert cfg.model is None
+        assert cfg.max_links == 3
+        assert cfg.flag == spam.SpamConfiguration.DEFAULT_FLAG
+        assert cfg.reject == 0.8
+
+
+class TestBlocklistMatcher:
+    def test_find(self):
+        matcher = spam.BlocklistMatcher(["he", "she", "hers", "Casino", "spam.com", "viagra pills", " "])
+
+        assert matcher.find("She said: cheap VIAGRA PILLS at spam.com casino, hers!") == \
+               ["she", "viagra pills", "spam.com", "casino", "hers"]
+
+    def test_whole_words(self):
+        matcher = spam.BlocklistMatcher(["casino", "spam.com"])
+
+        assert matcher.find("Occasionally a casinos visit") == []
+        assert matcher.find("visit nospam.com or spam.community") == []
+        assert matcher.find("casino") == ["casino"]
+
+    def test_empty(self):
+        matcher = spam.BlocklistMatcher([])
+
+        assert len(matcher) == 0
+        assert matcher.find("anything") == []
+
+    def test_load(self, tmp_path):
+        path = tmp_path / "blocklist.txt"
+        path.write_text("# Blocked terms\ncasino\n\nspam.com\n")
+
+        matcher = spam.BlocklistMatcher.load(str(path))
+        assert matcher.find("# Blocked terms at spam.com") == ["spam.com"]
+
+
+class TestNaiveBayesModel:
+    MODEL = spam.NaiveBayesModel.train(
+        spam=["buy cheap pills now", "cheap casino bonus now", "cheap pills online"],
+        ham=["great article, thanks", "thanks for the explanation", "the article helped me"]
+    )
+
+    def test_untrained(self):
+        with pytest.raises(ValueError):
+            spam.NaiveBayesModel(spam.NaiveBayesModel.train(spam=["cheap pills"], ham=[]))
+
+    def test_probability(self):
+        model = spam.NaiveBayesModel(self.MODEL)
+
+        assert model.probability(spam.tokenize("Cheap pills now!")) > 0.9
+        assert model.probability(spam.tokenize("Thanks for the great article")) < 0.1
+        assert model.probability([]) == pytest.approx(0.5)
+
+    def test_load(self, tmp_path):
+        path = tmp_path / "model.json"
+        path.write_text(json.dumps(self.MODEL))
+
+        model = spam.NaiveBayesModel.load(str(path))
+        assert model.probability(["cheap"]) > 0.5
+
+
+class TestSpamFilter:
+    def test_disabled(self):
+        with pytest.raises(ValueError):
+            spam.SpamFilter(spam.SpamConfiguration(max_links=0))
+
+    def test_links(self):
+        spam_filter = spam.SpamFilter(spam.SpamConfiguration(max_links=4, flag=0.5, reject=1.0))
+
+        verdict = spam_filter.classify("Nice post")
+        assert verdict.score == 0 and not verdict.flag and not verdict.reject
+
+        verdict = spam_filter.classify("See www.example.com and", url="https://example.org")
+        assert verdict.score == 0.5 and verdict.flag and not verdict.reject
+        assert verdict.reason() == "score 0.50 (2 links)"
+
+        verdict = spam_filter.classify("http://a https://b http://c http://d http://e")
+        assert verdict.score == 1.0 and verdict.reject
+
+        assert spam_filter.get_health() == ({"pass": 1, "flag": 1, "reject": 1}, True)
+
+    def test_blocklist_and_model(self, tmp_path):
+        blocklist = tmp_path / "blocklist.txt"
+        blocklist.write_text("casino\n")
+        model = tmp_path / "model.json"
+        model.write_text(json.dumps(TestNaiveBayesModel.MODEL))
+
+        spam_filter = spam.SpamFilter(spam.SpamConfiguration(blocklist=str(blocklist), model=str(model),
+                                                             max_links=0))
+
+        verdict = spam_filter.classify("Play at the Casino", url="https://example.com")
+        assert verdict.reject
+        assert verdict.reason() == "score 1.00 (blocked: casino)"
+
+        verdict = spam_filter.classify("Cheap pills now")
+        assert verdict.reject
+        assert verdict.reasons[0].startswith("model ")
+
+        verdict = spam_filter.classify("Thanks for the great article")
+        assert not verdict.flag
@@ -0,0 +1,127 @@
+""" Test the store module """
+import asyncio
+from unittest import mock
+import pytest
+
+import time
+
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import store
+
+
+class TestExpiringStore:
+    def test_invalid_values(self):
+        with pytest.raises(ValueError):
+            store.ExpiringStore("test", 0, 1)
+        with pytest.raises(ValueError):
+            store.ExpiringStore("test", 1, 0)
+
+    def test_lru(self):
+        entries = store.ExpiringStore("test", 2, 60)
+        entries.put("a", 1)
+        entries.put("b", 2)
+        assert entries.get("a") == 1
+        entries.put("c", 3)
+
+        # b is the least recently used entry
+        assert entries.get("b") is None
+        assert entries.get("a") == 1
+        assert entries.get("c") == 3
+        assert len(entries) == 2
+
+    def test_ttl(self):
+        entries = store.ExpiringStore("test", 10, 60)
+        entries.put("a", 1)
+        with mock.patch.object(time, 'time', return_value=time.time() + 61):
+            assert entries.get("a") is None
+        assert len(entries) == 0
+
+    def test_persisted(self, tmp_path):
+        path = str(tmp_path / "store.sqlite")
+        entries = store.ExpiringStore("test", 1, 60, path)
+        entries.put("a", {"status": 201})
+        entries.put("b", {"status": 202})
+        # Evicted from memory, but still in the database
+        assert entries.get("a") == {"status": 201}
+        entries.close()
+
+        restored = store.ExpiringStore("test", 10, 60, path)
+        assert restored.get("b") == {"status": 202}
+        with mock.patch.object(time, 'time', return_value=time.time() + 61):
+            assert restored.get("a") is None
+        restored.close()
+
+        # Stores are separated by name
+        other = store.ExpiringStore("other", 10, 60, path)
+        assert other.get("a") is None
+        other.close()
+
+
+class TestResponseStore:
+    @staticmethod
+    def _create():
+        return store.ResponseStore(store.ExpiringStore("test", 10, 60), "test")
+
+    @pytest.mark.asyncio
+    async def test_stored(self):
+        responses = TestResponseStore._create()
+        calls = list()
+
+        async def produce():
+            calls.append(True)
+            return {"pr": 1}
+
+        assert await responses.run("a", produce) == ({"pr": 1}, False)
+        assert await responses.run("a", produce) == ({"pr": 1}, True)
+        assert await responses.run("b", produce) == ({"pr": 1}, False)
+        assert len(calls) == 2
+
+        health, _ = responses.get_health()
+        assert health == {"entries": 2, "in-flight": 0, "hits": 1, "waited": 0, "misses": 2}
+
+    @pytest.mark.asyncio
+    async def test_wait_in_flight(self):
+        responses = TestResponseStore._create()
+        release = asyncio.Event()
+        calls = list()
+
+        async def produce():
+            calls.append(True)
+            await release.wait()
+            return {"pr": len(calls)}
+
+        first = asyncio.ensure_future(responses.run("a", produce))
+        second = asyncio.ensure_future(responses.run("a", produce))
+        await asyncio.sleep(0)
+        assert responses.get_health()[0]["in-flight"] == 1
+
+        release.set()
+        assert await first == ({"pr": 1}, False)
+        assert await second == ({"pr": 1}, True)
+        assert len(calls) == 1
+        assert responses.get_health()[0]["waited"] == 1
+
+    @pytest.mark.asyncio
+    async def test_failure_not_stored(self):
+        responses = TestResponseStore._create()
+        release = asyncio.Event()
+        calls = list()
+
+        async def produce():
+            calls.append(True)
+            await release.wait()
+            if len(calls) == 1:
+                raise RuntimeError("failed")
+            return {"pr": len(calls)}
+
+        first = asyncio.ensure_future(responses.run("a", produce))
+        second = asyncio.ensure_future(responses.run("a", produce))
+        await asyncio.sleep(0)
+
+        release.set()
+        with pytest.raises(RuntimeError):
+            await first
+        # The waiting request tries on its own
+        assert await second == ({"pr": 2}, False)
+        assert len(calls) == 2
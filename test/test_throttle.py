@@ -0,0 +1,185 @@
+""" Test the throttle module """
+from unittest import mock
+import pytest
+
+import os
+
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import throttle
+
+
+class TestTokenBucket:
+    def test_invalid_values(self):
+        with pytest.raises(ValueError):
+            throttle.TokenBucket(rate=0, burst=1)
+        with pytest.raises(ValueError):
+            throttle.TokenBucket(rate=1, burst=0)
+
+    def test_burst(self):
+        bucket = throttle.TokenBucket(rate=1, burst=3)
+        now = bucket._stamp
+
+        assert bucket.take(now) == 0
+        assert bucket.take(now) == 0
+        assert bucket.take(now) == 0
+        assert bucket.take(now) == pytest.approx(1.0)
+
+    def test_refill(self):
+        bucket = throttle.TokenBucket(rate=2, burst=2)
+        now = bucket._stamp
+
+        assert bucket.take(now) == 0
+        assert bucket.take(now) == 0
+        assert bucket.take(now) == pytest.approx(0.5)
+        assert bucket.take(now + 0.5) == 0
+        assert bucket.tokens(now + 10) == 2
+
+
+class TestKeyedTokenBuckets:
+    def test_invalid_values(self):
+        with pytest.raises(ValueError):
+            throttle.KeyedTokenBuckets(rate=1, burst=1, size=0)
+        with pytest.raises(ValueError):
+            throttle.KeyedTokenBuckets(rate=0, burst=1, size=1)
+
+    def test_keys(self):
+        buckets = throttle.KeyedTokenBuckets(rate=1, burst=1, size=2)
+
+        assert buckets.take("a") == 0
+        assert buckets.take("a") > 0
+        assert buckets.take("b") == 0
+        assert buckets.take("a") > 0
+
+        # c evicts the least recently used bucket b
+        assert buckets.take("c") == 0
+        assert len(buckets) == 2
+        assert buckets.take("a") > 0
+        assert buckets.take("b") == 0
+
+
+class TestRateLimitConfiguration:
+    def test_default_init(self):
+        cfg = throttle.RateLimitConfiguration()
+        assert cfg.ip_rate == 0
+        assert cfg.ip_burst == 5
+        assert cfg.slug_rate == 0
+        assert cfg.slug_burst == 20
+        assert cfg.size == 10000
+        assert cfg.proxies == 0
+        assert not cfg.is_enabled()
+
+    @mock.patch.dict(os.environ, {
+        "RATE_LIMIT_IP": "2",
+        "RATE_LIMIT_IP_BURST": "3",
+        "RATE_LIMIT_SLUG": "10",
+        "RATE_LIMIT_SLUG_BURST": "4",
+        "RATE_LIMIT_SIZE": "100",
+        "RATE_LIMIT_PROXIES": "1"
+    }, clear=True)
+    def test_env(self):
+        cfg = throttle.RateLimitConfiguration.from_environment()
+        assert cfg.ip_rate == 2
+        assert cfg.ip_burst == 3
+        assert cfg.slug_rate == 10
+        assert cfg.slug_burst == 4
+        assert cfg.size == 100
+        assert cfg.proxies == 1
+        assert cfg.is_enabled()
+
+    def test_invalid_values(self):
+        with pytest.raises(ValueError):
+            throttle.RateLimitConfiguration(ip_rate=-1)
+        with pytest.raises(ValueError):
+            throttle.RateLimitConfiguration(slug_burst=0)
+        with pytest.raises(ValueError):
+            throttle.RateLimitConfiguration(size=0)
+        with pytest.raises(ValueError):
+            throttle.RateLimitConfiguration(proxies=-1)
+        with pytest.raises(ValueError):
+            throttle.RateLimiter(throttle.RateLimitConfiguration())
+
+
+class TestRateLimiter:
+    def test_client_ip(self):
+        limiter = throttle.RateLimiter(throttle.RateLimitConfiguration(ip_rate=1))
+        # Forwarded addresses are not trusted
+        assert limiter.client_ip("10.0.0.1", "1.2.3.4") == "10.0.0.1"
+
+        limiter = throttle.RateLimiter(throttle.RateLimitConfiguration(ip_rate=1, proxies=1))
+        assert limiter.client_ip("10.0.0.1", None) == "10.0.0.1"
+        assert limiter.client_ip("10.0.0.1", "1.2.3.4") == "1.2.3.4"
+        # The forged first address is ignored
+        assert limiter.client_ip("10.0.0.1", "6.6.6.6, 1.2.3.4") == "1.2.3.4"
+
+        limiter = throttle.RateLimiter(throttle.RateLimitConfiguration(ip_rate=1, proxies=2))
+        assert limiter.client_ip("10.0.0.2", "6.6.6.6, 1.2.3.4, 10.0.0.1") == "1.2.3.4"
+        assert limiter.client_ip("10.0.0.2", "1.2.3.4") == "1.2.3.4"
+
+    def test_check(self):
+        limiter = throttle.RateLimiter(throttle.RateLimitConfiguration(ip_rate=1, ip_burst=2,
+                                                                       slug_rate=60, slug_burst=3))
+        assert limiter.check("a", "post") == 0
+        assert limiter.check("a", "post") == 0
+        # One comment per minute for the address
+        assert 0 < limiter.check("a", "post") <= 60
+        assert limiter.check("b", "post") == 0
+        # One comment per second for the post
+        assert limiter.check("c", "post") == 1
+
+        health, _ = limiter.get_health()
+        assert health == {"ip-keys": 3, "slug-keys": 1, "limited": {"ip": 1, "slug": 1}}
+
+    def test_shared(self, tmp_path):
+        cfg = throttle.RateLimitConfiguration(ip_rate=1, ip_burst=1, path=str(tmp_path / "limits.db"))
+        first, second = throttle.RateLimiter(cfg), throttle.RateLimiter(cfg)
+
+        assert first.check("a", "post") == 0
+        assert 0 < second.check("a", "post") <= 60
+        assert second.get_health()[0]["ip-keys"] == 1
+
+
+class TestSharedTokenBuckets:
+    def test_invalid_values(self, tmp_path):
+        with pytest.raises(ValueError):
+            throttle.SharedTokenBuckets("ip", rate=1, burst=1, size=0, path=str(tmp_path / "limits.db"))
+        with pytest.raises(ValueError):
+            throttle.SharedTokenBuckets("ip", rate=0, burst=1, size=1, path=str(tmp_path / "limits.db"))
+
+    def test_take(self, tmp_path):
+        buckets = throttle.SharedTokenBuckets("ip", rate=2, burst=2, size=10, path=str(tmp_path / "limits.db"))
+
+        assert buckets.take("a", now=100) == 0
+        assert buckets.take("a", now=100) == 0
+        assert buckets.take("a", now=100) == pytest.approx(0.5)
+        assert buckets.take("a", now=100.5) == 0
+        assert buckets.take("b", now=100.5) == 0
+        assert len(buckets) == 2
+        buckets.close()
+
+    def test_shared(self, tmp_path):
+        path = str(tmp_path / "limits.db")
+        first = throttle.SharedTokenBuckets("ip", rate=1, burst=1, size=10, path=path)
+        second = throttle.SharedTokenBuckets("ip", rate=1, burst=1, size=10, path=path)
+        other = throttle.SharedTokenBuckets("slug", rate=1, burst=1, size=10, path=path)
+
+        assert first.take("a", now=100) == 0
+        assert second.take("a", now=100) > 0
+        # Buckets are separated by name
+        assert other.take("a", now=100) == 0
+
+    def test_prune(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(throttle.SharedTokenBuckets, "PRUNE_INTERVAL", 0)
+        buckets = throttle.SharedTokenBuckets("ip", rate=1, burst=1, size=2, path=str(tmp_path / "limits.db"))
+
+        buckets.take("a", now=1000)
+        buckets.take("b", now=1000.5)
+        # a is full again and removed
+        buckets.take("c", now=1001.2)
+        assert len(buckets) == 2
+
+        # b is the least recently used above the size, it starts with a full bucket again
+        buckets.take("d", now=1001.3)
+        assert len(buckets) == 2
+        assert buckets.take("c", now=1001.3) > 0
+        assert buckets.take("b", now=1001.3) == 0
@@ -0,0 +1,57 @@
+""" Test the timing module """
+import pytest
+
+import asyncio
+import contextvars
+
+# noinspection PyUnresolvedReferences
+# noinspection PyPackageRequirements
+import timing
+
+
+def test_record_without_start():
+    def record():
+        timing.record("stage", 1.0)
+        return timing._TIMINGS.get()
+
+    assert contextvars.Context().run(record) is None
+
+
+def test_record_and_header():
+    def record():
+        timings = timing.start()
+        timing.record("ref", 0.002)
+        timing.record("upload", 0.1)
+        timing.record("ref", 0.0031)
+        return timings
+
+    timings = contextvars.Context().run(record)
+    assert timing.milliseconds(timings) == {"ref": 5.1, "upload": 100.0}
+    assert timing.header(timings) == "ref;dur=5.1, upload;dur=100.0"
+
+
+def test_empty_header():
+    assert timing.header(None) == ""
+    assert timing.header(dict()) == ""
+
+
+@pytest.mark.asyncio
+async def test_stage_in_task():
+    async def request():
+        timings = timing.start()
+
+        async def stage():
+            with timing.stage("github"):
+                await asyncio.sleep(0.01)
+
+        # Tasks copy the context, the timings are shared
+        await asyncio.ensure_future(stage())
+        with pytest.raises(RuntimeError):
+            with timing.stage("failed"):
+                raise RuntimeError()
+
+        return timings
+
+    timings = await asyncio.ensure_future(request())
+    assert timings["github"] >= 0.01
+    assert "failed" in timings